@@ -0,0 +1,306 @@
+"""
+Нагрузочный бенчмарк HTTP API Viora.
+
+Гоняет /run-ai-life, /run-ai-life/stream и оба flow-эндпоинта (обычные и SSE)
+на заданных уровнях параллельности и печатает пропускную способность,
+p50/p95/p99 задержки и время до первого содержательного SSE-события.
+
+Полностью локальный прогон: заглушка LLM (bench/mock_llm.py) и сервер Viora
+поднимаются сами.
+
+    python bench/load.py --mock --server asgi --concurrency 1,8,32 --requests 200
+
+Против уже запущенного сервера:
+
+    python bench/load.py --target http://127.0.0.1:5001 --scenarios next_frame,life_stream
+
+--save сохраняет результаты в JSON; --baseline сравнивает с сохранёнными и
+завершается с кодом 1, если p95 или пропускная способность ухудшились больше
+чем на --tolerance.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import requests
+
+from mock_llm import MockLLMServer, add_mock_arguments, settings_from_args
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# ── Сценарии ──────────────────────────────────────────────────────────────────
+@dataclass(frozen=True)
+class Scenario:
+    path: str
+    stream: bool
+    payload: Callable[[str, argparse.Namespace], dict[str, Any]]
+
+
+def _life(tag: str, args: argparse.Namespace) -> dict[str, Any]:
+    return {"title": f"Сменить работу {tag}", "outcomes": [f"Вариант {k + 1} {tag}" for k in range(args.outcomes)]}
+
+
+def _next_frame(tag: str, args: argparse.Namespace) -> dict[str, Any]:
+    return {"title": f"Сцена {tag}", "current_frame": "Герой стоит у окна и держит письмо"}
+
+
+def _analyze(tag: str, args: argparse.Namespace) -> dict[str, Any]:
+    return {"title": f"Сцена {tag}", "frames": ["Общий план комнаты", "Крупный план рук", "Лицо героя в тени"]}
+
+
+SCENARIOS: dict[str, Scenario] = {
+    "life": Scenario("/run-ai-life", False, _life),
+    "life_stream": Scenario("/run-ai-life/stream", True, _life),
+    "next_frame": Scenario("/run-ai-flow-next-frame", False, _next_frame),
+    "next_frame_stream": Scenario("/run-ai-flow-next-frame/stream", True, _next_frame),
+    "analyze": Scenario("/run-ai-flow-analyze-frames", False, _analyze),
+    "analyze_stream": Scenario("/run-ai-flow-analyze-frames/stream", True, _analyze),
+}
+
+
+# ── Запуск серверов ───────────────────────────────────────────────────────────
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_viora(kind: str, llm_url: str, *, workers: int, extra_env: dict[str, str]) -> tuple[subprocess.Popen, str]:
+    port = _free_port()
+    env = {**os.environ, "OLLAMA_URL": llm_url, "PORT": str(port), "VIORA_OLLAMA_PRELOAD": "0", **extra_env}
+    env.pop("OLLAMA_URLS", None)
+    if kind == "flask":
+        cmd = [sys.executable, "main.py"]
+    elif kind == "gunicorn":
+        cmd = ["gunicorn", "-w", str(workers), "-k", "gthread", "--threads", "32",
+               "-b", f"127.0.0.1:{port}", "--log-level", "warning", "main:app"]
+    elif kind == "asgi":
+        cmd = ["uvicorn", "main:asgi_app", "--port", str(port), "--workers", str(workers), "--log-level", "warning"]
+    else:
+        raise SystemExit(f"Неизвестный сервер: {kind}")
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"{kind}: сервер завершился с кодом {proc.returncode}")
+        try:
+            if requests.get(url + "/livez", timeout=1).ok:
+                return proc, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit(f"{kind}: сервер не поднялся за 30 с")
+
+
+# ── Прогон ────────────────────────────────────────────────────────────────────
+@dataclass
+class Sample:
+    ok: bool
+    status: int
+    latency: float
+    first_event: float | None
+
+
+def _one(session: requests.Session, url: str, scenario: Scenario, payload: dict[str, Any], timeout: float) -> Sample:
+    started = time.perf_counter()
+    try:
+        resp = session.post(url + scenario.path, json=payload, stream=scenario.stream, timeout=timeout)
+        first_event = None
+        ok = resp.status_code == 200
+        if scenario.stream and ok:
+            event = None
+            for line in resp.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                    # start отправляется сразу — считаем первое событие с ответом модели.
+                    if first_event is None and event not in ("start", "done"):
+                        first_event = time.perf_counter() - started
+                    if event == "error":
+                        ok = False
+        else:
+            resp.content
+        resp.close()
+        return Sample(ok, resp.status_code, time.perf_counter() - started, first_event)
+    except requests.RequestException:
+        return Sample(False, 0, time.perf_counter() - started, None)
+
+
+def run_level(url: str, name: str, concurrency: int, args: argparse.Namespace) -> dict[str, Any]:
+    scenario = SCENARIOS[name]
+    counter = iter(range(args.requests))
+    lock = threading.Lock()
+    samples: list[Sample] = []
+    run_id = uuid.uuid4().hex[:8]
+
+    def step(session: requests.Session, i: int) -> None:
+        # Уникальный тег — запросы не попадают в кэш ответов, если не задан --cached.
+        tag = "" if args.cached else f"#{run_id}-{i}"
+        payload = scenario.payload(tag, args)
+        if not args.cached:
+            payload["no_cache"] = True
+        sample = _one(session, url, scenario, payload, args.timeout)
+        with lock:
+            samples.append(sample)
+
+    def worker() -> None:
+        with requests.Session() as session:
+            while True:
+                with lock:
+                    i = next(counter, None)
+                if i is None:
+                    return
+                step(session, i)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    elapsed = time.perf_counter() - started
+    return summarize(name, concurrency, samples, elapsed)
+
+
+def _pct(values: list[float], p: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p * len(ordered)) - 1))]
+
+
+def summarize(name: str, concurrency: int, samples: list[Sample], elapsed: float) -> dict[str, Any]:
+    ok = [s for s in samples if s.ok]
+    latencies = [s.latency for s in ok]
+    firsts = [s.first_event for s in ok if s.first_event is not None]
+    statuses: dict[str, int] = {}
+    for s in samples:
+        statuses[str(s.status)] = statuses.get(str(s.status), 0) + 1
+    return {
+        "scenario": name,
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "statuses": statuses,
+        "elapsed": round(elapsed, 3),
+        "rps": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "p50": _pct(latencies, 0.50),
+        "p95": _pct(latencies, 0.95),
+        "p99": _pct(latencies, 0.99),
+        "first_event_p50": _pct(firsts, 0.50),
+        "first_event_p95": _pct(firsts, 0.95),
+    }
+
+
+def _ms(value: float | None) -> str:
+    return "-" if value is None else f"{value * 1000:.0f}"
+
+
+def print_table(rows: list[dict[str, Any]]) -> None:
+    header = f"{'scenario':<18} {'conc':>4} {'req':>5} {'err':>4} {'rps':>8} " \
+             f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'1st p50':>8} {'1st p95':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in rows:
+        print(f"{r['scenario']:<18} {r['concurrency']:>4} {r['requests']:>5} {r['errors']:>4} {r['rps']:>8.2f} "
+              f"{_ms(r['p50']):>8} {_ms(r['p95']):>8} {_ms(r['p99']):>8} "
+              f"{_ms(r['first_event_p50']):>8} {_ms(r['first_event_p95']):>8}")
+
+
+def compare(rows: list[dict[str, Any]], baseline_path: str, tolerance: float) -> list[str]:
+    """Регрессии относительно сохранённого прогона: p95 выше или rps ниже больше чем на tolerance."""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(r["scenario"], r["concurrency"]): r for r in json.load(f)["results"]}
+    problems = []
+    for r in rows:
+        base = baseline.get((r["scenario"], r["concurrency"]))
+        if base is None:
+            continue
+        key = f"{r['scenario']}@{r['concurrency']}"
+        if base["p95"] and r["p95"] and r["p95"] > base["p95"] * (1 + tolerance):
+            problems.append(f"{key}: p95 {_ms(base['p95'])} → {_ms(r['p95'])} ms")
+        if base["rps"] and r["rps"] < base["rps"] * (1 - tolerance):
+            problems.append(f"{key}: rps {base['rps']} → {r['rps']}")
+        if r["errors"] > base["errors"]:
+            problems.append(f"{key}: ошибок {base['errors']} → {r['errors']}")
+    return problems
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", help="URL запущенного сервера Viora (иначе поднимается --server)")
+    parser.add_argument("--server", choices=("flask", "gunicorn", "asgi"), default="asgi")
+    parser.add_argument("--workers", type=int, default=1, help="воркеров gunicorn/uvicorn")
+    parser.add_argument("--mock", action="store_true", help="поднять заглушку LLM (иначе OLLAMA_URL из окружения)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="через запятую: " + ", ".join(SCENARIOS))
+    parser.add_argument("--concurrency", default="1,4,16", help="уровни параллельности через запятую")
+    parser.add_argument("--requests", type=int, default=50, help="запросов на уровень")
+    parser.add_argument("--outcomes", type=int, default=3, help="исходов в запросе life")
+    parser.add_argument("--cached", action="store_true", help="одинаковые запросы (мерить кэш ответов)")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="переменные окружения для поднимаемого сервера (VIORA_LIFE_BATCH=1 и т. п.)")
+    parser.add_argument("--save", help="сохранить результаты в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение (доля)")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    names = [n.strip() for n in args.scenarios.split(",") if n.strip()]
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f"Неизвестные сценарии: {', '.join(unknown)}")
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+
+    mock = proc = None
+    try:
+        if args.mock:
+            mock = MockLLMServer(settings_from_args(args)).start()
+            print(f"mock LLM: {mock.url} (ttft={args.ttft}, tps={args.tps}, parallel={args.parallel})")
+        url = args.target
+        if url is None:
+            llm_url = mock.url if mock else os.environ.get("OLLAMA_URL", "http://localhost:11434")
+            extra_env = dict(item.split("=", 1) for item in args.env)
+            proc, url = start_viora(args.server, llm_url, workers=args.workers, extra_env=extra_env)
+            print(f"viora ({args.server}): {url}")
+        rows = []
+        for name in names:
+            for level in levels:
+                rows.append(run_level(url.rstrip("/"), name, level, args))
+        print()
+        print_table(rows)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=10)
+        if mock is not None:
+            mock.stop()
+
+    if args.save:
+        meta = {"server": args.server if not args.target else args.target, "mock": bool(args.mock),
+                "ttft": args.ttft, "tps": args.tps, "parallel": args.parallel, "created": time.time()}
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"meta": meta, "results": rows}, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        problems = compare(rows, args.baseline, args.tolerance)
+        if problems:
+            print("\nРегрессии:")
+            for p in problems:
+                print("  " + p)
+            raise SystemExit(1)
+        print("\nРегрессий относительно baseline нет.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Микробенчмарки очистки и разбора ответов модели.
+
+sanitize_ai_text, parse_*_sections, split_life_batch и потоковый
+StreamingParser на заготовках в стиле DeepSeek-R1 (см. bench/mock_llm.py).
+
+    python bench/micro.py
+    python bench/micro.py --think-chars 4000 --filter sanitize --save micro.json
+    python bench/micro.py --baseline micro.json --tolerance 0.25
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import timeit
+from typing import Any, Callable
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("VIORA_HEALTH_INTERVAL", "0")
+
+import main  # noqa: E402
+from mock_llm import canned_response, split_tokens  # noqa: E402
+
+_LIFE_PROMPT = main.build_prompt_pros_cons("Сменить работу", "Уйти во фриланс")
+_NEXT_PROMPT = main.build_prompt_next_frame("Сцена", "Герой стоит у окна")
+_ANALYZE_PROMPT = main.build_prompt_analyze_frames("Сцена", ["Общий план", "Крупный план", "Лицо в тени"])
+_BATCH_PROMPT = main.build_prompt_pros_cons_batch("Сменить работу", [f"Вариант {k}" for k in range(1, 6)])
+
+
+def _stream(kind: str, chunks: list[str]) -> Callable[[], Any]:
+    def run() -> Any:
+        parser = main.StreamingParser(kind)
+        for chunk in chunks:
+            parser.feed(chunk)
+        return parser.finish()
+    return run
+
+
+def cases(think_chars: int) -> dict[str, Callable[[], Any]]:
+    life = canned_response(_LIFE_PROMPT, think_chars=think_chars)[1]
+    nxt = canned_response(_NEXT_PROMPT, think_chars=think_chars)[1]
+    analyze = canned_response(_ANALYZE_PROMPT, think_chars=think_chars)[1]
+    batch = canned_response(_BATCH_PROMPT, think_chars=think_chars)[1]
+    life_clean = main.sanitize_ai_text(life)
+    next_clean = main.sanitize_ai_text(nxt)
+    analyze_clean = main.sanitize_ai_text(analyze)
+    return {
+        "sanitize/life": lambda: main.sanitize_ai_text(life),
+        "sanitize/next_frame": lambda: main.sanitize_ai_text(nxt),
+        "sanitize/analyze": lambda: main.sanitize_ai_text(analyze),
+        "parse/life": lambda: main.parse_life_sections(life_clean),
+        "parse/next_frame": lambda: main.parse_flow_next_frame_sections(next_clean),
+        "parse/analyze": lambda: main.parse_flow_analyze_sections(analyze_clean),
+        "sanitize+parse/life": lambda: main.parse_life_sections(main.sanitize_ai_text(life)),
+        "split_batch/5": lambda: main.split_life_batch(main.sanitize_ai_text(batch, max_len=20000), 5),
+        "stream/life": _stream("life", split_tokens(life)),
+        "stream/next_frame": _stream("next_frame", split_tokens(nxt)),
+        "stream/analyze": _stream("analyze", split_tokens(analyze)),
+    }
+
+
+def measure(fn: Callable[[], Any], *, min_time: float, repeat: int) -> float:
+    """Лучшее время одного вызова (секунды) из repeat серий по ≥ min_time."""
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    number = max(number, int(number * min_time / 0.2))
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--think-chars", type=int, default=400, help="длина блока <think> в заготовках")
+    parser.add_argument("--filter", default="", help="только кейсы, содержащие подстроку")
+    parser.add_argument("--min-time", type=float, default=0.2, help="секунд на серию")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", help="сохранить результаты в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимое замедление (доля)")
+    args = parser.parse_args()
+
+    results: dict[str, float] = {}
+    print(f"{'case':<24} {'µs/call':>10} {'calls/s':>12}")
+    for name, fn in cases(args.think_chars).items():
+        if args.filter and args.filter not in name:
+            continue
+        per_call = measure(fn, min_time=args.min_time, repeat=args.repeat)
+        results[name] = per_call
+        print(f"{name:<24} {per_call * 1e6:>10.1f} {1 / per_call:>12.0f}")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"think_chars": args.think_chars, "results": results}, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        slower = [
+            f"{name}: {baseline[name] * 1e6:.1f} → {value * 1e6:.1f} µs"
+            for name, value in results.items()
+            if name in baseline and value > baseline[name] * (1 + args.tolerance)
+        ]
+        if slower:
+            print("\nРегрессии:")
+            for line in slower:
+                print("  " + line)
+            raise SystemExit(1)
+        print("\nРегрессий относительно baseline нет.")
+
+
+if __name__ == "__main__":
+    run()
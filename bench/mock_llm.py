@@ -0,0 +1,422 @@
+"""
+Локальная заглушка LLM для бенчмарков Viora.
+
+Отвечает как Ollama (/api/generate, /api/chat, /api/tags — обычный и
+потоковый NDJSON) и как Mistral (/v1/chat/completions, /v1/models — JSON и SSE).
+Ответы — заготовки в стиле DeepSeek-R1: блок <think> с рассуждениями, затем
+отчёт в формате промпта (life, пакет life с «### ИСХОД k», следующий кадр,
+анализ кадров, оценка куска кадров для map-reduce). Тип ответа определяется
+по системной части промпта. --tail-chars добавляет после отчёта болтовню вне
+формата; лимит токенов (num_predict / max_tokens) и стоп-строки запроса
+соблюдаются, как у настоящей модели. Поле think запроса Ollama тоже:
+false — ответ без рассуждения, true — рассуждение в отдельном поле thinking.
+
+Задержка моделируется как время до первого токена (распределение --ttft)
+плюс генерация со скоростью --tps токенов в секунду; --parallel ограничивает
+число одновременных генераций, как OLLAMA_NUM_PARALLEL на одной GPU.
+
+    python bench/mock_llm.py --port 11500 --ttft lognormal:-1.2,0.5 --tps 60
+    OLLAMA_URL=http://127.0.0.1:11500 python main.py
+
+GET /_stats — число запросов по типам, текущая занятость и отданные токены
+(generated; оборванные клиентом потоки — aborted).
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Iterator
+
+# ── Заготовки ответов ─────────────────────────────────────────────────────────
+_THINK = (
+    "<think>\nПользователь просит разобрать вариант. Сначала пойму контекст: {subject}. "
+    "Нужно взвесить выгоды и издержки, не забыть о рисках и дать конкретные шаги. "
+    "Формат строгий — заголовки секций без маркеров.\n{filler}</think>\n"
+)
+
+_LIFE = (
+    "ОПИСАНИЕ {subject}\n"
+    "Вариант меняет привычный уклад и требует подготовки, но открывает новые возможности.\n"
+    "ПЛЮСЫ:\n"
+    "Рост профессиональных навыков и круга контактов\n"
+    "Больше контроля над собственным временем\n"
+    "Новый опыт, который пригодится в будущем\n"
+    "МИНУСЫ:\n"
+    "Дополнительные расходы в первые месяцы\n"
+    "Стресс адаптации и усталость\n"
+    "Меньше времени на близких\n"
+    "РИСКИ:\n"
+    "Ожидания могут не совпасть с реальностью\n"
+    "Финансовая подушка закончится раньше плана\n"
+    "РЕКОМЕНДАЦИИ:\n"
+    "Составить бюджет минимум на полгода\n"
+    "Договориться о поддержке с близкими заранее\n"
+    "ОЦЕНКА: 7/10 — перспективно при хорошей подготовке\n"
+    "ВЕРДИКТ: Стоит пробовать, если есть запас по деньгам и времени.\n"
+)
+
+_NEXT_FRAME = (
+    "СЛЕДУЮЩИЙ КАДР: Крупный план рук героя, сжимающих письмо\n"
+    "ВИЗУАЛЬНЫЕ ЭЛЕМЕНТЫ: тёплый свет лампы; смятая бумага; тень от окна\n"
+    "ЭМОЦИОНАЛЬНОЕ ВОЗДЕЙСТВИЕ: тревога; ожидание развязки\n"
+    "КОМПОЗИЦИЯ: руки в центре кадра; диагональ тени\n"
+    "ЗВУК И РИТМ: шорох бумаги; пауза перед репликой\n"
+    "ПЕРЕХОД: Резкая склейка на лицо героя.\n"
+)
+
+_ANALYZE = (
+    "ЛУЧШИЙ КАДР: 2\n"
+    "ПОЧЕМУ ЭТОТ КАДР: Он точнее всего передаёт напряжение сцены.\n"
+    "КОМПОЗИЦИЯ: герой смещён влево; свободное пространство усиливает одиночество\n"
+    "АТМОСФЕРА: холодная палитра; приглушённый свет\n"
+    "ДРАМАТУРГИЯ: момент перед решением; зритель ждёт ответа\n"
+    "СИЛЬНЫЕ СТОРОНЫ: ясная мизансцена; работа со светом\n"
+    "ВОЗМОЖНЫЕ УЛУЧШЕНИЯ: добавить деталь на переднем плане; замедлить ритм\n"
+    "СЛЕДУЮЩИЙ ШАГ: показать реакцию второго персонажа\n"
+    "ОЦЕНКА: 8/10 — сильный кадр с понятной эмоцией\n"
+    "ВЕРДИКТ: Оставить кадр 2 и развивать сцену от него.\n"
+)
+
+_TAIL = "Надеюсь, этот разбор поможет. Если нужно, могу расписать подробнее каждый пункт. "
+
+_BATCH_LIST_RE = re.compile(r"^(\d+)\.\s+(.+)$", re.MULTILINE)
+_SUBJECT_RE = re.compile(r"Вариант решения:\s*(.+)")
+
+
+def _kind(prompt: str) -> str:
+    if "Варианты решения:" in prompt:
+        return "life_batch"
+    if "кинорежиссёр-отборщик" in prompt:
+        return "score_frames"
+    if "кинорежиссёр-аналитик" in prompt:
+        return "analyze"
+    if "кинорежиссёр" in prompt:
+        return "next_frame"
+    return "life"
+
+
+def _think(subject: str, think_chars: int) -> str:
+    filler = ("Проверю ещё раз формулировки и порядок секций. " * (think_chars // 48 + 1))[:think_chars]
+    return _THINK.format(subject=subject, filler=filler)
+
+
+def canned_response(prompt: str, *, think_chars: int = 400, tail_chars: int = 0) -> tuple[str, str]:
+    """(тип, текст ответа) для промпта Viora; tail_chars — болтовня после формата."""
+    kind, text = _canned_response(prompt, think_chars)
+    if tail_chars:
+        text += "\n" + (_TAIL * (tail_chars // len(_TAIL) + 1))[:tail_chars]
+    return kind, text
+
+
+def _canned_response(prompt: str, think_chars: int) -> tuple[str, str]:
+    kind = _kind(prompt)
+    if kind == "life_batch":
+        listed = _BATCH_LIST_RE.findall(prompt.split("Варианты решения:", 1)[1])
+        blocks = [f"### ИСХОД {k}\n" + _LIFE.format(subject=name.strip()) for k, name in listed]
+        return kind, _think("несколько вариантов", think_chars) + "\n".join(blocks)
+    if kind == "score_frames":
+        listed = _BATCH_LIST_RE.findall(prompt.split("Кадры:", 1)[1])
+        # Оценка зависит только от текста кадра — отбор воспроизводим между прогонами.
+        lines = [f"КАДР {k}: {3 + zlib.crc32(name.encode()) % 7}/10 — выразительный свет" for k, name in listed]
+        return kind, _think("кадры", think_chars) + "\n".join(lines) + "\n"
+    if kind == "life":
+        m = _SUBJECT_RE.search(prompt)
+        subject = m.group(1).strip() if m else "Вариант"
+        return kind, _think(subject, think_chars) + _LIFE.format(subject=subject)
+    body = _ANALYZE if kind == "analyze" else _NEXT_FRAME
+    return kind, _think("сцена", think_chars) + body
+
+
+_THINK_RE = re.compile(r"<think>\n?(.*?)</think>\n?", re.DOTALL)
+
+
+def split_tokens(text: str, size: int = 4) -> list[str]:
+    """Грубая нарезка на «токены» по ~4 символа — как отдаёт модель при стриминге."""
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def split_thinking(text: str) -> tuple[str, str]:
+    """(рассуждение, ответ): блок <think> — в отдельное поле, как у Ollama с think: true."""
+    m = _THINK_RE.match(text)
+    if not m:
+        return "", text
+    return m.group(1), text[m.end():]
+
+
+def apply_limits(text: str, body: dict[str, Any], *, openai: bool) -> str:
+    """Стоп-строки и лимит токенов из запроса (options у Ollama, верхний уровень у Mistral)."""
+    params = body if openai else (body.get("options") or {})
+    stop = params.get("stop") or []
+    for seq in [stop] if isinstance(stop, str) else stop:
+        pos = text.find(seq)
+        if pos >= 0:
+            text = text[:pos]
+    limit = params.get("max_tokens" if openai else "num_predict") or 0
+    if limit > 0:
+        text = "".join(split_tokens(text)[:limit])
+    return text
+
+
+# ── Распределения задержек ────────────────────────────────────────────────────
+def parse_distribution(spec: str) -> Callable[[], float]:
+    """fixed:0.5 | uniform:0.2,1.5 | lognormal:mu,sigma | exp:mean (секунды)."""
+    name, _, raw = spec.partition(":")
+    args = [float(x) for x in raw.split(",") if x.strip()]
+    if name == "fixed":
+        return lambda: args[0]
+    if name == "uniform":
+        return lambda: random.uniform(args[0], args[1])
+    if name == "lognormal":
+        return lambda: random.lognormvariate(args[0], args[1])
+    if name == "exp":
+        return lambda: random.expovariate(1 / args[0])
+    raise ValueError(f"Неизвестное распределение: {spec}")
+
+
+@dataclass
+class MockSettings:
+    ttft: Callable[[], float]
+    tps: float
+    parallel: int
+    think_chars: int
+    error_rate: float
+    tail_chars: int
+
+    @property
+    def token_delay(self) -> float:
+        return 1 / self.tps if self.tps > 0 else 0.0
+
+
+class _Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests: dict[str, int] = {}
+        self.active = 0
+        self.errors = 0
+        self.generated = 0
+        self.aborted = 0
+
+    def hit(self, kind: str) -> None:
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+    def add(self, field: str, delta: int) -> None:
+        with self._lock:
+            setattr(self, field, getattr(self, field) + delta)
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": dict(self.requests), "active": self.active, "errors": self.errors,
+                "generated": self.generated, "aborted": self.aborted,
+            }
+
+
+# ── HTTP ──────────────────────────────────────────────────────────────────────
+def make_handler(settings: MockSettings, stats: _Stats) -> type[BaseHTTPRequestHandler]:
+    gpu = threading.BoundedSemaphore(settings.parallel) if settings.parallel > 0 else None
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+        def _json(self, obj: Any, status: int = 200) -> None:
+            data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self) -> None:
+            if self.path == "/api/tags":
+                return self._json({"models": [{"name": self.server.model_name}]})
+            if self.path.rstrip("/").endswith("/models"):
+                return self._json({"data": [{"id": "mistral-small-latest"}]})
+            if self.path == "/_stats":
+                return self._json(stats.snapshot())
+            self._json({"error": "not found"}, 404)
+
+        def do_POST(self) -> None:
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                body = json.loads(self.rfile.read(length) or b"{}")
+            except json.JSONDecodeError:
+                return self._json({"error": "bad json"}, 400)
+            openai = self.path.rstrip("/").endswith("/chat/completions")
+            if not openai and self.path not in ("/api/generate", "/api/chat"):
+                return self._json({"error": "not found"}, 404)
+            messages = body.get("messages") or []
+            prompt = body.get("prompt") or "\n\n".join(str(m.get("content", "")) for m in messages)
+            if not prompt:
+                # Ollama: запрос без промпта только загружает модель.
+                return self._json({"model": body.get("model"), "response": "", "done": True})
+            kind, text = canned_response(prompt, think_chars=settings.think_chars, tail_chars=settings.tail_chars)
+            think = None if openai else body.get("think")
+            if think is False:
+                text = split_thinking(text)[1]
+            text = apply_limits(text, body, openai=openai)
+            thinking, text = split_thinking(text) if think else ("", text)
+            stats.hit(kind)
+            if settings.error_rate and random.random() < settings.error_rate:
+                stats.add("errors", 1)
+                return self._json({"error": "mock failure"}, 500)
+
+            if gpu is not None:
+                gpu.acquire()
+            stats.add("active", 1)
+            try:
+                time.sleep(settings.ttft())
+                usage = (math.ceil(len(prompt) / 4), len(split_tokens(thinking)) + len(split_tokens(text)))
+                chat = self.path == "/api/chat"
+                if body.get("stream"):
+                    self._stream(text, thinking, usage, openai=openai, chat=chat)
+                else:
+                    time.sleep(settings.token_delay * usage[1])
+                    stats.add("generated", usage[1])
+                    self._json(self._final(text, thinking, usage, openai=openai, chat=chat))
+            finally:
+                stats.add("active", -1)
+                if gpu is not None:
+                    gpu.release()
+
+        def _final(self, text: str, thinking: str, usage: tuple[int, int], *, openai: bool, chat: bool) -> dict[str, Any]:
+            if openai:
+                return {
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": usage[0], "completion_tokens": usage[1]},
+                }
+            payload: dict[str, Any] = {"done": True, "prompt_eval_count": usage[0], "eval_count": usage[1]}
+            if chat:
+                payload["message"] = {"role": "assistant", "content": text}
+                if thinking:
+                    payload["message"]["thinking"] = thinking
+            else:
+                payload["response"] = text
+                if thinking:
+                    payload["thinking"] = thinking
+            return payload
+
+        def _stream(self, text: str, thinking: str, usage: tuple[int, int], *, openai: bool, chat: bool) -> None:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream" if openai else "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for piece in self._pieces(text, thinking, openai=openai, chat=chat):
+                    self._chunk(piece)
+                    stats.add("generated", 1)
+                    time.sleep(settings.token_delay)
+                if openai:
+                    last = {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                            "usage": {"prompt_tokens": usage[0], "completion_tokens": usage[1]}}
+                    self._chunk(f"data: {json.dumps(last)}\n\ndata: [DONE]\n\n")
+                else:
+                    final = {"done": True, "prompt_eval_count": usage[0], "eval_count": usage[1]}
+                    final.update({"message": {"role": "assistant", "content": ""}} if chat else {"response": ""})
+                    self._chunk(json.dumps(final) + "\n")
+                self._chunk("")
+            except (BrokenPipeError, ConnectionResetError):
+                # Клиент закрыл соединение (в том числе до финального чанка) — Ollama
+                # в этом случае прекращает генерацию.
+                stats.add("aborted", 1)
+                self.close_connection = True
+
+        def _pieces(self, text: str, thinking: str, *, openai: bool, chat: bool) -> Iterator[str]:
+            for token in split_tokens(thinking):
+                if chat:
+                    message = {"role": "assistant", "content": "", "thinking": token}
+                    yield json.dumps({"message": message, "done": False}, ensure_ascii=False) + "\n"
+                else:
+                    yield json.dumps({"response": "", "thinking": token, "done": False}, ensure_ascii=False) + "\n"
+            for token in split_tokens(text):
+                if openai:
+                    delta = {"choices": [{"index": 0, "delta": {"content": token}}]}
+                    yield f"data: {json.dumps(delta, ensure_ascii=False)}\n\n"
+                elif chat:
+                    yield json.dumps({"message": {"role": "assistant", "content": token}, "done": False},
+                                     ensure_ascii=False) + "\n"
+                else:
+                    yield json.dumps({"response": token, "done": False}, ensure_ascii=False) + "\n"
+
+        def _chunk(self, data: str) -> None:
+            raw = data.encode("utf-8")
+            self.wfile.write(f"{len(raw):x}\r\n".encode() + raw + b"\r\n")
+            self.wfile.flush()
+
+    return Handler
+
+
+class MockLLMServer:
+    """Заглушка в фоновом потоке (для bench/load.py --mock)."""
+
+    def __init__(self, settings: MockSettings, *, host: str = "127.0.0.1", port: int = 0,
+                 model: str = "deepseek-r1:8b"):
+        self.stats = _Stats()
+        self.httpd = ThreadingHTTPServer((host, port), make_handler(settings, self.stats))
+        self.httpd.daemon_threads = True
+        self.httpd.model_name = model
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="mock-llm", daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockLLMServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def add_mock_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--ttft", default="lognormal:-1.2,0.5",
+                        help="время до первого токена: fixed:S | uniform:A,B | lognormal:MU,SIGMA | exp:MEAN")
+    parser.add_argument("--tps", type=float, default=80, help="токенов в секунду (0 — мгновенно)")
+    parser.add_argument("--parallel", type=int, default=4, help="одновременных генераций (0 — без лимита)")
+    parser.add_argument("--think-chars", type=int, default=400, help="длина рассуждений в <think>")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов HTTP 500")
+    parser.add_argument("--tail-chars", type=int, default=0, help="болтовня после отчёта, символов")
+
+
+def settings_from_args(args: argparse.Namespace) -> MockSettings:
+    return MockSettings(
+        ttft=parse_distribution(args.ttft),
+        tps=args.tps,
+        parallel=args.parallel,
+        think_chars=args.think_chars,
+        error_rate=args.error_rate,
+        tail_chars=args.tail_chars,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11500)
+    parser.add_argument("--model", default="deepseek-r1:8b", help="имя модели в /api/tags")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    server = MockLLMServer(settings_from_args(args), host=args.host, port=args.port, model=args.model)
+    print(f"mock LLM: {server.url} (ttft={args.ttft}, tps={args.tps}, parallel={args.parallel})", flush=True)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+"""
+Корпус совместимости парсера ответов модели.
+
+Сравнивает sanitize_ai_text, parse_*_sections, split_life_batch и потоковый
+StreamingParser из main.py с эталоном — прежней реализацией на отдельных
+re.search по каждому заголовку (зафиксирована ниже как есть). Корпус:
+заготовки mock_llm с разной длиной <think>, ручные пограничные случаи и
+случайные склейки фрагментов с фиксированным seed.
+
+    python bench/parse_compat.py
+    python bench/parse_compat.py --seed 7 --random 20000
+
+Фиксированная часть корпуса прогоняется в tests/test_parse_compat.py.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import re
+import sys
+from typing import Any
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("VIORA_HEALTH_INTERVAL", "0")
+
+import main  # noqa: E402
+from mock_llm import canned_response, split_tokens  # noqa: E402
+
+
+# ── Эталон: прежняя реализация ────────────────────────────────────────────────
+_PREAMBLE_PHRASES = (
+    "как эксперт", "в качестве", "проанализировав",
+    "рассмотрев вариант", "после анализа", "исходя из",
+)
+_THINK_BLOCK_RE = re.compile(r"<think>.*?</think>", re.DOTALL | re.IGNORECASE)
+_SECTION_HEADERS_RE = re.compile(
+    r"^\s*("
+    r"ОПИСАНИЕ|ПЛЮСЫ?|МИНУСЫ?|РИСКИ?|РЕКОМЕНДАЦИИ|ОЦЕНКА|ВЕРДИКТ|"
+    r"СЛЕДУЮЩИЙ\s+КАДР|ВИЗУАЛЬНЫЕ\s+ЭЛЕМЕНТЫ|ЭМОЦИОНАЛЬНОЕ\s+ВОЗДЕЙСТВИЕ|"
+    r"КОМПОЗИЦИЯ|ЗВУК\s+И\s+РИТМ|ПЕРЕХОД|"
+    r"ЛУЧШИЙ\s+КАДР|ПОЧЕМУ\s+ЭТОТ\s+КАДР|АТМОСФЕРА|ДРАМАТУРГИЯ|"
+    r"СИЛЬНЫЕ\s+СТОРОНЫ|ВОЗМОЖНЫЕ\s+УЛУЧШЕНИЯ|СЛЕДУЮЩИЙ\s+ШАГ"
+    r")\b",
+    re.IGNORECASE,
+)
+
+
+def ref_sanitize(text: str, max_len: int = 4000) -> str:
+    if not text:
+        return ""
+    text = _THINK_BLOCK_RE.sub("", text)
+    text = text.replace("\r\n", "\n").replace("\r", "\n").strip()
+    cleaned_lines: list[str] = []
+    seen_section = False
+    for raw in text.split("\n"):
+        line = raw.strip()
+        if not line:
+            cleaned_lines.append("")
+            continue
+        if _SECTION_HEADERS_RE.match(line):
+            seen_section = True
+            cleaned_lines.append(line)
+            continue
+        if not seen_section:
+            low = line.lower()
+            if any(low.startswith(p) for p in _PREAMBLE_PHRASES):
+                continue
+        cleaned_lines.append(line)
+    cleaned = "\n".join(cleaned_lines).strip()
+    cleaned = re.sub(r"^[\-\*\•\d]+[\.\)\s]+", "", cleaned, flags=re.MULTILINE)
+    if len(cleaned) > max_len:
+        cleaned = cleaned[:max_len].rstrip() + "…"
+    return cleaned
+
+
+def _ref_split_items(raw: str, *, max_items: int = 6) -> list[str]:
+    items: list[str] = []
+    for line in raw.split("\n"):
+        line = re.sub(r"^[\-\*\•\d\.\)\s]+", "", line.strip()).strip()
+        if len(line) > 2:
+            items.append(line)
+    return items[:max_items]
+
+
+def _ref_parse_sections(text: str, headers: list[tuple[str, str, bool]]) -> dict[str, Any]:
+    normalized = (text or "").replace("\r\n", "\n").replace("\r", "\n").strip()
+    single_line_by_key = {key: single for key, _, single in headers}
+    positions: list[tuple[str, int, int, str]] = []
+    for key, pattern, _single_line in headers:
+        m = re.search(pattern, normalized, re.IGNORECASE | re.MULTILINE)
+        if m:
+            positions.append((key, m.start(), m.end(), m.group(1) if m.lastindex else ""))
+    positions.sort(key=lambda x: x[1])
+
+    description = ""
+    if positions:
+        description = normalized[: positions[0][1]].strip()
+    elif normalized:
+        description = normalized
+    description = re.sub(r"^ОПИСАНИЕ[:\s]*", "", description, flags=re.IGNORECASE).strip()
+    sections: dict[str, Any] = {}
+    for i, (key, _start, end, capture) in enumerate(positions):
+        next_start = positions[i + 1][1] if i + 1 < len(positions) else len(normalized)
+        body = normalized[end:next_start].strip()
+        if single_line_by_key.get(key):
+            sections[key] = (capture or body.split("\n")[0] or "").strip()
+        else:
+            raw = capture or body
+            if ";" in raw and "\n" not in raw.strip():
+                sections[key] = [p.strip() for p in raw.split(";") if p.strip()]
+            else:
+                sections[key] = _ref_split_items(body if not capture else capture + "\n" + body)
+    return {"description": description, **sections}
+
+
+_REF_LIFE_HEADERS = [
+    ("pros", r"^\s*ПЛЮСЫ?\s*:?\s*$", False),
+    ("cons", r"^\s*МИНУСЫ?\s*:?\s*$", False),
+    ("risks", r"^\s*РИСКИ?\s*:?\s*$", False),
+    ("recommendations", r"^\s*РЕКОМЕНДАЦИИ\s*:?\s*$", False),
+    ("rating", r"^\s*ОЦЕНКА\s*:\s*(.*)$", True),
+    ("verdict", r"^\s*ВЕРДИКТ\s*:\s*(.*)$", True),
+]
+_REF_ANALYZE_HEADERS = [
+    ("best_frame", r"^\s*ЛУЧШИЙ\s+КАДР:\s*(.*)$", True),
+    ("explanation", r"^\s*ПОЧЕМУ\s+ЭТОТ\s+КАДР:\s*(.*)$", True),
+    ("composition", r"^\s*КОМПОЗИЦИЯ:\s*(.*)$", False),
+    ("atmosphere", r"^\s*АТМОСФЕРА:\s*(.*)$", False),
+    ("dramaturgy", r"^\s*ДРАМАТУРГИЯ:\s*(.*)$", False),
+    ("strengths", r"^\s*СИЛЬНЫЕ\s+СТОРОНЫ:\s*(.*)$", False),
+    ("improvements", r"^\s*ВОЗМОЖНЫЕ\s+УЛУЧШЕНИЯ:\s*(.*)$", False),
+    ("next_steps", r"^\s*СЛЕДУЮЩИЙ\s+ШАГ:\s*(.*)$", False),
+    ("score", r"^\s*ОЦЕНКА:\s*(.*)$", True),
+    ("verdict", r"^\s*ВЕРДИКТ:\s*(.*)$", True),
+]
+
+
+def ref_parse_life(text: str) -> dict[str, Any]:
+    parsed = _ref_parse_sections(text, _REF_LIFE_HEADERS)
+    return {
+        "description": parsed.get("description", ""),
+        "pros": parsed.get("pros", []),
+        "cons": parsed.get("cons", []),
+        "risks": parsed.get("risks", []),
+        "recommendations": parsed.get("recommendations", []),
+        "rating": parsed.get("rating", ""),
+        "verdict": parsed.get("verdict", ""),
+    }
+
+
+def ref_parse_next_frame(text: str) -> dict[str, Any]:
+    def m(pattern: str) -> str:
+        x = re.search(pattern, text or "", re.IGNORECASE)
+        return x.group(1).strip() if x else ""
+
+    def items(raw: str) -> list[str]:
+        if not raw:
+            return []
+        return [p.strip() for p in re.split(r"[;\n]", raw) if p.strip()]
+
+    return {
+        "next_frame": m(r"СЛЕДУЮЩИЙ\s+КАДР:\s*([^\n]+)"),
+        "visual_elements": items(m(r"ВИЗУАЛЬНЫЕ\s+ЭЛЕМЕНТЫ:\s*([^\n]+)")),
+        "emotional_impact": items(m(r"ЭМОЦИОНАЛЬНОЕ\s+ВОЗДЕЙСТВИЕ:\s*([^\n]+)")),
+        "composition": items(m(r"КОМПОЗИЦИЯ:\s*([^\n]+)")),
+        "sound_rhythm": items(m(r"ЗВУК\s+И\s+РИТМ:\s*([^\n]+)")),
+        "transition": m(r"ПЕРЕХОД:\s*([^\n]+)"),
+    }
+
+
+def ref_parse_analyze(text: str) -> dict[str, Any]:
+    parsed = _ref_parse_sections(text, _REF_ANALYZE_HEADERS)
+    for key in ("composition", "atmosphere", "dramaturgy", "strengths", "improvements", "next_steps"):
+        val = parsed.get(key)
+        if isinstance(val, list) and len(val) == 1 and ";" in val[0]:
+            parsed[key] = [p.strip() for p in val[0].split(";") if p.strip()]
+    return {
+        "best_frame": parsed.get("best_frame", ""),
+        "explanation": parsed.get("explanation", ""),
+        "composition": parsed.get("composition", []),
+        "atmosphere": parsed.get("atmosphere", []),
+        "dramaturgy": parsed.get("dramaturgy", []),
+        "strengths": parsed.get("strengths", []),
+        "improvements": parsed.get("improvements", []),
+        "next_steps": parsed.get("next_steps", []),
+        "score": parsed.get("score", ""),
+        "verdict": parsed.get("verdict", ""),
+    }
+
+
+_REF_PARSERS = {
+    "life": (ref_parse_life, main.parse_life_sections),
+    "next_frame": (ref_parse_next_frame, main.parse_flow_next_frame_sections),
+    "analyze": (ref_parse_analyze, main.parse_flow_analyze_sections),
+}
+
+
+# ── Корпус ────────────────────────────────────────────────────────────────────
+_FRAGMENTS = [
+    "ОПИСАНИЕ Вариант", "ОПИСАНИЕ: x", "Как эксперт, скажу", "В качестве вывода", "Исходя из опыта",
+    "ПЛЮСЫ:", "ПЛЮС", "плюсы :", "ПЛЮСЫ: сразу текст", "МИНУСЫ:", "минусы", "РИСКИ:", "РЕКОМЕНДАЦИИ:",
+    "ОЦЕНКА: 7/10 — ок", "ОЦЕНКА:", "ОЦЕНКА :", "ВЕРДИКТ: Делать.", "ВЕРДИКТ:", "7/10",
+    "- пункт один", "* пункт два", "• три", "1. четыре", "2) пять", "1.", "5", "-", "—", ")", ".)x",
+    "1.5 кг", "2024 год", "a; b; c", "  отступ", "\tтаб",
+    "ЛУЧШИЙ КАДР: 2", "ЛУЧШИЙ  КАДР:", "ПОЧЕМУ ЭТОТ КАДР: потому", "КОМПОЗИЦИЯ: a; b", "КОМПОЗИЦИЯ:",
+    "АТМОСФЕРА: тон", "ДРАМАТУРГИЯ: д1; д2", "СИЛЬНЫЕ СТОРОНЫ: s", "ВОЗМОЖНЫЕ УЛУЧШЕНИЯ: u1; u2",
+    "СЛЕДУЮЩИЙ ШАГ: n", "ОЦЕНКА: 8/10", "СЛЕДУЮЩИЙ КАДР: крупный", "СЛЕДУЮЩИЙ КАДР:",
+    "ВИЗУАЛЬНЫЕ ЭЛЕМЕНТЫ: свет; тень", "ЭМОЦИОНАЛЬНОЕ ВОЗДЕЙСТВИЕ: грусть", "ЗВУК И РИТМ: тишина",
+    "ПЕРЕХОД: склейка", "текст ПЕРЕХОД: внутри", "обычная строка текста", "ok", "", "", "   ", "\t",
+    "<think>размышление\nмногострочное</think>", "<think>", "</think>", "<THINK>x</Think>",
+    "в заключение", "в итоге всё", "x\r", "\r", "\x0cПЛЮСЫ", " ", "ИСХОД 2", "### ИСХОД 1",
+]
+_SEPARATORS = ["\n", "\n", "\n", "\r\n", "\n\n", " ", "\r", "\n  \n"]
+
+_EDGE_CASES = [
+    "",
+    "   \n\n  ",
+    "ПЛЮСЫ:\n- a\nМИНУСЫ:\n- b",
+    "ОЦЕНКА:\nВЕРДИКТ: x",
+    "ОЦЕНКА:\n\n\nВЕРДИКТ:\n",
+    "описание\n\n  ПЛЮСЫ:\n\n  - один\n\nПЛЮСЫ:\n- дубль",
+    "ПЛЮСЫ: не заголовок\nПЛЮСЫ\n- настоящий",
+    "СЛЕДУЮЩИЙ КАДР: КОМПОЗИЦИЯ: x; y",
+    "КОМПОЗИЦИЯ:   ",
+    "КОМПОЗИЦИЯ:\n\nпозже; потом\nКОМПОЗИЦИЯ: второе",
+    "ЛУЧШИЙ КАДР:\nПОЧЕМУ ЭТОТ КАДР:\nКОМПОЗИЦИЯ: a; b\nОЦЕНКА: 5",
+    "<think>ПЛЮСЫ:\n- из размышлений</think>ПЛЮСЫ:\n- после",
+    "<think>незакрытый\nПЛЮСЫ:\n- a",
+    "1.\n\n2)\nПЛЮСЫ:\n-\n\n- a",
+    "Как эксперт, отмечу\nВ качестве итога\nПЛЮСЫ:\nКак эксперт — уже не преамбула",
+]
+
+
+def random_text(rng: random.Random) -> str:
+    n = rng.randint(0, 25)
+    parts = [rng.choice(_FRAGMENTS) for _ in range(n)]
+    seps = [rng.choice(_SEPARATORS) for _ in range(n)]
+    return "".join(p + s for p, s in zip(parts, seps)) + rng.choice(["", "\n", "  \n\n", "хвост"])
+
+
+def canned_corpus() -> list[str]:
+    prompts = [
+        main.build_prompt_pros_cons("Сменить работу", "Уйти во фриланс"),
+        main.build_prompt_next_frame("Сцена", "Герой стоит у окна"),
+        main.build_prompt_analyze_frames("Сцена", ["Общий план", "Крупный план"]),
+        main.build_prompt_pros_cons_batch("Сменить работу", [f"Вариант {k}" for k in range(1, 16)]),
+    ]
+    return [canned_response(p, think_chars=n)[1] for p in prompts for n in (0, 400, 4000)]
+
+
+# ── Проверка ──────────────────────────────────────────────────────────────────
+class Report:
+    def __init__(self):
+        self.checked = 0
+        self.mismatches: list[str] = []
+
+    def expect(self, what: str, text: str, got: Any, want: Any) -> None:
+        self.checked += 1
+        if got != want and len(self.mismatches) < 20:
+            self.mismatches.append(f"{what}: {text[:200]!r}\n    got:  {got!r}\n    want: {want!r}")
+        elif got != want:
+            self.mismatches.append(what)
+
+
+def check(report: Report, text: str, rng: random.Random, max_len: int = 4000) -> None:
+    clean = ref_sanitize(text, max_len=max_len)
+    report.expect(f"sanitize[{max_len}]", text, main.sanitize_ai_text(text, max_len=max_len), clean)
+    for kind, (ref, new) in _REF_PARSERS.items():
+        want = ref(clean)
+        report.expect(f"parse/{kind}", clean, new(clean), want)
+        report.expect(f"parse_raw/{kind}", text, new(text), ref(text))
+
+        parser = main.StreamingParser(kind, max_len=max_len)
+        pos = 0
+        while pos < len(text):
+            step = rng.randint(1, 12)
+            parser.feed(text[pos:pos + step])
+            pos += step
+        got_text, got, _ = parser.finish()
+        report.expect(f"stream_text/{kind}", text, got_text, clean)
+        report.expect(f"stream/{kind}", text, got, want)
+
+
+def check_batch(report: Report, text: str, count: int) -> None:
+    want = []
+    marks = list(main._LIFE_BATCH_MARKER_RE.finditer(text))
+    blocks: dict[int, str] = {}
+    for m, nxt in zip(marks, marks[1:] + [None]):
+        idx = int(m.group(1))
+        if 1 <= idx <= count and idx not in blocks:
+            blocks[idx] = text[m.end():nxt.start() if nxt else len(text)]
+    for idx in range(1, count + 1):
+        block = ref_sanitize(blocks.get(idx, ""))
+        sections = ref_parse_life(block)
+        want.append((block, sections) if sections["pros"] and sections["cons"] else None)
+    report.expect(f"split_batch/{count}", text, main.split_life_batch(text, count), want)
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--random", type=int, default=3000, help="число случайных текстов")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    report = Report()
+    for text in _EDGE_CASES + canned_corpus():
+        for max_len in (4000, 120, 60):
+            check(report, text, rng, max_len=max_len)
+        check(report, "".join(split_tokens(text)), rng)
+        check_batch(report, text, 15)
+    for _ in range(args.random):
+        text = random_text(rng)
+        check(report, text, rng, max_len=rng.choice([4000, 4000, 120, 60]))
+        check_batch(report, text, 3)
+
+    print(f"проверок: {report.checked}, расхождений: {len(report.mismatches)}")
+    for line in report.mismatches[:20]:
+        print("  " + line)
+    if report.mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    run()
@@ -6,27 +6,132 @@ Viora — Flask-бэкенд: дерево решений и сценарный
 - mistral — облачный Mistral API (OpenAI-совместимый /v1/chat/completions)
 
 См. .env.example
-- Параллельная обработка исходов в /run-ai-life через ThreadPoolExecutor.
-- Streaming-эндпоинты (Server-Sent Events) для прогресса в реальном времени.
+- Параллельная обработка исходов в /run-ai-life: общий планировщик с лимитом
+  на провайдера, честной очередью по клиентам и 429 при переполнении.
+- Пакетный режим /run-ai-life ({"batch": true} или VIORA_LIFE_BATCH=1): несколько
+  исходов в одном промпте, битые блоки переспрашиваются по одному.
+- Streaming-эндпоинты (Server-Sent Events) для прогресса в реальном времени:
+  токены по мере генерации и секции по мере их завершения.
 - Ретраи с экспоненциальной задержкой при ошибках Ollama.
-- /healthz — health-check и сводка по модели.
+- Ollama: keep_alive и предзагрузка модели, options (temperature, num_ctx,
+  num_predict), общий неизменный префикс промптов для переиспользования
+  KV-кэша; VIORA_OLLAMA_API=chat — /api/chat с system-сообщением.
+- Общий keep-alive пул HTTP-соединений на провайдера (HTTP/2 для Mistral опционально).
+- Адаптивный лимит одновременных генераций на хост (AIMD): таймауты, 429/503
+  и медленные ответы снижают его, успешные ответы под нагрузкой — поднимают
+  (VIORA_ADAPTIVE_CONCURRENCY, VIORA_ADAPTIVE_MAX, VIORA_ADAPTIVE_LATENCY).
+- Лимит запросов на клиента (VIORA_RATE_LIMIT оценочных токенов в минуту, запас
+  VIORA_RATE_BURST): token bucket, стоимость — токены промптов и ответов; при
+  VIORA_RATE_PATH бюджеты общие для воркеров; сверх лимита — 429 с Retry-After.
+- Кэш ответов ИИ: LRU в памяти + опциональный SQLite-файл, общий для воркеров;
+  {"no_cache": true} в запросе — свежий ответ (страница flow шлёт его при
+  повторной генерации следующего кадра: ответ с temperature 0.8 — другой вариант).
+- Single-flight: одинаковые одновременные запросы к модели склеиваются в один.
+- Несколько хостов Ollama (OLLAMA_URLS): балансировка по наименьшему числу
+  запросов в работе, circuit breaker и фоновый health-check на хост, ретраи
+  с джиттером на другой хост, хеджирование медленных ответов, опциональный
+  Mistral как overflow (VIORA_MISTRAL_OVERFLOW=1).
+- ASGI-режим (uvicorn main:asgi_app): LLM-маршруты на asyncio и httpx,
+  ожидание модели и SSE не держат потоков; остальное отдаёт Flask.
+- /metrics — метрики в формате Prometheus: задержки маршрутов, очереди,
+  модели (TTFT и полное время), разбора ответа; ретраи, таймауты, кэш, токены.
+  С VIORA_METRICS_DIR — сумма по всем воркерам gunicorn, а не по одному.
+- Фоновые задачи POST /jobs/life: сразу job_id, результаты исходов копятся в журнале
+  (SQLite-файл instance/viora_jobs.db, общий для воркеров; другой путь —
+  VIORA_JOBS_PATH, :memory: — в памяти процесса); опрос GET /jobs/<id>, SSE
+  GET /jobs/<id>/events с возобновлением по Last-Event-ID, отмена DELETE /jobs/<id>,
+  очистка по VIORA_JOB_TTL.
+- Инкрементальный анализ life: вместо outcomes можно прислать дерево nodes
+  с id узлов (вложенные исходы анализируются с контекстом ветки) и hash из
+  прошлого ответа — неизменённые и закэшированные исходы не генерируются заново.
+- Map-reduce в /run-ai-flow-analyze-frames для больших наборов кадров (по
+  умолчанию выключен: VIORA_FLOW_MAP_MIN=N — от N кадров, или {"map_reduce": true}
+  в запросе): куски по VIORA_FLOW_MAP_CHUNK кадров оцениваются параллельно,
+  финальное сравнение — только VIORA_FLOW_SHORTLIST лучших; ответ той же формы
+  плюс сводка map_reduce.
+- Спекулятивный следующий кадр (VIORA_PREFETCH=1): страница flow присылает
+  последний отредактированный кадр на /run-ai-flow-next-frame/prefetch, ответ
+  готовится с низшим приоритетом только на свободный слот (уступает его живым
+  запросам), отменяется при правке кадра и отдаётся по клику сразу
+  (живёт VIORA_PREFETCH_TTL секунд).
+- Бюджет ответа: num_predict / max_tokens по виду промпта (VIORA_OUTPUT_TOKENS,
+  запас VIORA_THINK_TOKENS на <think> у рассуждающих моделей), стоп-строки против
+  болтовни после формата (VIORA_STOP_SEQUENCES) и ранняя остановка: генерация
+  обрывается, как только дописана строка ВЕРДИКТ/ПЕРЕХОД (VIORA_EARLY_STOP).
+- Рассуждение по видам промптов (VIORA_REASONING="next_frame=off,life=1024,analyze=full"):
+  off — think: false, число — лимит токенов (дошли до лимита — повтор без
+  рассуждения), full — без лимита. Рассуждение Ollama читается из поля thinking,
+  а не из текста; потраченные токены — viora_llm_reasoning_tokens_total{kind}.
+- Маршрутизация моделей: своя модель (и провайдер) на вид промпта
+  (VIORA_MODEL_ROUTES="score_frames=qwen2.5:3b,life=mistral:mistral-large-latest")
+  и каскад (VIORA_CASCADE): сначала отвечает быстрая модель, основная вызывается,
+  только если в ответе нет обязательных секций. Стрим при эскалации шлёт событие
+  reset; счётчик viora_llm_cascade_total{kind,outcome}.
+- Отмена при уходе клиента: закрытое соединение (во Flask-режиме — фоновая проверка
+  сокета, в ASGI — http.disconnect) снимает запрос с очереди и обрывает запрос
+  к модели, ретраи не запускаются (VIORA_CANCEL_ON_DISCONNECT=0 — выключить).
+- Статика через /assets/: минифицированные JS/CSS с хэшем содержимого в имени,
+  заранее сжатые gzip/brotli-варианты, immutable-кэш и ETag/304 (VIORA_ASSETS=0 —
+  прежние /static/); python main.py build-assets [DIR] — сборка для nginx/CDN.
+- /healthz — сводка по модели из фонового опроса (VIORA_HEALTH_INTERVAL) с возрастом
+  снимка; /livez — дешёвая liveness-проба, /readyz — readiness (модель доступна,
+  очередь не переполнена).
 - Чистые промпты без капслока (LLM лучше отвечают на спокойные инструкции).
 - Логирование вместо print().
 - Аккуратная обработка таймаутов, CORS, JSON-валидация.
 """
 from __future__ import annotations
 
+import asyncio
+import atexit
+import bisect
+import functools
+import gzip
+import hashlib
 import json
 import logging
 import os
+import random
 import re
+import secrets
+import socket
+import sqlite3
+import sys
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import OrderedDict
+from contextlib import aclosing, asynccontextmanager, closing, contextmanager, nullcontext
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from itertools import chain
+from queue import Queue
 from dataclasses import dataclass
-from typing import Any, Generator
+from typing import Any, AsyncGenerator, Generator
+from urllib.parse import parse_qsl, urlsplit
 
 import requests
-from flask import Flask, Response, jsonify, render_template, request, stream_with_context
+from flask import Flask, Response, g, jsonify, render_template, request, stream_with_context
+from requests.adapters import HTTPAdapter
+from werkzeug.datastructures import Headers
+
+try:  # межпроцессные блокировки single-flight (только POSIX)
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:  # HTTP/2 для Mistral и ASGI-режим — опционально (pip install "httpx[http2]")
+    import httpx
+except ImportError:
+    httpx = None
+
+try:  # ASGI-режим: не-LLM маршруты отдаются Flask через мост WSGI→ASGI
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    WsgiToAsgi = None
+
+try:  # brotli-варианты статики — опционально (pip install brotli)
+    import brotli
+except ImportError:
+    brotli = None
 
 # ── Конфигурация ──────────────────────────────────────────────────────────────
 def _normalize_llm_provider(raw: str) -> str:
@@ -36,17 +141,77 @@ def _normalize_llm_provider(raw: str) -> str:
     return "ollama"
 
 
+@dataclass(frozen=True)
+class ModelRoute:
+    """Провайдер и модель для вида промпта (VIORA_MODEL_ROUTES, VIORA_CASCADE)."""
+    provider: str
+    model: str
+
+    def model_for(self, provider: str) -> str:
+        """Модель на хосте провайдера: Mistral-overflow отвечает своей MISTRAL_MODEL."""
+        if provider == self.provider:
+            return self.model
+        return CFG.mistral_model if provider == "mistral" else CFG.ollama_model
+
+
 @dataclass(frozen=True)
 class Config:
     llm_provider: str
     ollama_url: str
+    ollama_urls: tuple[str, ...]
     ollama_model: str
+    ollama_api: str
+    ollama_keep_alive: str
+    ollama_num_ctx: int
+    ollama_num_predict: int
+    ollama_preload: bool
+    output_tokens: dict[str, int]
+    think_tokens: int
+    reasoning: dict[str, int]
+    stop_sequences: bool
+    early_stop: bool
+    model_routes: dict[str, ModelRoute]
+    cascade: dict[str, ModelRoute]
     mistral_api_key: str
     mistral_base_url: str
     mistral_model: str
+    mistral_overflow: bool
     request_timeout: int
+    connect_timeout: float
+    mistral_http2: bool
     max_workers: int
     max_retries: int
+    cache_ttl: int
+    cache_max_bytes: int
+    cache_path: str
+    singleflight_dir: str
+    singleflight_wait: float
+    metrics_dir: str
+    jobs_path: str
+    job_ttl: int
+    ollama_concurrency: int
+    mistral_concurrency: int
+    queue_limit: int
+    adaptive_concurrency: bool
+    adaptive_max: int
+    adaptive_latency: float
+    rate_limit: int
+    rate_burst: int
+    rate_path: str
+    trust_proxy: bool
+    breaker_failures: int
+    breaker_cooldown: float
+    health_interval: float
+    hedge_after: float
+    cancel_on_disconnect: bool
+    life_batch: bool
+    life_batch_size: int
+    flow_map_min: int
+    flow_map_chunk: int
+    flow_shortlist: int
+    prefetch: bool
+    prefetch_ttl: float
+    assets: bool
     port: int
     debug: bool
     cors_origin: str
@@ -55,18 +220,148 @@ class Config:
         return self.mistral_model if self.llm_provider == "mistral" else self.ollama_model
 
 
+# Лимит токенов видимого ответа по видам промптов (prompt_kind); life_batch и
+# score_frames — на один исход или кадр. Запас на <think> добавляет output_budget.
+_OUTPUT_TOKENS = {"life": 1400, "life_batch": 1200, "next_frame": 700, "analyze": 1400, "score_frames": 80}
+
+# Рассуждение рассуждающих моделей по видам промптов: 0 — выключено (think: false),
+# -1 — без лимита, N — не больше N токенов. Следующему кадру и оценке кадров
+# рассуждение почти ничего не даёт, а стоит большую часть времени генерации.
+_REASONING = {"life": -1, "life_batch": -1, "next_frame": 0, "analyze": -1, "score_frames": 0}
+
+
+def _parse_urls(raw: str) -> tuple[str, ...]:
+    return tuple(u.strip().rstrip("/") for u in raw.split(",") if u.strip())
+
+
+def _parse_hedge_after(raw: str) -> float:
+    """VIORA_HEDGE_AFTER: секунды до дублирующего запроса, auto — p95 бэкенда, 0 — выкл."""
+    value = (raw or "").strip().lower()
+    if value == "auto":
+        return -1.0
+    return max(float(value or 0), 0.0)
+
+
+def _parse_output_tokens(raw: str) -> dict[str, int]:
+    """VIORA_OUTPUT_TOKENS: «life=1400,next_frame=700» поверх умолчаний, 0 — без лимитов."""
+    value = (raw or "").strip()
+    if value in ("0", "off"):
+        return {}
+    budgets = dict(_OUTPUT_TOKENS)
+    for item in value.split(","):
+        kind, _, tokens = item.partition("=")
+        if kind.strip() in budgets and tokens.strip():
+            budgets[kind.strip()] = max(int(tokens), 0)
+    return budgets
+
+
+def _parse_reasoning(raw: str) -> dict[str, int]:
+    """VIORA_REASONING: «next_frame=off,life=1024,analyze=full» поверх умолчаний.
+
+    off — без рассуждения, full — без лимита, число — лимит токенов рассуждения.
+    0 — не управлять: think не передаётся, рассуждение приходит в тексте (<think>).
+    """
+    value = (raw or "").strip().lower()
+    if value == "0":
+        return {}
+    modes = dict(_REASONING)
+    for item in value.split(","):
+        kind, _, mode = (part.strip() for part in item.partition("="))
+        if kind not in modes or not mode:
+            continue
+        modes[kind] = 0 if mode == "off" else -1 if mode == "full" else max(int(mode), 0)
+    return modes
+
+
+def _parse_model_routes(raw: str, provider: str) -> dict[str, ModelRoute]:
+    """«next_frame=qwen2.5:3b,analyze=mistral:mistral-small-latest»: вид промпта → модель.
+
+    Префикс ollama:/mistral: выбирает провайдера, без него — VIORA_LLM_PROVIDER.
+    """
+    routes: dict[str, ModelRoute] = {}
+    for item in (raw or "").split(","):
+        kind, _, spec = (part.strip() for part in item.partition("="))
+        if kind not in _OUTPUT_TOKENS or not spec:
+            continue
+        route_provider, _, model = spec.partition(":")
+        if route_provider in ("ollama", "mistral") and model:
+            routes[kind] = ModelRoute(route_provider, model)
+        else:
+            routes[kind] = ModelRoute(provider, spec)
+    return routes
+
+
+def _jobs_path(raw: str) -> str:
+    """Журнал задач по умолчанию — файл в instance-каталоге: задачу, созданную в одном
+    воркере gunicorn, опрашивают через другой. ":memory:" — журнал в памяти процесса."""
+    if raw == ":memory:":
+        return ""
+    return raw or os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance", "viora_jobs.db")
+
+
 def load_config() -> Config:
     provider = _normalize_llm_provider(os.environ.get("VIORA_LLM_PROVIDER", "ollama"))
+    # OLLAMA_URLS — несколько хостов через запятую; без неё — один OLLAMA_URL.
+    ollama_urls = _parse_urls(os.environ.get("OLLAMA_URLS", "")) or (
+        os.environ.get("OLLAMA_URL", "http://localhost:11434").rstrip("/"),
+    )
     return Config(
         llm_provider=provider,
-        ollama_url=os.environ.get("OLLAMA_URL", "http://localhost:11434").rstrip("/"),
+        ollama_url=ollama_urls[0],
+        ollama_urls=ollama_urls,
         ollama_model=os.environ.get("VIORA_MODEL", os.environ.get("OLLAMA_MODEL", "deepseek-r1:8b")),
+        ollama_api="chat" if os.environ.get("VIORA_OLLAMA_API", "generate").strip().lower() == "chat" else "generate",
+        ollama_keep_alive=os.environ.get("VIORA_OLLAMA_KEEP_ALIVE", "30m").strip(),
+        ollama_num_ctx=int(os.environ.get("VIORA_OLLAMA_NUM_CTX", "0")),
+        ollama_num_predict=int(os.environ.get("VIORA_OLLAMA_NUM_PREDICT", "0")),
+        ollama_preload=os.environ.get("VIORA_OLLAMA_PRELOAD", "1") == "1",
+        output_tokens=_parse_output_tokens(os.environ.get("VIORA_OUTPUT_TOKENS", "")),
+        think_tokens=int(os.environ.get("VIORA_THINK_TOKENS", "-1")),
+        reasoning=_parse_reasoning(os.environ.get("VIORA_REASONING", "")),
+        stop_sequences=os.environ.get("VIORA_STOP_SEQUENCES", "1") == "1",
+        early_stop=os.environ.get("VIORA_EARLY_STOP", "1") == "1",
+        model_routes=_parse_model_routes(os.environ.get("VIORA_MODEL_ROUTES", ""), provider),
+        cascade=_parse_model_routes(os.environ.get("VIORA_CASCADE", ""), provider),
         mistral_api_key=os.environ.get("MISTRAL_API_KEY", "").strip(),
         mistral_base_url=os.environ.get("MISTRAL_API_URL", "https://api.mistral.ai/v1").rstrip("/"),
         mistral_model=os.environ.get("MISTRAL_MODEL", "mistral-small-latest"),
+        mistral_overflow=os.environ.get("VIORA_MISTRAL_OVERFLOW", "0") == "1",
         request_timeout=int(os.environ.get("VIORA_TIMEOUT", "90")),
+        connect_timeout=float(os.environ.get("VIORA_CONNECT_TIMEOUT", "5")),
+        mistral_http2=os.environ.get("VIORA_MISTRAL_HTTP2", "0") == "1",
         max_workers=int(os.environ.get("VIORA_MAX_WORKERS", "4")),
         max_retries=int(os.environ.get("VIORA_MAX_RETRIES", "2")),
+        cache_ttl=int(os.environ.get("VIORA_CACHE_TTL", "3600")),
+        cache_max_bytes=int(float(os.environ.get("VIORA_CACHE_MAX_MB", "64")) * 1024 * 1024),
+        cache_path=os.environ.get("VIORA_CACHE_PATH", "").strip(),
+        singleflight_dir=os.environ.get("VIORA_SINGLEFLIGHT_DIR", "").strip(),
+        singleflight_wait=float(os.environ.get("VIORA_SINGLEFLIGHT_WAIT", os.environ.get("VIORA_TIMEOUT", "90"))),
+        metrics_dir=os.environ.get("VIORA_METRICS_DIR", "").strip(),
+        jobs_path=_jobs_path(os.environ.get("VIORA_JOBS_PATH", "").strip()),
+        job_ttl=int(os.environ.get("VIORA_JOB_TTL", "3600")),
+        ollama_concurrency=int(os.environ.get("VIORA_OLLAMA_CONCURRENCY", os.environ.get("VIORA_MAX_WORKERS", "4"))),
+        mistral_concurrency=int(os.environ.get("VIORA_MISTRAL_CONCURRENCY", os.environ.get("VIORA_MAX_WORKERS", "4"))),
+        queue_limit=int(os.environ.get("VIORA_QUEUE_LIMIT", "64")),
+        adaptive_concurrency=os.environ.get("VIORA_ADAPTIVE_CONCURRENCY", "1") == "1",
+        adaptive_max=int(os.environ.get("VIORA_ADAPTIVE_MAX", "0")),
+        adaptive_latency=float(os.environ.get("VIORA_ADAPTIVE_LATENCY", "0")),
+        rate_limit=int(os.environ.get("VIORA_RATE_LIMIT", "0")),
+        rate_burst=int(os.environ.get("VIORA_RATE_BURST", "0")),
+        rate_path=os.environ.get("VIORA_RATE_PATH", "").strip(),
+        trust_proxy=os.environ.get("VIORA_TRUST_PROXY", "0") == "1",
+        breaker_failures=max(int(os.environ.get("VIORA_BREAKER_FAILURES", "5")), 1),
+        breaker_cooldown=float(os.environ.get("VIORA_BREAKER_COOLDOWN", "30")),
+        health_interval=float(os.environ.get("VIORA_HEALTH_INTERVAL", "15")),
+        hedge_after=_parse_hedge_after(os.environ.get("VIORA_HEDGE_AFTER", "auto")),
+        cancel_on_disconnect=os.environ.get("VIORA_CANCEL_ON_DISCONNECT", "1") == "1",
+        life_batch=os.environ.get("VIORA_LIFE_BATCH", "0") == "1",
+        life_batch_size=int(os.environ.get("VIORA_LIFE_BATCH_SIZE", "5")),
+        flow_map_min=int(os.environ.get("VIORA_FLOW_MAP_MIN", "0")),
+        flow_map_chunk=max(int(os.environ.get("VIORA_FLOW_MAP_CHUNK", "5")), 1),
+        flow_shortlist=max(int(os.environ.get("VIORA_FLOW_SHORTLIST", "4")), 2),
+        prefetch=os.environ.get("VIORA_PREFETCH", "0") == "1",
+        prefetch_ttl=float(os.environ.get("VIORA_PREFETCH_TTL", "120")),
+        assets=os.environ.get("VIORA_ASSETS", "1") == "1",
         port=int(os.environ.get("PORT", "5001")),
         debug=os.environ.get("FLASK_DEBUG", "0") == "1",
         cors_origin=os.environ.get("CORS_ORIGIN", "*"),
@@ -80,6 +375,7 @@ logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(name)s — %(message)s",
 )
 log = logging.getLogger("viora")
+logging.getLogger("httpx").setLevel(logging.WARNING)  # не логировать каждый запрос к модели
 
 app = Flask(__name__)
 
@@ -88,107 +384,526 @@ app = Flask(__name__)
 @app.after_request
 def add_cors(resp: Response) -> Response:
     resp.headers["Access-Control-Allow-Origin"] = CFG.cors_origin
-    resp.headers["Access-Control-Allow-Headers"] = "Content-Type"
-    resp.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
+    resp.headers["Access-Control-Allow-Headers"] = "Content-Type, Last-Event-ID"
+    resp.headers["Access-Control-Allow-Methods"] = "GET, POST, DELETE, OPTIONS"
+    return resp
+
+
+# ── Метрики (текстовый формат Prometheus) ─────────────────────────────────────
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+_PARSE_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+
+def _metric_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _metric_labels(labels: dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """Монотонный счётчик с метками."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list[tuple[str, dict[str, Any], float]]:
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, dict(zip(self.labels, key)), value) for key, value in items]
+
+
+class Histogram:
+    """Гистограмма с фиксированными бакетами (le — включительно, как в Prometheus)."""
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help_text: str, labels: tuple[str, ...] = (), *, buckets: tuple[float, ...] = _LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # На набор меток: [отсчёты по бакетам..., отсчёты выше последнего, сумма].
+        self._values: dict[tuple[str, ...], list[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * (len(self.buckets) + 2)
+            row[idx] += 1
+            row[-1] += value
+
+    @contextmanager
+    def time(self, **labels: Any):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> list[tuple[str, dict[str, Any], float]]:
+        with self._lock:
+            items = [(key, list(row)) for key, row in self._values.items()]
+        result = []
+        for key, row in items:
+            labels = dict(zip(self.labels, key))
+            total = 0
+            for bound, n in zip(self.buckets + (float("inf"),), row):
+                total += n
+                result.append((f"{self.name}_bucket", {**labels, "le": _metric_value(bound)}, total))
+            result.append((f"{self.name}_sum", labels, row[-1]))
+            result.append((f"{self.name}_count", labels, total))
+        return result
+
+
+class MetricsRegistry:
+    """Метрики процесса для /metrics.
+
+    Счётчики и гистограммы обновляются по ходу запросов; коллекторы снимают
+    текущее состояние (кэш, планировщик, бэкенды) в момент запроса метрик.
+    Воркеры gunicorn слушают один порт, и скрейп попадает в случайный из них,
+    поэтому без общего каталога /metrics показывает только один процесс.
+    С VIORA_METRICS_DIR каждый воркер раз в FLUSH_INTERVAL (и на каждом
+    /metrics) пишет снимок в metrics-<pid>.json, а /metrics складывает снимки:
+    счётчики и гистограммы суммируются, в том числе от завершившихся воркеров,
+    гейджи берутся только у живых с меткой pid. Каталог — на одном хосте с
+    воркерами; очищать его при старте сервиса (как PROMETHEUS_MULTIPROC_DIR).
+    """
+
+    FLUSH_INTERVAL = 5.0
+
+    def __init__(self, shared_dir: str = ""):
+        self.shared_dir = shared_dir
+        if shared_dir:
+            os.makedirs(shared_dir, exist_ok=True)
+        self._metrics: list[Counter | Histogram] = []
+        self._collectors: list[Any] = []
+        self._lock = threading.Lock()
+        self._pid: int | None = None
+
+    def counter(self, name: str, help_text: str, labels: tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labels: tuple[str, ...] = (), **kwargs: Any) -> Histogram:
+        metric = Histogram(name, help_text, labels, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        """fn() → [(имя, тип, описание, [(метки, значение), ...]), ...]."""
+        self._collectors.append(fn)
+        return fn
+
+    def families(self) -> list[tuple[str, str, str, list[tuple[str, dict[str, Any], float]]]]:
+        """Метрики этого процесса: [(имя, тип, описание, [(имя отсчёта, метки, значение), ...]), ...]."""
+        result = [(metric.name, metric.kind, metric.help, metric.samples()) for metric in self._metrics]
+        for fn in self._collectors:
+            try:
+                families = fn()
+            except Exception:
+                log.exception("metrics collector %s failed", getattr(fn, "__name__", fn))
+                continue
+            for name, kind, help_text, values in families:
+                result.append((name, kind, help_text, [(name, labels, value) for labels, value in values]))
+        return result
+
+    def ensure_running(self) -> None:
+        """Поток сброса снимков на процесс (ленивый старт, fork-safe)."""
+        pid = os.getpid()
+        if not self.shared_dir or self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+        threading.Thread(target=self._loop, name="viora-metrics", daemon=True).start()
+        atexit.register(self.flush)
+
+    def _loop(self) -> None:
+        while True:
+            time.sleep(self.FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception:
+                log.exception("metrics flush failed")
+
+    def flush(self) -> None:
+        """Снимок метрик процесса → <shared_dir>/metrics-<pid>.json (атомарной заменой файла)."""
+        pid = os.getpid()
+        path = os.path.join(self.shared_dir, f"metrics-{pid}.json")
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"pid": pid, "families": self.families()}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def _snapshots(self) -> list[dict[str, Any]]:
+        snapshots = []
+        for entry in sorted(os.scandir(self.shared_dir), key=lambda e: e.name):
+            if not (entry.name.startswith("metrics-") and entry.name.endswith(".json")):
+                continue
+            try:
+                with open(entry.path, encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                log.warning("metrics: пропускаю повреждённый снимок %s", entry.path)
+        return snapshots
+
+    def _merged(self) -> list[tuple[str, str, str, list[tuple[str, dict[str, Any], float]]]]:
+        self.flush()
+        merged: dict[str, tuple[str, str, dict[tuple, tuple[str, dict[str, Any], float]]]] = {}
+        for snapshot in self._snapshots():
+            pid = snapshot["pid"]
+            alive = _pid_alive(pid)
+            for name, kind, help_text, samples in snapshot["families"]:
+                family = merged.setdefault(name, (kind, help_text, {}))[2]
+                if kind == "gauge":
+                    if not alive:
+                        continue
+                    samples = [(sample_name, {**labels, "pid": pid}, value) for sample_name, labels, value in samples]
+                for sample_name, labels, value in samples:
+                    key = (sample_name, tuple(labels.items()))
+                    prev = family.get(key)
+                    family[key] = (sample_name, labels, value + (prev[2] if prev else 0))
+        return [(name, kind, help_text, list(samples.values())) for name, (kind, help_text, samples) in merged.items()]
+
+    def render(self) -> str:
+        lines: list[str] = []
+        families = self._merged() if self.shared_dir else self.families()
+        for name, kind, help_text, samples in families:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in samples:
+                lines.append(f"{sample_name}{_metric_labels(labels)} {_metric_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def timed(histogram: Histogram, **labels: Any):
+    """Декоратор: время вызова функции → histogram."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, **labels)
+        return inner
+    return wrap
+
+
+METRICS = MetricsRegistry(CFG.metrics_dir)
+HTTP_SECONDS = METRICS.histogram(
+    "viora_http_request_duration_seconds",
+    "Время HTTP-запроса от входа до конца ответа (у SSE — до конца потока)",
+    ("route", "method", "status"),
+)
+QUEUE_WAIT_SECONDS = METRICS.histogram(
+    "viora_queue_wait_seconds", "Ожидание слота планировщика провайдера", ("provider",),
+)
+LLM_TTFT_SECONDS = METRICS.histogram(
+    "viora_llm_time_to_first_token_seconds", "Время до первого токена стрима модели", ("backend",),
+)
+LLM_GENERATION_SECONDS = METRICS.histogram(
+    "viora_llm_generation_seconds", "Полное время успешного ответа модели", ("backend", "mode"),
+)
+PARSE_SECONDS = METRICS.histogram(
+    "viora_parse_seconds", "Очистка и разбор ответа модели", ("stage",), buckets=_PARSE_BUCKETS,
+)
+LLM_RETRIES = METRICS.counter("viora_llm_retries_total", "Повторные попытки запроса к модели", ("provider",))
+LLM_TIMEOUTS = METRICS.counter("viora_llm_timeouts_total", "Таймауты запросов к модели", ("provider",))
+CLIENT_DISCONNECTS = METRICS.counter(
+    "viora_client_disconnects_total", "Клиент ушёл до конца ответа — работа по запросу отменена", ("route",),
+)
+LLM_EARLY_STOPS = METRICS.counter(
+    "viora_llm_early_stops_total", "Генерации, оборванные после строки последней секции ответа", ("kind",),
+)
+LLM_REASONING_TOKENS = METRICS.counter(
+    "viora_llm_reasoning_tokens_total",
+    "Токены рассуждения (поле thinking; в потоке — по чанкам, без потока — оценка по длине)", ("kind",),
+)
+LLM_REASONING_CUTS = METRICS.counter(
+    "viora_llm_reasoning_cuts_total",
+    "Рассуждение упёрлось в лимит VIORA_REASONING — запрос повторён без рассуждения", ("kind",),
+)
+LLM_CASCADE = METRICS.counter(
+    "viora_llm_cascade_total",
+    "Каскад моделей: ответ быстрой модели принят (accepted) или запрос передан основной (escalated)",
+    ("kind", "outcome"),
+)
+LLM_TOKENS = METRICS.counter(
+    "viora_llm_tokens_total", "Токены по данным провайдера (prompt — промпт, completion — ответ)", ("backend", "type"),
+)
+
+
+@app.before_request
+def _start_request_timer() -> None:
+    g.viora_started = time.perf_counter()
+    METRICS.ensure_running()
+
+
+@app.after_request
+def _observe_request(resp: Response) -> Response:
+    started = g.get("viora_started")
+    if started is not None:
+        labels = {
+            "route": request.url_rule.rule if request.url_rule is not None else "unmatched",
+            "method": request.method,
+            "status": resp.status_code,
+        }
+        if resp.is_streamed:
+            # SSE меряем по закрытию ответа — до конца потока, а не до первого байта.
+            resp.call_on_close(lambda: HTTP_SECONDS.observe(time.perf_counter() - started, **labels))
+        else:
+            HTTP_SECONDS.observe(time.perf_counter() - started, **labels)
     return resp
 
 
 # ── Промпты (без капслока, в спокойном тоне) ──────────────────────────────────
+_LIFE_SECTIONS_FORMAT = (
+    "(2–3 предложения по сути варианта, без воды)\n"
+    "ПЛЮСЫ:\n"
+    "(3–5 пунктов, каждый с новой строки, без маркеров)\n"
+    "МИНУСЫ:\n"
+    "(3–5 пунктов, каждый с новой строки, без маркеров)\n"
+    "РИСКИ:\n"
+    "(2–4 конкретных риска, что может пойти не так)\n"
+    "РЕКОМЕНДАЦИИ:\n"
+    "(2–4 конкретных шага, как повысить шансы на успех)\n"
+    "ОЦЕНКА: N/10 — короткое обоснование одной фразой\n"
+    "ВЕРДИКТ: 1–2 предложения с финальной рекомендацией\n\n"
+)
+
+_LIFE_RULES = (
+    "2. Используй ровно указанные заголовки секций.\n"
+    "3. Без маркеров (-, *, •), нумерации, точек с запятой.\n"
+    "4. Конкретика вместо общих фраз. Каждый пункт — законченная мысль.\n"
+    "5. Без вступлений, выводов и метакомментариев вне формата.\n"
+)
+
+_LIFE_EXAMPLE = (
+    "ОПИСАНИЕ Переезд в другой город\n"
+    "Смена места жительства ради новых карьерных возможностей и круга общения.\n"
+    "ПЛЮСЫ:\n"
+    "Новый круг общения и карьерные возможности\n"
+    "Изменение жизненного контекста и привычек\n"
+    "Освобождение от груза прошлого окружения\n"
+    "МИНУСЫ:\n"
+    "Финансовые расходы на переезд и аренду\n"
+    "Стресс адаптации в первые месяцы\n"
+    "Потеря привычной поддерживающей среды\n"
+    "РИСКИ:\n"
+    "Невозможность быстро найти работу в новом городе\n"
+    "Одиночество и эмоциональное выгорание\n"
+    "Несоответствие ожиданий реальности нового места\n"
+    "РЕКОМЕНДАЦИИ:\n"
+    "Накопить финансовую подушку минимум на 6 месяцев\n"
+    "Заранее наладить контакты и согласовать работу\n"
+    "Запланировать поездку-разведку на 1–2 недели\n"
+    "ОЦЕНКА: 7/10 — перспективно при хорошей подготовке\n"
+    "ВЕРДИКТ: Стоит делать, если есть финансовая подушка и предварительные контакты в новом городе.\n\n"
+)
+
+
+# Неизменная часть каждого промпта (роль, формат, правила, пример) идёт первой,
+# а данные запроса — в конце: Ollama переиспользует KV-кэш общего префикса,
+# а в режиме /api/chat префикс уходит стабильным system-сообщением.
+_LIFE_SYSTEM_PROMPT = (
+    "Ты — опытный аналитик решений и консультант. Проанализируй вариант "
+    "решения и верни развёрнутый отчёт строго в указанном формате.\n\n"
+    "Формат ответа:\n"
+    "ОПИСАНИЕ <вариант решения>\n"
+    + _LIFE_SECTIONS_FORMAT
+    + "Правила:\n"
+    "1. Начни ответ строго со слова «ОПИСАНИЕ», без вступлений.\n"
+    + _LIFE_RULES
+    + "\nПример:\n"
+    + _LIFE_EXAMPLE
+)
+
+_LIFE_BATCH_SYSTEM_PROMPT = (
+    "Ты — опытный аналитик решений и консультант. Проанализируй каждый из "
+    "перечисленных вариантов решения и верни по каждому развёрнутый отчёт "
+    "строго в указанном формате.\n\n"
+    "Формат ответа — блок на каждый вариант, по порядку номеров:\n"
+    "### ИСХОД k\n"
+    "ОПИСАНИЕ <вариант k>\n"
+    + _LIFE_SECTIONS_FORMAT
+    + "Правила:\n"
+    "1. Каждый блок начинается отдельной строкой «### ИСХОД k», следом «ОПИСАНИЕ»; "
+    "не пропускай и не объединяй варианты.\n"
+    + _LIFE_RULES
+    + "\nПример блока:\n"
+    "### ИСХОД 1\n"
+    + _LIFE_EXAMPLE
+)
+
+_NEXT_FRAME_SYSTEM_PROMPT = (
+    "Ты — кинорежиссёр. Предложи следующий кадр в сцене и подробно "
+    "разбери его художественные средства.\n\n"
+    "Формат ответа (строго эти заголовки, каждый с новой строки):\n"
+    "СЛЕДУЮЩИЙ КАДР: <описание одной фразой>\n"
+    "ВИЗУАЛЬНЫЕ ЭЛЕМЕНТЫ: элемент1; элемент2; элемент3\n"
+    "ЭМОЦИОНАЛЬНОЕ ВОЗДЕЙСТВИЕ: эффект1; эффект2; эффект3\n"
+    "КОМПОЗИЦИЯ: приём1; приём2; приём3\n"
+    "ЗВУК И РИТМ: элемент1; элемент2\n"
+    "ПЕРЕХОД: <одно предложение о том, как этот кадр соединяется с предыдущим>\n\n"
+    "Правила: 3–5 пунктов в разделах со списком, через «;». Без маркеров, "
+    "вступлений и выводов. Будь кинематографичен и конкретен.\n\n"
+)
+
+_ANALYZE_FRAMES_SYSTEM_PROMPT = (
+    "Ты — кинорежиссёр-аналитик. Сравни предложенные кадры, выбери лучший "
+    "и дай развёрнутый разбор: композиция, атмосфера, драматургия, "
+    "сильные стороны, что улучшить, куда развивать сцену дальше.\n\n"
+    "Формат ответа (строго эти заголовки, каждый с новой строки):\n"
+    "ЛУЧШИЙ КАДР: <номер кадра>\n"
+    "ПОЧЕМУ ЭТОТ КАДР: <2–3 предложения обоснования>\n"
+    "КОМПОЗИЦИЯ: приём1; приём2; приём3\n"
+    "АТМОСФЕРА: тон1; тон2; тон3\n"
+    "ДРАМАТУРГИЯ: момент1; момент2; момент3\n"
+    "СИЛЬНЫЕ СТОРОНЫ: сторона1; сторона2; сторона3\n"
+    "ВОЗМОЖНЫЕ УЛУЧШЕНИЯ: улучшение1; улучшение2; улучшение3\n"
+    "СЛЕДУЮЩИЙ ШАГ: идея1; идея2; идея3\n"
+    "ОЦЕНКА: N/10 — короткое обоснование\n"
+    "ВЕРДИКТ: <1–2 предложения с финальной рекомендацией>\n\n"
+    "Правила: 2–5 пунктов в разделах со списком, через «;». Будь объективен, "
+    "говори кинематографическим языком, давай конструктивные рекомендации. "
+    "Без маркеров (-, *, •), вступлений и метакомментариев вне формата.\n\n"
+)
+
+# Map-этап анализа большого набора кадров: короткая оценка каждого кадра куска.
+_SCORE_FRAMES_SYSTEM_PROMPT = (
+    "Ты — кинорежиссёр-отборщик. Оцени каждый кадр сцены отдельно: "
+    "композиция, атмосфера, драматургическая сила.\n\n"
+    "Формат ответа (строго по строке на кадр, в порядке номеров):\n"
+    "КАДР <номер>: N/10 — <одно короткое обоснование>\n\n"
+    "Правила: номера — как во входных данных, оценка — целое от 1 до 10. "
+    "Без маркеров, вступлений и метакомментариев вне формата.\n\n"
+)
+
+# Неизменная часть промпта → вид промпта (ключи _OUTPUT_TOKENS).
+_SYSTEM_PROMPTS = {
+    _LIFE_SYSTEM_PROMPT: "life",
+    _LIFE_BATCH_SYSTEM_PROMPT: "life_batch",
+    _NEXT_FRAME_SYSTEM_PROMPT: "next_frame",
+    _ANALYZE_FRAMES_SYSTEM_PROMPT: "analyze",
+    _SCORE_FRAMES_SYSTEM_PROMPT: "score_frames",
+}
+
+
+def split_system_prompt(prompt: str) -> tuple[str, str]:
+    """(неизменные инструкции, данные запроса); для чужих промптов system пустой."""
+    for system in _SYSTEM_PROMPTS:
+        if prompt.startswith(system):
+            return system.rstrip(), prompt[len(system):]
+    return "", prompt
+
+
+def prompt_kind(prompt: str) -> str:
+    """Вид промпта по его неизменной части; для чужих промптов — пустая строка."""
+    for system, kind in _SYSTEM_PROMPTS.items():
+        if prompt.startswith(system):
+            return kind
+    return ""
+
+
 def build_prompt_pros_cons(title: str, outcome: str) -> str:
     return (
-        "Ты — опытный аналитик решений и консультант. Проанализируй вариант "
-        "решения и верни развёрнутый отчёт строго в указанном формате.\n\n"
-        "Формат ответа:\n"
-        f"ОПИСАНИЕ {outcome}\n"
-        "(2–3 предложения по сути варианта, без воды)\n"
-        "ПЛЮСЫ:\n"
-        "(3–5 пунктов, каждый с новой строки, без маркеров)\n"
-        "МИНУСЫ:\n"
-        "(3–5 пунктов, каждый с новой строки, без маркеров)\n"
-        "РИСКИ:\n"
-        "(2–4 конкретных риска, что может пойти не так)\n"
-        "РЕКОМЕНДАЦИИ:\n"
-        "(2–4 конкретных шага, как повысить шансы на успех)\n"
-        "ОЦЕНКА: N/10 — короткое обоснование одной фразой\n"
-        "ВЕРДИКТ: 1–2 предложения с финальной рекомендацией\n\n"
-        "Правила:\n"
-        "1. Начни ответ строго со слова «ОПИСАНИЕ», без вступлений.\n"
-        "2. Используй ровно указанные заголовки секций.\n"
-        "3. Без маркеров (-, *, •), нумерации, точек с запятой.\n"
-        "4. Конкретика вместо общих фраз. Каждый пункт — законченная мысль.\n"
-        "5. Без вступлений, выводов и метакомментариев вне формата.\n\n"
-        "Пример:\n"
-        "ОПИСАНИЕ Переезд в другой город\n"
-        "Смена места жительства ради новых карьерных возможностей и круга общения.\n"
-        "ПЛЮСЫ:\n"
-        "Новый круг общения и карьерные возможности\n"
-        "Изменение жизненного контекста и привычек\n"
-        "Освобождение от груза прошлого окружения\n"
-        "МИНУСЫ:\n"
-        "Финансовые расходы на переезд и аренду\n"
-        "Стресс адаптации в первые месяцы\n"
-        "Потеря привычной поддерживающей среды\n"
-        "РИСКИ:\n"
-        "Невозможность быстро найти работу в новом городе\n"
-        "Одиночество и эмоциональное выгорание\n"
-        "Несоответствие ожиданий реальности нового места\n"
-        "РЕКОМЕНДАЦИИ:\n"
-        "Накопить финансовую подушку минимум на 6 месяцев\n"
-        "Заранее наладить контакты и согласовать работу\n"
-        "Запланировать поездку-разведку на 1–2 недели\n"
-        "ОЦЕНКА: 7/10 — перспективно при хорошей подготовке\n"
-        "ВЕРДИКТ: Стоит делать, если есть финансовая подушка и предварительные контакты в новом городе.\n\n"
-        f"Проблема: {title}\n"
+        _LIFE_SYSTEM_PROMPT
+        + f"Проблема: {title}\n"
         f"Вариант решения: {outcome}\n\n"
         f"Ответ (начни с «ОПИСАНИЕ {outcome}»):"
     )
 
 
+def build_prompt_pros_cons_batch(title: str, outcomes: list[str]) -> str:
+    """Один промпт на несколько исходов: инструкции и пример передаются модели один раз.
+
+    Ответ — блоки «### ИСХОД k» в формате build_prompt_pros_cons, их разбирает split_life_batch.
+    """
+    listed = "".join(f"{i}. {outcome}\n" for i, outcome in enumerate(outcomes, 1))
+    return (
+        _LIFE_BATCH_SYSTEM_PROMPT
+        + f"Проблема: {title}\n"
+        f"Варианты решения:\n{listed}\n"
+        f"Ответ — {len(outcomes)} блоков (начни с «### ИСХОД 1»):"
+    )
+
+
 def build_prompt_next_frame(title: str, current_frame: str) -> str:
     return (
-        "Ты — кинорежиссёр. Предложи следующий кадр в сцене и подробно "
-        "разбери его художественные средства.\n\n"
-        "Формат ответа (строго эти заголовки, каждый с новой строки):\n"
-        "СЛЕДУЮЩИЙ КАДР: <описание одной фразой>\n"
-        "ВИЗУАЛЬНЫЕ ЭЛЕМЕНТЫ: элемент1; элемент2; элемент3\n"
-        "ЭМОЦИОНАЛЬНОЕ ВОЗДЕЙСТВИЕ: эффект1; эффект2; эффект3\n"
-        "КОМПОЗИЦИЯ: приём1; приём2; приём3\n"
-        "ЗВУК И РИТМ: элемент1; элемент2\n"
-        "ПЕРЕХОД: <одно предложение о том, как этот кадр соединяется с предыдущим>\n\n"
-        "Правила: 3–5 пунктов в разделах со списком, через «;». Без маркеров, "
-        "вступлений и выводов. Будь кинематографичен и конкретен.\n\n"
-        f"Тема сцены: {title}\n"
+        _NEXT_FRAME_SYSTEM_PROMPT
+        + f"Тема сцены: {title}\n"
         f"Текущий кадр: {current_frame}\n\n"
         "Ответ (начни со «СЛЕДУЮЩИЙ КАДР:»):"
     )
 
 
-def build_prompt_analyze_frames(title: str, frames: list[str]) -> str:
-    frames_text = "\n".join(f"{i + 1}. {f}" for i, f in enumerate(frames))
+def _numbered_frames(frames: list[str], numbers: list[int] | None) -> str:
+    return "\n".join(f"{n}. {f}" for n, f in zip(numbers or range(1, len(frames) + 1), frames))
+
+
+def build_prompt_analyze_frames(
+    title: str, frames: list[str], *, numbers: list[int] | None = None, total: int = 0,
+) -> str:
+    """numbers — исходные номера кадров (после отбора), total — сколько кадров было всего."""
+    heading = f"Кадры (лучшие из {total} по предварительной оценке)" if total else "Кадры"
     return (
-        "Ты — кинорежиссёр-аналитик. Сравни предложенные кадры, выбери лучший "
-        "и дай развёрнутый разбор: композиция, атмосфера, драматургия, "
-        "сильные стороны, что улучшить, куда развивать сцену дальше.\n\n"
-        "Формат ответа (строго эти заголовки, каждый с новой строки):\n"
-        "ЛУЧШИЙ КАДР: <номер кадра>\n"
-        "ПОЧЕМУ ЭТОТ КАДР: <2–3 предложения обоснования>\n"
-        "КОМПОЗИЦИЯ: приём1; приём2; приём3\n"
-        "АТМОСФЕРА: тон1; тон2; тон3\n"
-        "ДРАМАТУРГИЯ: момент1; момент2; момент3\n"
-        "СИЛЬНЫЕ СТОРОНЫ: сторона1; сторона2; сторона3\n"
-        "ВОЗМОЖНЫЕ УЛУЧШЕНИЯ: улучшение1; улучшение2; улучшение3\n"
-        "СЛЕДУЮЩИЙ ШАГ: идея1; идея2; идея3\n"
-        "ОЦЕНКА: N/10 — короткое обоснование\n"
-        "ВЕРДИКТ: <1–2 предложения с финальной рекомендацией>\n\n"
-        "Правила: 2–5 пунктов в разделах со списком, через «;». Будь объективен, "
-        "говори кинематографическим языком, давай конструктивные рекомендации. "
-        "Без маркеров (-, *, •), вступлений и метакомментариев вне формата.\n\n"
-        f"Тема: {title}\n"
-        f"Кадры:\n{frames_text}\n\n"
+        _ANALYZE_FRAMES_SYSTEM_PROMPT
+        + f"Тема: {title}\n"
+        f"{heading}:\n{_numbered_frames(frames, numbers)}\n\n"
         "Ответ (начни с «ЛУЧШИЙ КАДР:»):"
     )
 
 
+def build_prompt_score_frames(title: str, frames: list[str], numbers: list[int]) -> str:
+    """Кусок кадров на map-этап; ответ разбирает parse_frame_scores."""
+    return (
+        _SCORE_FRAMES_SYSTEM_PROMPT
+        + f"Тема: {title}\n"
+        f"Кадры:\n{_numbered_frames(frames, numbers)}\n\n"
+        f"Ответ (начни с «КАДР {numbers[0]}:»):"
+    )
+
+
 # ── Очистка ответа модели ─────────────────────────────────────────────────────
 _PREAMBLE_PHRASES = (
     "как эксперт", "в качестве", "проанализировав",
@@ -215,76 +930,129 @@ _SECTION_HEADERS_RE = re.compile(
 )
 
 
+# Маркеры списков в начале строки (-, *, •, 1., 2)).
+_LIST_MARKER_RE = re.compile(r"^[\-\*\•\d]+[\.\)\s]+", re.MULTILINE)
+
+
+@timed(PARSE_SECONDS, stage="sanitize")
 def sanitize_ai_text(text: str, max_len: int = 4000) -> str:
     """Аккуратная очистка: убираем размышления и преамбулу, сохраняем структуру."""
     if not text:
         return ""
     text = _THINK_BLOCK_RE.sub("", text)
-    text = text.replace("\r\n", "\n").replace("\r", "\n").strip()
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").strip().split("\n")
 
     cleaned_lines: list[str] = []
-    seen_section = False
-
-    for raw in text.split("\n"):
+    for i, raw in enumerate(lines):
         line = raw.strip()
         if not line:
             cleaned_lines.append("")
             continue
 
         if _SECTION_HEADERS_RE.match(line):
-            seen_section = True
+            # Преамбулу выкидываем только ДО первой секции — дальше строки
+            # идут как есть, заголовки проверять незачем.
             cleaned_lines.append(line)
-            continue
+            cleaned_lines.extend(rest.strip() for rest in lines[i + 1:])
+            break
 
-        # Преамбулу выкидываем только ДО первой секции и только если
-        # строка реально начинается с одной из преамбульных фраз.
-        if not seen_section:
-            low = line.lower()
-            if any(low.startswith(p) for p in _PREAMBLE_PHRASES):
-                continue
+        # Строка реально начинается с одной из преамбульных фраз.
+        if line.lower().startswith(_PREAMBLE_PHRASES):
+            continue
 
         cleaned_lines.append(line)
 
     cleaned = "\n".join(cleaned_lines).strip()
-
-    # Убираем маркеры списков ТОЛЬКО в начале строки (-, *, •, 1., 2)).
-    cleaned = re.sub(r"^[\-\*\•\d]+[\.\)\s]+", "", cleaned, flags=re.MULTILINE)
+    cleaned = _LIST_MARKER_RE.sub("", cleaned)
 
     if len(cleaned) > max_len:
         cleaned = cleaned[:max_len].rstrip() + "…"
     return cleaned
 
 
+class ThinkStripper:
+    """Потоковое удаление <think>…</think>: кормим кусками, получаем видимый текст.
+
+    Хвост, похожий на начало тега, придерживаем до следующего куска, поэтому
+    тег, разрезанный между токенами, тоже распознаётся. Незакрытый блок, как и
+    в _THINK_BLOCK_RE, остаётся в тексте — он возвращается из flush().
+    """
+
+    _OPEN = "<think>"
+    _CLOSE = "</think>"
+
+    def __init__(self):
+        self._pending = ""
+        self._inside = False
+        self._swallowed: list[str] = []
+
+    def feed(self, chunk: str) -> str:
+        buf = self._pending + chunk
+        self._pending = ""
+        out: list[str] = []
+        while buf:
+            tag = self._CLOSE if self._inside else self._OPEN
+            maybe_tag = "<" in buf
+            pos = buf.lower().find(tag) if maybe_tag else -1
+            if pos >= 0:
+                if self._inside:
+                    self._swallowed.clear()
+                else:
+                    out.append(buf[:pos])
+                    self._swallowed.append(buf[pos:pos + len(tag)])
+                buf = buf[pos + len(tag):]
+                self._inside = not self._inside
+                continue
+            keep = self._partial_tag_len(buf, tag) if maybe_tag else 0
+            body, self._pending = buf[: len(buf) - keep], buf[len(buf) - keep:]
+            (self._swallowed if self._inside else out).append(body)
+            break
+        return "".join(out)
+
+    def flush(self) -> str:
+        rest = self._pending
+        if self._inside:
+            rest = "".join(self._swallowed) + rest
+        self._pending, self._inside, self._swallowed = "", False, []
+        return rest
+
+    @staticmethod
+    def _partial_tag_len(buf: str, tag: str) -> int:
+        # «<» в теге только первый символ — начало обрывка ищем по последнему «<».
+        pos = buf.rfind("<", max(0, len(buf) - len(tag) + 1))
+        if pos < 0 or not tag.startswith(buf[pos:].lower()):
+            return 0
+        return len(buf) - pos
+
+
 # ── Парсинг секций ответа ИИ (структурированные поля для фронта) ─────────────
+_ITEM_MARKER_RE = re.compile(r"^[\-\*\•\d\.\)\s]+")
+_DESCRIPTION_HEADER_RE = re.compile(r"^ОПИСАНИЕ[:\s]*", re.IGNORECASE)
+
+
 def _split_section_items(raw: str, *, max_items: int = 6) -> list[str]:
     items: list[str] = []
     for line in raw.split("\n"):
-        line = re.sub(r"^[\-\*\•\d\.\)\s]+", "", line.strip()).strip()
+        line = _ITEM_MARKER_RE.sub("", line.strip()).strip()
         if len(line) > 2:
             items.append(line)
-    return items[:max_items]
+            if len(items) == max_items:
+                break
+    return items
 
 
-def _parse_sections(
-    text: str,
-    headers: list[tuple[str, str, bool]],
+def _assemble_sections(
+    normalized: str,
+    positions: list[tuple[str, int, int, str]],
+    single_line_by_key: dict[str, bool],
 ) -> dict[str, Any]:
-    """headers: (key, regex_pattern, single_line)."""
-    normalized = (text or "").replace("\r\n", "\n").replace("\r", "\n").strip()
-    single_line_by_key = {key: single for key, _, single in headers}
-    positions: list[tuple[str, int, int, str]] = []
-    for key, pattern, _single_line in headers:
-        m = re.search(pattern, normalized, re.IGNORECASE | re.MULTILINE)
-        if m:
-            positions.append((key, m.start(), m.end(), m.group(1) if m.lastindex else ""))
-    positions.sort(key=lambda x: x[1])
-
+    """positions: (key, start, end, capture) найденных заголовков, по возрастанию start."""
     description = ""
     if positions:
         description = normalized[: positions[0][1]].strip()
     elif normalized:
         description = normalized
-    description = re.sub(r"^ОПИСАНИЕ[:\s]*", "", description, flags=re.IGNORECASE).strip()
+    description = _DESCRIPTION_HEADER_RE.sub("", description).strip()
 
     sections: dict[str, Any] = {}
     for i, (key, _start, end, capture) in enumerate(positions):
@@ -302,18 +1070,103 @@ def _parse_sections(
     return {"description": description, **sections}
 
 
-_LIFE_HEADERS = [
+@dataclass(frozen=True)
+class _HeaderSet:
+    """Заголовки секций одного формата ответа, скомпилированные один раз.
+
+    scan — все заголовки одним шаблоном: опережающая проверка в начале строки,
+    имя сработавшей группы — ключ секции. Один finditer по тексту заменяет
+    отдельный re.search на каждый заголовок.
+    """
+    scan: re.Pattern
+    single_line: dict[str, bool]
+    by_key: dict[str, re.Pattern]
+
+
+_CAPTURE_GROUP_RE = re.compile(r"(?<!\\)\((?!\?)")
+
+
+def _header_set(headers: list[tuple[str, str, bool]]) -> _HeaderSet:
+    """headers: (key, regex_pattern, single_line); шаблоны начинаются с ^."""
+    flags = re.IGNORECASE | re.MULTILINE
+    # Захватывающие группы внутри делаем незахватывающими: lastgroup должен быть ключом.
+    alternatives = "|".join(
+        f"(?P<{key}>{_CAPTURE_GROUP_RE.sub('(?:', pattern.removeprefix('^'))})"
+        for key, pattern, _ in headers
+    )
+    return _HeaderSet(
+        scan=re.compile(f"^(?=(?:{alternatives}))", flags),
+        single_line={key: single for key, _, single in headers},
+        by_key={key: re.compile(pattern, flags) for key, pattern, _ in headers},
+    )
+
+
+def _find_headers(normalized: str, headers: _HeaderSet) -> list[tuple[str, int, int, str]]:
+    """Первое вхождение каждого заголовка, по возрастанию позиции — как re.search по каждому."""
+    positions: list[tuple[str, int, int, str]] = []
+    found: set[str] = set()
+    for hit in headers.scan.finditer(normalized):
+        key = hit.lastgroup
+        if key in found:
+            continue
+        found.add(key)
+        m = headers.by_key[key].match(normalized, hit.start())
+        positions.append((key, m.start(), m.end(), m.group(1) if m.lastindex else ""))
+        if len(found) == len(headers.by_key):
+            break
+    return positions
+
+
+def _parse_sections(text: str, headers: _HeaderSet) -> dict[str, Any]:
+    normalized = (text or "").replace("\r\n", "\n").replace("\r", "\n").strip()
+    return _assemble_sections(normalized, _find_headers(normalized, headers), headers.single_line)
+
+
+_LIFE_HEADERS = _header_set([
     ("pros", r"^\s*ПЛЮСЫ?\s*:?\s*$", False),
     ("cons", r"^\s*МИНУСЫ?\s*:?\s*$", False),
     ("risks", r"^\s*РИСКИ?\s*:?\s*$", False),
     ("recommendations", r"^\s*РЕКОМЕНДАЦИИ\s*:?\s*$", False),
     ("rating", r"^\s*ОЦЕНКА\s*:\s*(.*)$", True),
     ("verdict", r"^\s*ВЕРДИКТ\s*:\s*(.*)$", True),
-]
+])
 
+_FLOW_ANALYZE_HEADERS = _header_set([
+    ("best_frame", r"^\s*ЛУЧШИЙ\s+КАДР:\s*(.*)$", True),
+    ("explanation", r"^\s*ПОЧЕМУ\s+ЭТОТ\s+КАДР:\s*(.*)$", True),
+    ("composition", r"^\s*КОМПОЗИЦИЯ:\s*(.*)$", False),
+    ("atmosphere", r"^\s*АТМОСФЕРА:\s*(.*)$", False),
+    ("dramaturgy", r"^\s*ДРАМАТУРГИЯ:\s*(.*)$", False),
+    ("strengths", r"^\s*СИЛЬНЫЕ\s+СТОРОНЫ:\s*(.*)$", False),
+    ("improvements", r"^\s*ВОЗМОЖНЫЕ\s+УЛУЧШЕНИЯ:\s*(.*)$", False),
+    ("next_steps", r"^\s*СЛЕДУЮЩИЙ\s+ШАГ:\s*(.*)$", False),
+    ("score", r"^\s*ОЦЕНКА:\s*(.*)$", True),
+    ("verdict", r"^\s*ВЕРДИКТ:\s*(.*)$", True),
+])
 
-def parse_life_sections(text: str) -> dict[str, Any]:
-    parsed = _parse_sections(text, _LIFE_HEADERS)
+# next_frame ищет заголовки в любом месте текста (не с начала строки): все шесть
+# ключевых слов одним шаблоном, значение — остаток строки (\s* захватывает и переводы строк).
+_NEXT_FRAME_KEYWORDS_RE = re.compile(
+    r"(?P<next_frame>СЛЕДУЮЩИЙ\s+КАДР:)|(?P<visual_elements>ВИЗУАЛЬНЫЕ\s+ЭЛЕМЕНТЫ:)|"
+    r"(?P<emotional_impact>ЭМОЦИОНАЛЬНОЕ\s+ВОЗДЕЙСТВИЕ:)|(?P<composition>КОМПОЗИЦИЯ:)|"
+    r"(?P<sound_rhythm>ЗВУК\s+И\s+РИТМ:)|(?P<transition>ПЕРЕХОД:)",
+    re.IGNORECASE,
+)
+_NEXT_FRAME_VALUE_RE = re.compile(r"\s*([^\n]+)")
+_NEXT_FRAME_SCALAR_KEYS = ("next_frame", "transition")
+_NEXT_FRAME_SECTION_KEYS = (
+    "next_frame", "visual_elements", "emotional_impact", "composition", "sound_rhythm", "transition",
+)
+
+
+def _next_frame_value(key: str, raw: str) -> Any:
+    raw = raw.strip()
+    if key in _NEXT_FRAME_SCALAR_KEYS:
+        return raw
+    return [p.strip() for p in raw.split(";") if p.strip()]
+
+
+def _life_result(parsed: dict[str, Any]) -> dict[str, Any]:
     return {
         "description": parsed.get("description", ""),
         "pros": parsed.get("pros", []),
@@ -325,42 +1178,35 @@ def parse_life_sections(text: str) -> dict[str, Any]:
     }
 
 
-def parse_flow_next_frame_sections(text: str) -> dict[str, Any]:
-    def m(pattern: str) -> str:
-        x = re.search(pattern, text or "", re.IGNORECASE)
-        return x.group(1).strip() if x else ""
+@timed(PARSE_SECONDS, stage="parse")
+def parse_life_sections(text: str) -> dict[str, Any]:
+    return _life_result(_parse_sections(text, _LIFE_HEADERS))
 
-    def items(raw: str) -> list[str]:
-        if not raw:
-            return []
-        return [p.strip() for p in re.split(r"[;\n]", raw) if p.strip()]
 
+def _scan_flow_next_frame(text: str) -> dict[str, Any]:
+    """Один проход по тексту: первое вхождение каждого заголовка с непустым значением."""
+    found: dict[str, Any] = {}
+    for m in _NEXT_FRAME_KEYWORDS_RE.finditer(text):
+        key = m.lastgroup
+        if key in found:
+            continue
+        value = _NEXT_FRAME_VALUE_RE.match(text, m.end())
+        if value:
+            found[key] = _next_frame_value(key, value.group(1))
+            if len(found) == 6:
+                break
     return {
-        "next_frame": m(r"СЛЕДУЮЩИЙ\s+КАДР:\s*([^\n]+)"),
-        "visual_elements": items(m(r"ВИЗУАЛЬНЫЕ\s+ЭЛЕМЕНТЫ:\s*([^\n]+)")),
-        "emotional_impact": items(m(r"ЭМОЦИОНАЛЬНОЕ\s+ВОЗДЕЙСТВИЕ:\s*([^\n]+)")),
-        "composition": items(m(r"КОМПОЗИЦИЯ:\s*([^\n]+)")),
-        "sound_rhythm": items(m(r"ЗВУК\s+И\s+РИТМ:\s*([^\n]+)")),
-        "transition": m(r"ПЕРЕХОД:\s*([^\n]+)"),
+        key: found.get(key, "" if key in _NEXT_FRAME_SCALAR_KEYS else [])
+        for key in _NEXT_FRAME_SECTION_KEYS
     }
 
 
-def parse_flow_analyze_sections(text: str) -> dict[str, Any]:
-    parsed = _parse_sections(
-        text,
-        [
-            ("best_frame", r"^\s*ЛУЧШИЙ\s+КАДР:\s*(.*)$", True),
-            ("explanation", r"^\s*ПОЧЕМУ\s+ЭТОТ\s+КАДР:\s*(.*)$", True),
-            ("composition", r"^\s*КОМПОЗИЦИЯ:\s*(.*)$", False),
-            ("atmosphere", r"^\s*АТМОСФЕРА:\s*(.*)$", False),
-            ("dramaturgy", r"^\s*ДРАМАТУРГИЯ:\s*(.*)$", False),
-            ("strengths", r"^\s*СИЛЬНЫЕ\s+СТОРОНЫ:\s*(.*)$", False),
-            ("improvements", r"^\s*ВОЗМОЖНЫЕ\s+УЛУЧШЕНИЯ:\s*(.*)$", False),
-            ("next_steps", r"^\s*СЛЕДУЮЩИЙ\s+ШАГ:\s*(.*)$", False),
-            ("score", r"^\s*ОЦЕНКА:\s*(.*)$", True),
-            ("verdict", r"^\s*ВЕРДИКТ:\s*(.*)$", True),
-        ],
-    )
+@timed(PARSE_SECONDS, stage="parse")
+def parse_flow_next_frame_sections(text: str) -> dict[str, Any]:
+    return _scan_flow_next_frame(text or "")
+
+
+def _flow_analyze_result(parsed: dict[str, Any]) -> dict[str, Any]:
     # Однострочные секции flow-анализа часто идут списком через «;» в одной строке.
     for key in ("composition", "atmosphere", "dramaturgy", "strengths", "improvements", "next_steps"):
         val = parsed.get(key)
@@ -380,158 +1226,3615 @@ def parse_flow_analyze_sections(text: str) -> dict[str, Any]:
     }
 
 
-def enrich_life_result(outcome: str, result: str, *, ok: bool = True, index: int | None = None) -> dict[str, Any]:
-    payload: dict[str, Any] = {"outcome": outcome, "result": result, "ok": ok, **parse_life_sections(result)}
-    if index is not None:
-        payload["index"] = index
-    return payload
+@timed(PARSE_SECONDS, stage="parse")
+def parse_flow_analyze_sections(text: str) -> dict[str, Any]:
+    return _flow_analyze_result(_parse_sections(text, _FLOW_ANALYZE_HEADERS))
 
 
-# ── LLM: Ollama и Mistral API ─────────────────────────────────────────────────
-class LLMError(Exception):
-    """Ошибка запроса к провайдеру ИИ."""
+_FRAME_SCORE_RE = re.compile(
+    r"^\W*КАДР\s*№?\s*(\d+)\s*[:.—–-]\s*(\d+(?:[.,]\d+)?)\s*(?:/\s*10)?\s*[—–:-]?\s*(.*)$",
+    re.IGNORECASE | re.MULTILINE,
+)
 
 
-OllamaError = LLMError  # обратная совместимость
+def parse_frame_scores(text: str, numbers: list[int]) -> dict[int, tuple[float, str]]:
+    """Ответ map-этапа → {номер кадра: (оценка 0–10, обоснование)}; чужие номера отбрасываются."""
+    scores: dict[int, tuple[float, str]] = {}
+    for m in _FRAME_SCORE_RE.finditer(text or ""):
+        number = int(m.group(1))
+        if number in numbers and number not in scores:
+            scores[number] = (min(float(m.group(2).replace(",", ".")), 10.0), m.group(3).strip())
+    return scores
 
 
-def _retry_generate(label: str, call) -> str:
-    last_err: Exception | None = None
-    for attempt in range(1, CFG.max_retries + 2):
-        try:
-            return call()
-        except requests.exceptions.Timeout as e:
-            last_err = e
-            log.warning("%s timeout (attempt %d)", label, attempt)
-        except LLMError as e:
-            last_err = e
-            log.warning("%s failed (attempt %d): %s", label, attempt, e)
-        except Exception as e:
-            last_err = e
-            log.warning("%s error (attempt %d): %s", label, attempt, e)
-        if attempt <= CFG.max_retries:
-            time.sleep(0.5 * attempt)
-    raise LLMError(f"Все попытки исчерпаны: {last_err}")
+_SECTION_PARSERS = {
+    "life": parse_life_sections,
+    "next_frame": parse_flow_next_frame_sections,
+    "analyze": parse_flow_analyze_sections,
+}
 
 
-def _ollama_generate_once(prompt: str, *, temperature: float) -> str:
-    r = requests.post(
-        f"{CFG.ollama_url}/api/generate",
-        json={
-            "model": CFG.ollama_model,
-            "prompt": prompt,
-            "temperature": temperature,
-            "stream": False,
-        },
-        timeout=CFG.request_timeout,
-    )
-    if r.status_code != 200:
-        raise LLMError(f"Ollama HTTP {r.status_code}: {r.text[:200]}")
-    return sanitize_ai_text(r.json().get("response", ""))
+# ── Потоковый разбор ответа (инкрементальные sanitize_ai_text + parse_*) ─────
+@dataclass(frozen=True)
+class _SectionSpec:
+    """Как разбирать ответ одного эндпоинта в потоке."""
+    headers: _HeaderSet
+    finalize: Any                 # dict из _assemble_sections → dict ответа API
+    batch: Any                    # эталонный batch-парсер с той же семантикой
 
 
-def _mistral_generate_once(prompt: str, *, temperature: float) -> str:
-    if not CFG.mistral_api_key:
-        raise LLMError("MISTRAL_API_KEY не задан (нужен для VIORA_LLM_PROVIDER=mistral)")
-    r = requests.post(
-        f"{CFG.mistral_base_url}/chat/completions",
-        headers={
-            "Authorization": f"Bearer {CFG.mistral_api_key}",
-            "Content-Type": "application/json",
-        },
-        json={
-            "model": CFG.mistral_model,
-            "messages": [{"role": "user", "content": prompt}],
-            "temperature": temperature,
-        },
-        timeout=CFG.request_timeout,
-    )
-    if r.status_code != 200:
-        raise LLMError(f"Mistral HTTP {r.status_code}: {r.text[:300]}")
-    data = r.json()
-    choices = data.get("choices") or []
-    if not choices:
-        raise LLMError("Mistral: пустой ответ (нет choices)")
-    message = choices[0].get("message") or {}
-    content = message.get("content", "")
-    if isinstance(content, list):
-        # Некоторые модели отдают content как массив блоков
-        parts = []
-        for block in content:
-            if isinstance(block, dict) and block.get("type") == "text":
-                parts.append(block.get("text", ""))
-            elif isinstance(block, str):
-                parts.append(block)
-        content = "\n".join(p for p in parts if p)
-    return sanitize_ai_text(str(content))
-
-
-def llm_generate(prompt: str, *, temperature: float = 0.7) -> str:
-    """Единая точка генерации: провайдер из VIORA_LLM_PROVIDER."""
-    if CFG.llm_provider == "mistral":
-        return _retry_generate("mistral_generate", lambda: _mistral_generate_once(prompt, temperature=temperature))
-    return _retry_generate("ollama_generate", lambda: _ollama_generate_once(prompt, temperature=temperature))
+_SECTION_SPECS: dict[str, _SectionSpec] = {
+    "life": _SectionSpec(_LIFE_HEADERS, _life_result, parse_life_sections),
+    "analyze": _SectionSpec(_FLOW_ANALYZE_HEADERS, _flow_analyze_result, parse_flow_analyze_sections),
+}
 
 
-def ollama_generate(prompt: str, *, temperature: float = 0.7, stream: bool = False) -> str:
-    """Алиас для совместимости; stream игнорируется (используйте llm_generate)."""
-    if stream:
-        log.debug("ollama_generate(stream=True): стриминг только для Ollama, batch через llm_generate")
-    if CFG.llm_provider == "mistral":
-        return llm_generate(prompt, temperature=temperature)
-    return _retry_generate("ollama_generate", lambda: _ollama_generate_once(prompt, temperature=temperature))
+_MARKER_RE = re.compile(r"[\-\*\•\d]+[\.\)\s]+")
+_MARKER_ONLY_RE = re.compile(r"[\-\*\•\d]+")
+_MARKER_TAIL_RE = re.compile(r"[\.\)\s]*")
 
 
-def ollama_stream(prompt: str, *, temperature: float = 0.7) -> Generator[str, None, None]:
-    """Стрим токенов из Ollama (только провайдер ollama)."""
-    if CFG.llm_provider == "mistral":
-        raise LLMError("Стриминг через ollama_stream недоступен при VIORA_LLM_PROVIDER=mistral")
-    r = requests.post(
-        f"{CFG.ollama_url}/api/generate",
-        json={
-            "model": CFG.ollama_model,
-            "prompt": prompt,
-            "temperature": temperature,
-            "stream": True,
-        },
-        timeout=CFG.request_timeout,
-        stream=True,
-    )
-    if r.status_code != 200:
-        raise LLMError(f"HTTP {r.status_code}: {r.text[:200]}")
+class StreamingParser:
+    """Конечный автомат: куски ответа модели → видимый текст и готовые секции.
 
-    for line in r.iter_lines():
+    Состояние (think-блок, незавершённая строка, «видели ли секцию», открытые
+    заголовки) переносится между кусками, поэтому каждый символ обрабатывается
+    один раз. finish() возвращает (text, sections) — ровно то же, что
+    sanitize_ai_text(raw) и parse_*_sections от него.
+    """
+
+    def __init__(self, kind: str, *, max_len: int = 4000):
+        self.kind = kind
+        self.max_len = max_len
+        self._spec = _SECTION_SPECS.get(kind)
+        self._think = ThinkStripper()
+        self._cr = False
+        self._partial = ""
+        self._seen_section = False
+        # Выходные строки (уже как в sanitize_ai_text) и длина "\n".join(lines).
+        self._lines: list[str] = []
+        self._length = -1
+        self._pending_blanks = 0
+        self._pending_marker: str | None = None
+        self._pending_marker_full = False
+        self._eating = False
+        self._overflow = False
+        # Заголовки, найденные по ходу потока.
+        self._positions: list[tuple[str, int, int, str]] = []
+        self._emitted: set[str] = set()
+        self._awaiting: list[str] = []
+        self._deferred: tuple[str, int, bool] | None = None
+        self._ready: list[tuple[str, Any]] = []
+        self._held: list[tuple[str, Any]] = []
+        self._elapsed = 0.0  # время разбора за весь поток → viora_parse_seconds{stage="stream"}
+
+    # -- вход ---------------------------------------------------------------
+    def feed(self, chunk: str) -> tuple[str, list[tuple[str, Any]]]:
+        """Возвращает (видимый текст куска без <think>, секции, завершённые этим куском)."""
+        started = time.perf_counter()
+        self._ready = []
+        visible = self._think.feed(chunk)
+        if visible:
+            self._feed_visible(visible)
+        self._elapsed += time.perf_counter() - started
+        return visible, self._ready
+
+    def finish(self) -> tuple[str, dict[str, Any], list[tuple[str, Any]]]:
+        """Закрывает поток: (очищенный текст, разобранные секции, ещё не отданные секции)."""
+        started = time.perf_counter()
+        self._ready = []
+        tail = self._think.flush()
+        if tail:
+            self._feed_visible(tail)
+        if self._cr:
+            self._cr = False
+            self._feed_visible("\n")
+        if self._partial:
+            self._line(self._partial)
+            self._partial = ""
+        self._close()
+        for key, _ in self._held:
+            self._emitted.discard(key)
+        self._held = []
+
+        text = "\n".join(self._lines)
+        if len(text) > self.max_len:
+            text = text[: self.max_len].rstrip() + "…"
+            # Обрезка может разрезать секцию посередине — разбираем обрезанный текст целиком.
+            parsed = self._batch(text)
+        else:
+            parsed = self._final_sections(text)
+        for key, value in parsed.items():
+            if value and key not in self._emitted:
+                self._emitted.add(key)
+                self._ready.append((key, value))
+        PARSE_SECONDS.observe(self._elapsed + time.perf_counter() - started, stage="stream")
+        return text, parsed, self._ready
+
+    def _feed_visible(self, visible: str) -> None:
+        if self._cr:
+            visible = "\r" + visible
+            self._cr = False
+        if visible.endswith("\r"):
+            self._cr = True
+            visible = visible[:-1]
+        visible = visible.replace("\r\n", "\n").replace("\r", "\n")
+        *lines, self._partial = (self._partial + visible).split("\n")
+        for line in lines:
+            self._line(line)
+
+    # -- sanitize_ai_text построчно ----------------------------------------
+    def _line(self, raw: str) -> None:
+        if self._overflow:
+            return
+        line = raw.strip()
         if not line:
-            continue
-        try:
-            chunk = json.loads(line)
-        except json.JSONDecodeError:
-            continue
-        piece = chunk.get("response", "")
-        if piece:
-            yield piece
-        if chunk.get("done"):
+            if not self._eating and self._pending_marker is None:
+                self._pending_blanks += 1
             return
+        if _SECTION_HEADERS_RE.match(line):
+            self._seen_section = True
+        elif not self._seen_section and line.lower().startswith(_PREAMBLE_PHRASES):
+            return
+        self._content(line)
 
+    def _content(self, line: str) -> None:
+        # Эмуляция re.sub(r"^[\-\*\•\d]+[\.\)\s]+", "", MULTILINE) по склеенному тексту:
+        # строка из одних маркеров «съедает» свой перевод строки и пустые строки за ней.
+        if self._pending_marker is not None:
+            self._pending_marker = None
+            self._eating = True
+        if self._eating:
+            eaten = _MARKER_TAIL_RE.match(line).end()
+            if eaten:
+                line = line[eaten:]
+                if line:
+                    self._eating = False
+                    self._emit_line(line)
+                return
+            self._eating = False
+        m = _MARKER_RE.match(line)
+        if m and m.end() < len(line):
+            self._emit_line(line[m.end():])
+        elif m or _MARKER_ONLY_RE.fullmatch(line):
+            # Исчезнет ли строка, станет ясно по следующей непустой строке.
+            self._flush_blanks()
+            self._pending_marker = line
+            self._pending_marker_full = bool(m)
+        else:
+            self._emit_line(line)
 
-def check_llm_health() -> dict[str, Any]:
-    """Проверка активного провайдера для /healthz."""
-    if CFG.llm_provider == "mistral":
-        if not CFG.mistral_api_key:
-            return {
-                "status": "degraded",
-                "provider": "mistral",
-                "reachable": False,
-                "error": "MISTRAL_API_KEY не задан",
-                "model": CFG.mistral_model,
-                "api_url": CFG.mistral_base_url,
+    def _close(self) -> None:
+        if self._pending_marker is not None:
+            if self._pending_marker_full:
+                self._append("")
+            else:
+                self._emit_line(self._pending_marker)
+            self._pending_marker = None
+        elif self._eating:
+            self._append("")
+            self._eating = False
+
+    def _flush_blanks(self) -> None:
+        if self._lines:
+            for _ in range(self._pending_blanks):
+                self._append("")
+        self._pending_blanks = 0
+
+    def _emit_line(self, line: str) -> None:
+        self._flush_blanks()
+        self._append(line)
+
+    def _append(self, line: str) -> None:
+        offset = self._length + 1
+        self._lines.append(line)
+        self._length += len(line) + 1
+        if line:
+            # Обрезка по max_len дописывает «…» к последней строке, поэтому секции,
+            # закрытые строкой, отдаём только когда после неё в пределах лимита есть текст.
+            if offset < self.max_len:
+                self._ready.extend(self._held)
+                self._held = []
+            self._on_line(line, offset)
+        if self._length > self.max_len:
+            self._overflow = True
+
+    # -- секции ---------------------------------------------------------------
+    def _on_line(self, line: str, offset: int) -> None:
+        if self._overflow:
+            return
+        if self._spec is None:
+            self._on_next_frame_line(line)
+            return
+        if self._deferred is not None:
+            # «КЛЮЧ:» без значения: \s* в шаблоне захватывает следующую непустую строку.
+            key, start, single = self._deferred
+            self._deferred = None
+            self._positions.append((key, start, offset + len(line), line))
+            if single:
+                self._emit_ready({key})
+        hit = self._spec.headers.scan.match(line)
+        if hit is None:
+            return
+        key = hit.lastgroup
+        # Все ранее открытые секции на этом месте завершены.
+        closed = {k for k, *_ in self._positions} | {"description"}
+        if key in closed:
+            return
+        rx = self._spec.headers.by_key[key]
+        single = self._spec.headers.single_line[key]
+        m = rx.match(line)
+        capture = m.group(1) if m.lastindex else ""
+        if rx.groups and not capture.strip():
+            self._deferred = (key, offset, single)
+        else:
+            self._positions.append((key, offset, offset + m.end(), capture))
+            if single:
+                closed.add(key)
+        self._emit_ready(closed)
+
+    def _emit_ready(self, keys: set[str]) -> None:
+        text = "\n".join(self._lines)
+        positions = list(self._positions)
+        if self._deferred is not None:
+            # Незавершённый заголовок уже ограничивает предыдущие секции.
+            key, start, _ = self._deferred
+            positions.append((key, start, len(text), ""))
+        parsed = self._spec.finalize(_assemble_sections(text, positions, self._spec.headers.single_line))
+        for key, value in parsed.items():
+            if key in keys and value and key not in self._emitted:
+                self._emitted.add(key)
+                self._held.append((key, value))
+
+    def _on_next_frame_line(self, line: str) -> None:
+        # «КЛЮЧ:» в конце строки — значение берётся со следующей непустой строки (\s* в шаблоне).
+        for key in self._awaiting:
+            self._emitted.add(key)
+            self._held.append((key, _next_frame_value(key, line)))
+        self._awaiting = []
+        for m in _NEXT_FRAME_KEYWORDS_RE.finditer(line):
+            key = m.lastgroup
+            if key in self._emitted or key in self._awaiting:
+                continue
+            value = line[m.end():].strip()
+            if value:
+                self._emitted.add(key)
+                self._held.append((key, _next_frame_value(key, value)))
+            else:
+                self._awaiting.append(key)
+
+    def _final_sections(self, text: str) -> dict[str, Any]:
+        if self._spec is None:
+            return _scan_flow_next_frame(text)
+        return self._spec.finalize(_parse_sections(text, self._spec.headers))
+
+    def _batch(self, text: str) -> dict[str, Any]:
+        if self._spec is None:
+            return parse_flow_next_frame_sections(text)
+        return self._spec.batch(text)
+
+
+def enrich_life_result(
+    outcome: str,
+    result: str,
+    *,
+    ok: bool = True,
+    index: int | None = None,
+    sections: dict[str, Any] | None = None,
+) -> dict[str, Any]:
+    """sections — уже разобранные секции (например, из StreamingParser), чтобы не парсить повторно."""
+    if sections is None:
+        sections = parse_life_sections(result)
+    payload: dict[str, Any] = {"outcome": outcome, "result": result, "ok": ok, **sections}
+    if index is not None:
+        payload["index"] = index
+    return payload
+
+
+_LIFE_BATCH_MARKER_RE = re.compile(r"^\s*(?:#{1,6}|\*\*)?\s*ИСХОД\s+(\d+)\b[^\n]*$", re.MULTILINE)
+
+
+def split_life_batch(text: str, count: int) -> list[tuple[str, dict[str, Any]] | None]:
+    """Делит ответ на build_prompt_pros_cons_batch на (текст, секции) по исходам.
+
+    None — блока нет (модель сбилась или упёрлась в лимит токенов) или он не
+    похож на отчёт: без плюсов или минусов. Такие исходы переспрашиваются по одному.
+    """
+    marks = list(_LIFE_BATCH_MARKER_RE.finditer(text))
+    blocks: dict[int, str] = {}
+    for m, nxt in zip(marks, marks[1:] + [None]):
+        idx = int(m.group(1))
+        if 1 <= idx <= count and idx not in blocks:
+            blocks[idx] = text[m.end():nxt.start() if nxt else len(text)]
+    parts: list[tuple[str, dict[str, Any]] | None] = []
+    for idx in range(1, count + 1):
+        block = sanitize_ai_text(blocks.get(idx, ""))
+        sections = parse_life_sections(block)
+        parts.append((block, sections) if sections["pros"] and sections["cons"] else None)
+    return parts
+
+
+# ── Бюджет ответа: лимит токенов, рассуждение, стоп-последовательности, ранняя остановка ──
+# Рассуждающие модели (<think>…</think> или поле thinking): им нужен запас
+# токенов на рассуждение, а стоп-строки могут сработать внутри него.
+_REASONING_MODEL_RE = re.compile(r"r1\b|qwq|qwen3|think|reason|magistral", re.IGNORECASE)
+_THINK_TOKENS = 4096
+
+# Болтовня после формата: разделитель или примечание с новой строки. Пакетный
+# и map-промпты разделителями не режем — ими модель может отбивать блоки.
+_STOP_SEQUENCES = ("\n---", "\n***", "\nПримечание", "\n**Примечание", "\nОбратите внимание")
+_STOP_SEQUENCES_BY_KIND = {
+    "life": _STOP_SEQUENCES,
+    "next_frame": _STOP_SEQUENCES,
+    "analyze": _STOP_SEQUENCES,
+    "life_batch": _STOP_SEQUENCES[2:],
+    "score_frames": _STOP_SEQUENCES[2:],
+}
+
+
+def is_reasoning_model(model: str) -> bool:
+    return bool(_REASONING_MODEL_RE.search(model or ""))
+
+
+def reasoning_mode(prompt: str) -> int | None:
+    """Режим рассуждения вида промпта (VIORA_REASONING): 0 — выкл., -1 — полный,
+    N — лимит токенов, None — не управлять."""
+    return CFG.reasoning.get(prompt_kind(prompt))
+
+
+def ollama_think(prompt: str, model: str) -> bool | None:
+    """Поле think запроса Ollama: True — рассуждение отдельно от ответа (поле thinking),
+    False — без рассуждения, None — не передавать (модель не рассуждающая или VIORA_REASONING=0)."""
+    mode = reasoning_mode(prompt)
+    if mode is None or not is_reasoning_model(model):
+        return None
+    return mode != 0
+
+
+def reasoning_cap(prompt: str, model: str) -> int:
+    """Лимит токенов рассуждения Ollama-запроса; 0 — без лимита или без рассуждения."""
+    mode = reasoning_mode(prompt)
+    return mode if ollama_think(prompt, model) and mode > 0 else 0
+
+
+def output_budget(
+    prompt: str, model: str | None = None, provider: str | None = None, items: list[int] | None = None,
+) -> int:
+    """Лимит токенов ответа (num_predict / max_tokens) для промпта; 0 — без лимита.
+
+    Бюджет вида промпта из VIORA_OUTPUT_TOKENS (у пакетных — на каждый пункт
+    списка items: номера исходов или кадров от вызывающего кода) плюс запас
+    на рассуждение для рассуждающих моделей (VIORA_THINK_TOKENS,
+    -1 — _THINK_TOKENS, если модель похожа на рассуждающую). У Ollama запас
+    следует VIORA_REASONING: выключенному рассуждению — ноль, ограниченному — лимит.
+    """
+    kind = prompt_kind(prompt)
+    answer = CFG.output_tokens.get(kind, 0)
+    if not answer:
+        return 0
+    if kind in ("life_batch", "score_frames"):
+        answer *= max(len(items or ()), 1)
+    model = model or CFG.active_model()
+    think = CFG.think_tokens
+    if think < 0:
+        think = _THINK_TOKENS if is_reasoning_model(model) else 0
+    if (provider or CFG.llm_provider) == "ollama":
+        thinking = ollama_think(prompt, model)
+        if thinking is False:
+            think = 0
+        elif thinking:
+            think = reasoning_cap(prompt, model) or think
+    return answer + think
+
+
+def stop_sequences(prompt: str, model: str | None = None, provider: str | None = None) -> list[str]:
+    """Стоп-строки для промпта; у рассуждающих моделей — никаких (сработали бы в рассуждении),
+    кроме Ollama с выключенным рассуждением."""
+    model = model or CFG.active_model()
+    if not CFG.stop_sequences:
+        return []
+    reasoning = is_reasoning_model(model)
+    if reasoning and (provider or CFG.llm_provider) == "ollama":
+        reasoning = ollama_think(prompt, model) is not False
+    if reasoning:
+        return []
+    return list(_STOP_SEQUENCES_BY_KIND.get(prompt_kind(prompt), ()))
+
+
+class ReasoningMeter:
+    """Токены рассуждения одного потокового ответа и лимит на них.
+
+    Ollama отдаёт по токену на чанк, поэтому считаются чанки с непустым
+    thinking. feed() говорит, что рассуждение упёрлось в cap; cut() снимает
+    лимит перед повтором запроса без рассуждения, close() пишет метрику.
+    """
+
+    def __init__(self, prompt: str, cap: int = 0):
+        self.kind = prompt_kind(prompt)
+        self.cap = cap
+        self.tokens = 0
+
+    def feed(self, thinking: str) -> bool:
+        if thinking:
+            self.tokens += 1
+        return bool(self.cap) and self.tokens >= self.cap
+
+    def cut(self) -> None:
+        LLM_REASONING_CUTS.inc(kind=self.kind)
+        log.info("Рассуждение %s упёрлось в лимит %d токенов — повтор без рассуждения", self.kind, self.cap)
+        self.cap = 0
+
+    def close(self) -> None:
+        if self.tokens:
+            LLM_REASONING_TOKENS.inc(self.tokens, kind=self.kind)
+
+
+def count_reasoning(prompt: str, thinking: str) -> None:
+    """Рассуждение ответа без потока: токены — оценка по длине текста."""
+    if thinking:
+        LLM_REASONING_TOKENS.inc(-(-len(thinking) // _CHARS_PER_TOKEN), kind=prompt_kind(prompt))
+
+
+class AnswerWatchdog:
+    """Следит за потоком ответа и говорит, когда дописана строка последней секции.
+
+    Последние секции форматов (ВЕРДИКТ, ПЕРЕХОД) однострочные: парсеры берут
+    остаток строки заголовка или, если он пуст, следующую непустую строку.
+    Когда все заголовки формата встречены и эта строка закончилась, дальше
+    модель может только болтать — генерацию можно обрывать, результат разбора
+    от этого не изменится. <think> пропускается; заголовок последней секции
+    раньше остальных (модель сбилась с формата) остановку не включает.
+    """
+
+    # вид промпта → (заголовки формата или None — ключевые слова next_frame, последняя секция)
+    _FINAL = {
+        "life": (_LIFE_HEADERS, "verdict"),
+        "analyze": (_FLOW_ANALYZE_HEADERS, "verdict"),
+        "next_frame": (None, "transition"),
+    }
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.done = False
+        self._headers, self._final = self._FINAL[kind]
+        self._keys = set(self._headers.by_key) if self._headers else set(_NEXT_FRAME_SECTION_KEYS)
+        self._seen: set[str] = set()
+        self._awaiting = False      # заголовок последней секции без значения — ждём следующую строку
+        self._think = ThinkStripper()
+        self._partial = ""
+
+    def feed(self, piece: str) -> bool:
+        """Кусок сырого ответа модели; True — ответ закончен, дальше читать незачем."""
+        if self.done:
+            return True
+        *lines, self._partial = (self._partial + self._think.feed(piece)).split("\n")
+        for line in lines:
+            self._on_line(line.strip())
+            if self.done:
+                LLM_EARLY_STOPS.inc(kind=self.kind)
+                break
+        return self.done
+
+    def _on_line(self, line: str) -> None:
+        if not line:
+            return
+        if self._awaiting:
+            self.done = True
+            return
+        for key, value in self._headers_in(line):
+            self._seen.add(key)
+            if key == self._final and self._seen >= self._keys:
+                self.done = bool(value)
+                self._awaiting = not value
+
+    def _headers_in(self, line: str) -> list[tuple[str, str]]:
+        if self._headers is None:
+            return [(m.lastgroup, line[m.end():].strip()) for m in _NEXT_FRAME_KEYWORDS_RE.finditer(line)]
+        line = _LIST_MARKER_RE.sub("", line)
+        hit = self._headers.scan.match(line)
+        if hit is None:
+            return []
+        m = self._headers.by_key[hit.lastgroup].match(line)
+        return [(hit.lastgroup, (m.group(1) if m.lastindex else "").strip())]
+
+
+def answer_watchdog(prompt: str) -> AnswerWatchdog | None:
+    """AnswerWatchdog для промпта или None: ранняя остановка выключена или формат без последней строки."""
+    kind = prompt_kind(prompt)
+    if not CFG.early_stop or kind not in AnswerWatchdog._FINAL:
+        return None
+    return AnswerWatchdog(kind)
+
+
+# ── Маршрутизация моделей: модель по виду промпта, каскад ────────────────────
+# Секции, без которых ответ быстрой модели каскада не принимается.
+_CASCADE_REQUIRED = {
+    "life": ("pros", "cons", "verdict"),
+    "next_frame": ("next_frame",),
+    "analyze": ("best_frame", "verdict"),
+}
+
+
+def model_route(prompt: str) -> ModelRoute:
+    """Основная модель промпта: VIORA_MODEL_ROUTES по виду промпта, иначе модель провайдера."""
+    return CFG.model_routes.get(prompt_kind(prompt)) or ModelRoute(CFG.llm_provider, CFG.active_model())
+
+
+def cascade_route(prompt: str) -> ModelRoute | None:
+    """Быстрая модель, которая отвечает первой (VIORA_CASCADE); None — каскада нет."""
+    return CFG.cascade.get(prompt_kind(prompt))
+
+
+def generation_options(prompt: str, route: ModelRoute, items: list[int] | None = None) -> dict[str, Any]:
+    """Параметры запроса к модели маршрута, меняющие ответ: лимит ответа, стоп-строки, рассуждение."""
+    if route.provider == "ollama":
+        budget = CFG.ollama_num_predict or output_budget(prompt, route.model, "ollama", items)
+        think, cap = ollama_think(prompt, route.model), reasoning_cap(prompt, route.model)
+    else:
+        budget = output_budget(prompt, route.model, route.provider, items)
+        think, cap = None, 0
+    return {"budget": budget, "stop": stop_sequences(prompt, route.model, route.provider), "think": think, "cap": cap}
+
+
+def response_key(prompt: str, temperature: float, items: list[int] | None = None) -> str:
+    """Ключ кэша и single-flight ответа на промпт; каскад — отдельная «модель» из двух ступеней.
+
+    В ключ входят и generation_options: смена VIORA_OUTPUT_TOKENS, стоп-строк или
+    VIORA_REASONING не отдаёт из дискового кэша ответы, сгенерированные по-старому.
+    """
+    route, fast = model_route(prompt), cascade_route(prompt)
+    model = f"{fast.provider}:{fast.model}>{route.model}" if fast else route.model
+    options = [generation_options(prompt, r, items) for r in (fast, route) if r is not None]
+    return ResponseCache.make_key(route.provider, model, temperature, prompt, options)
+
+
+def routed_models(provider: str) -> list[str]:
+    """Модели провайдера из маршрутов и каскада (для предзагрузки и health-check)."""
+    routes = (*CFG.model_routes.values(), *CFG.cascade.values())
+    return sorted({r.model for r in routes if r.provider == provider})
+
+
+def describe_routes() -> str:
+    """Маршруты для лога запуска: «next_frame=ollama:qwen2.5:3b, life=… (каскад …)»."""
+    parts = []
+    for kind in _OUTPUT_TOKENS:
+        route, fast = CFG.model_routes.get(kind), CFG.cascade.get(kind)
+        if route or fast:
+            route = route or ModelRoute(CFG.llm_provider, CFG.active_model())
+            cascade = f" (сначала {fast.provider}:{fast.model})" if fast else ""
+            parts.append(f"{kind}={route.provider}:{route.model}{cascade}")
+    return ", ".join(parts)
+
+
+def cascade_accepts(prompt: str, text: str, items: list[int] | None = None) -> bool:
+    """Годится ли ответ быстрой модели: на месте все секции, без которых он бесполезен.
+
+    Пакет life — каждый исход с плюсами и минусами (как в split_life_batch),
+    map-этап — оценка у каждого кадра куска; items — номера исходов или кадров
+    от вызывающего кода (см. llm_generate).
+    """
+    kind = prompt_kind(prompt)
+    if kind in _CASCADE_REQUIRED:
+        parsed = _SECTION_PARSERS[kind](text)
+        return all(parsed[key] for key in _CASCADE_REQUIRED[kind])
+    items = items or []
+    if kind == "life_batch":
+        return all(split_life_batch(text, len(items)))
+    if kind == "score_frames":
+        return len(parse_frame_scores(text, items)) == len(items)
+    return bool(text)
+
+
+def cascade_result(prompt: str, text: str | None, items: list[int] | None = None) -> str | None:
+    """Итог первой ступени каскада: text, если ответ принят, иначе None — запрос
+    уходит основной модели. text=None — быстрая модель не ответила."""
+    accepted = bool(text) and cascade_accepts(prompt, text, items)
+    LLM_CASCADE.inc(kind=prompt_kind(prompt), outcome="accepted" if accepted else "escalated")
+    return text if accepted else None
+
+
+# ── HTTP-клиенты провайдеров (keep-alive пул) ────────────────────────────────
+class ProviderClient:
+    """Долгоживущий HTTP-клиент одного провайдера с пулом соединений.
+
+    Один экземпляр на процесс: потоки ThreadPoolExecutor делят пул, а после
+    fork (воркеры gunicorn) клиент пересоздаётся — сокеты родителя не наследуются.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        base_url: str,
+        *,
+        pool_size: int,
+        connect_timeout: float,
+        read_timeout: float,
+        headers: dict[str, str] | None = None,
+        http2: bool = False,
+    ):
+        self.name = name
+        self.base_url = base_url
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.http2 = bool(http2 and httpx is not None)
+        if http2 and httpx is None:
+            log.warning("%s: HTTP/2 запрошен, но httpx не установлен — используем HTTP/1.1", name)
+        if self.http2:
+            self._httpx = httpx.Client(
+                http2=True,
+                headers=headers or {},
+                limits=httpx.Limits(
+                    max_connections=pool_size,
+                    max_keepalive_connections=pool_size,
+                ),
+            )
+            self._session = None
+        else:
+            self._httpx = None
+            self._session = requests.Session()
+            self._session.headers.update(headers or {})
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0)
+            self._session.mount("http://", adapter)
+            self._session.mount("https://", adapter)
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        *,
+        json_body: Any = None,
+        read_timeout: float | None = None,
+        stream: bool = False,
+    ):
+        """Запрос к провайдеру; ответ поддерживает .status_code, .text, .json(), .iter_lines(), .close()."""
+        url = f"{self.base_url}{path}"
+        read = read_timeout if read_timeout is not None else self.read_timeout
+        if self._httpx is not None:
+            req = self._httpx.build_request(
+                method, url, json=json_body,
+                timeout=httpx.Timeout(read, connect=self.connect_timeout),
+            )
+            r = self._httpx.send(req, stream=stream)
+            if stream and r.status_code != 200:
+                r.read()
+            return r
+        return self._session.request(
+            method, url, json=json_body,
+            timeout=(self.connect_timeout, read), stream=stream,
+        )
+
+    def close(self) -> None:
+        if self._httpx is not None:
+            self._httpx.close()
+        if self._session is not None:
+            self._session.close()
+
+
+_clients: dict[tuple[str, str], ProviderClient] = {}
+_clients_pid: int | None = None
+_clients_lock = threading.Lock()
+
+
+def _mistral_headers() -> dict[str, str]:
+    return {
+        "Authorization": f"Bearer {CFG.mistral_api_key}",
+        "Content-Type": "application/json",
+    }
+
+
+def _default_base_url(provider: str) -> str:
+    return CFG.mistral_base_url if provider == "mistral" else CFG.ollama_url
+
+
+def _build_client(provider: str, base_url: str) -> ProviderClient:
+    per_host = CFG.mistral_concurrency if provider == "mistral" else CFG.ollama_concurrency
+    pool_size = max(_concurrency_ceiling(per_host), CFG.max_workers, 1) * 2
+    if provider == "mistral":
+        return ProviderClient(
+            "mistral",
+            base_url,
+            pool_size=pool_size,
+            connect_timeout=CFG.connect_timeout,
+            read_timeout=CFG.request_timeout,
+            headers=_mistral_headers(),
+            http2=CFG.mistral_http2,
+        )
+    return ProviderClient(
+        "ollama",
+        base_url,
+        pool_size=pool_size,
+        connect_timeout=CFG.connect_timeout,
+        read_timeout=CFG.request_timeout,
+    )
+
+
+def get_client(provider: str, base_url: str | None = None) -> ProviderClient:
+    """Общий клиент провайдера для текущего процесса (ленивое создание, fork-safe).
+
+    base_url — конкретный хост (по умолчанию первый OLLAMA_URLS / MISTRAL_API_URL).
+    """
+    global _clients_pid
+    pid = os.getpid()
+    key = (provider, base_url or _default_base_url(provider))
+    client = _clients.get(key)
+    if client is not None and _clients_pid == pid:
+        return client
+    with _clients_lock:
+        if _clients_pid != pid:
+            # После fork соединения родителя использовать нельзя — просто забываем их.
+            _clients.clear()
+            _clients_pid = pid
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = _build_client(*key)
+        return client
+
+
+_aclients: dict[tuple[str, str], Any] = {}
+_aclients_loop: asyncio.AbstractEventLoop | None = None
+
+
+def _build_async_client(provider: str, base_url: str):
+    per_host = CFG.mistral_concurrency if provider == "mistral" else CFG.ollama_concurrency
+    pool_size = max(_concurrency_ceiling(per_host), CFG.max_workers, 1) * 2
+    kwargs: dict[str, Any] = {
+        "timeout": httpx.Timeout(CFG.request_timeout, connect=CFG.connect_timeout),
+        "limits": httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+    }
+    if provider == "mistral":
+        return httpx.AsyncClient(
+            base_url=base_url, headers=_mistral_headers(),
+            http2=CFG.mistral_http2, **kwargs,
+        )
+    return httpx.AsyncClient(base_url=base_url, **kwargs)
+
+
+def get_async_client(provider: str, base_url: str | None = None):
+    """httpx.AsyncClient провайдера для ASGI-режима: один на хост и event loop процесса."""
+    global _aclients_loop
+    if httpx is None:
+        raise RuntimeError("ASGI-режим требует httpx (pip install httpx)")
+    loop = asyncio.get_running_loop()
+    if _aclients_loop is not loop:
+        # Клиент привязан к своему loop — в новом (другой воркер, тесты) создаём заново.
+        _aclients.clear()
+        _aclients_loop = loop
+    key = (provider, base_url or _default_base_url(provider))
+    client = _aclients.get(key)
+    if client is None:
+        client = _aclients[key] = _build_async_client(*key)
+    return client
+
+
+async def close_async_clients() -> None:
+    for client in list(_aclients.values()):
+        await client.aclose()
+    _aclients.clear()
+
+
+# ── Бэкенды: балансировка, circuit breaker, health-check ─────────────────────
+class CircuitBreaker:
+    """Предохранитель бэкенда: closed → open после N ошибок подряд → half-open.
+
+    В open запросы на хост не идут. Через VIORA_BREAKER_COOLDOWN (или раньше,
+    если health-check увидел хост живым) пропускается один пробный запрос:
+    успех закрывает предохранитель, ошибка открывает снова.
+    Методы вызываются под замком BackendPool.
+    """
+
+    def __init__(self, *, failures: int, cooldown: float):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.consecutive = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.trips = 0
+
+    def available(self, now: float) -> bool:
+        if self.state == "open" and now - self.opened_at >= self.cooldown:
+            self.half_open()
+        if self.state == "half_open":
+            return not self.probing
+        return self.state == "closed"
+
+    def half_open(self) -> None:
+        self.state, self.probing = "half_open", False
+
+    def trip(self, now: float) -> None:
+        if self.state != "open":
+            self.trips += 1
+        self.state, self.opened_at, self.probing = "open", now, False
+
+    def on_start(self) -> None:
+        if self.state == "half_open":
+            self.probing = True
+
+    def on_abort(self) -> None:
+        # Пробный запрос отменён (проиграл хедж) — пропустить следующий.
+        self.probing = False
+
+    def on_success(self) -> None:
+        self.state, self.consecutive, self.probing = "closed", 0, False
+
+    def on_failure(self, now: float) -> None:
+        self.consecutive += 1
+        if self.state == "half_open" or self.consecutive >= self.failures:
+            self.trip(now)
+
+
+def _concurrency_ceiling(initial: int) -> int:
+    """Потолок адаптивного лимита хоста: VIORA_ADAPTIVE_MAX или вдвое больше заданного."""
+    if not CFG.adaptive_concurrency:
+        return max(1, initial)
+    return max(1, initial, CFG.adaptive_max or 2 * initial)
+
+
+class AdaptiveLimit:
+    """AIMD-лимит одновременных генераций на хосте (как AIMDLimit из Netflix concurrency-limits).
+
+    Перегрузка — таймаут, ответ 429/503 или ответ (у стрима — первый токен)
+    дольше VIORA_ADAPTIVE_LATENCY — умножает лимит на BACKOFF, но не чаще раза
+    за «окно»: запросы, начатые до прошлого снижения, видели старый лимит и
+    снижение не повторяют. Успешный ответ, пока хост загружен хотя бы наполовину,
+    добавляет 1/limit — около +1 за окно. Начальное значение — заданный
+    VIORA_OLLAMA_CONCURRENCY / VIORA_MISTRAL_CONCURRENCY, пределы — 1 и
+    _concurrency_ceiling. Методы вызываются под замком BackendPool.
+    """
+
+    BACKOFF = 0.75
+
+    def __init__(self, initial: int, *, ceiling: int, latency: float, enabled: bool = True):
+        self.enabled = enabled
+        self.ceiling = max(1, initial, ceiling)
+        self.latency = latency
+        self.limit = float(max(1, initial))
+        self.decreased_at = 0.0
+        self.decreases = 0
+
+    @property
+    def value(self) -> int:
+        return max(1, int(self.limit))
+
+    def on_sample(self, started: float, now: float, *, inflight: int, overload: bool, latency: float | None) -> bool:
+        """Итог запроса к хосту; True — целый лимит изменился."""
+        if not self.enabled:
+            return False
+        before = self.value
+        if overload or (latency is not None and latency > self.latency):
+            if started >= self.decreased_at:
+                self.limit = max(1.0, self.limit * self.BACKOFF)
+                self.decreased_at = now
+                self.decreases += 1
+        elif latency is not None and inflight * 2 >= before:
+            self.limit = min(float(self.ceiling), self.limit + 1 / self.limit)
+        return self.value != before
+
+
+class Backend:
+    """Один хост модели: запросы в работе, задержки ответов, предохранитель, лимит."""
+
+    def __init__(self, provider: str, base_url: str, *, capacity: int, overflow: bool = False, routed: bool = False):
+        self.provider = provider
+        self.base_url = base_url
+        self.limiter = AdaptiveLimit(
+            capacity, ceiling=_concurrency_ceiling(capacity), enabled=CFG.adaptive_concurrency,
+            latency=CFG.adaptive_latency or CFG.request_timeout / 2,
+        )
+        self.overflow = overflow
+        self.routed = routed  # хост другого провайдера только для VIORA_MODEL_ROUTES / VIORA_CASCADE
+        self.name = provider if provider == "mistral" else f"ollama@{urlsplit(base_url).netloc or base_url}"
+        self.breaker = CircuitBreaker(failures=CFG.breaker_failures, cooldown=CFG.breaker_cooldown)
+        self.outstanding = 0
+        self.requests_total = 0
+        self.failures_total = 0
+        self.hedges_total = 0
+        self.healthy: bool | None = None
+        self.probe_failures = 0  # неудачных health-check подряд
+        self._latencies: list[float] = []
+
+    def __repr__(self) -> str:
+        return f"<Backend {self.name}>"
+
+    @property
+    def capacity(self) -> int:
+        """Текущий лимит одновременных запросов (адаптивный, см. AdaptiveLimit)."""
+        return self.limiter.value
+
+    def client(self) -> ProviderClient:
+        return get_client(self.provider, self.base_url)
+
+    def async_client(self):
+        return get_async_client(self.provider, self.base_url)
+
+    def p95(self) -> float | None:
+        if len(self._latencies) < 20:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+
+class BackendPool:
+    """Балансировка между хостами Ollama по наименьшему числу запросов в работе.
+
+    Хосты с открытым предохранителем пропускаются. Mistral с VIORA_MISTRAL_OVERFLOW=1
+    получает запросы, только когда все хосты Ollama недоступны или заняты под завязку
+    (лимит VIORA_OLLAMA_CONCURRENCY — на хост). provider в методах — запрос,
+    направленный маршрутом моделей к другому провайдеру: он обслуживается только
+    хостами этого провайдера, а routed-хосты не берут обычные запросы.
+    """
+
+    def __init__(self, backends: list[Backend]):
+        self.backends = backends
+        self._lock = threading.Lock()
+        self.on_resize = None  # fn(провайдер, его лимит) — планировщик провайдера подстраивает число слотов
+
+    @property
+    def capacity(self) -> int:
+        return self.capacity_for(None)
+
+    @property
+    def max_capacity(self) -> int:
+        return sum(b.limiter.ceiling for b in self._serving(None))
+
+    def capacity_for(self, provider: str | None) -> int:
+        return sum(b.capacity for b in self._serving(provider))
+
+    def _serving(self, provider: str | None) -> list[Backend]:
+        if provider is None or provider == CFG.llm_provider:
+            return [b for b in self.backends if not b.routed]
+        return [b for b in self.backends if b.provider == provider]
+
+    def _choose_locked(self, avoid: set[Backend], now: float, provider: str | None) -> Backend | None:
+        up = [b for b in self._serving(provider) if b.breaker.available(now)]
+        fresh = [b for b in up if b not in avoid]
+        for group in (
+            [b for b in fresh if not b.overflow and b.outstanding < b.capacity],
+            [b for b in fresh if b.overflow and b.outstanding < b.capacity],
+            [b for b in fresh if not b.overflow],
+            fresh,
+            up,  # все исправные уже пробовали — повтор на наименее загруженном
+        ):
+            if group:
+                # При равной загрузке — тот, кто обслужил меньше: простые хосты не простаивают.
+                return min(group, key=lambda b: (b.outstanding / b.capacity, b.requests_total))
+        return None
+
+    def _start_locked(self, backend: Backend) -> Backend:
+        backend.breaker.on_start()
+        backend.outstanding += 1
+        backend.requests_total += 1
+        return backend
+
+    def acquire(self, avoid: set[Backend] = frozenset(), provider: str | None = None) -> Backend:
+        """Бэкенд для очередного запроса; после запроса обязательно done()."""
+        HEALTH.ensure_running()
+        with self._lock:
+            backend = self._choose_locked(avoid, time.monotonic(), provider)
+            if backend is None:
+                raise LLMError("Все бэкенды модели недоступны (circuit breaker открыт)")
+            return self._start_locked(backend)
+
+    def acquire_hedge(self, avoid: set[Backend], provider: str | None = None) -> Backend | None:
+        """Хост для дублирующего запроса: только исправный хост Ollama со свободным местом."""
+        with self._lock:
+            spare = [
+                b for b in self._serving(provider)
+                if not b.overflow and b not in avoid
+                and b.breaker.state == "closed" and b.outstanding < b.capacity
+            ]
+            if not spare:
+                return None
+            backend = min(spare, key=lambda b: (b.outstanding / b.capacity, b.requests_total))
+            backend.hedges_total += 1
+            return self._start_locked(backend)
+
+    def hedge_delay(self, backend: Backend, provider: str | None = None) -> float | None:
+        """Через сколько секунд дублировать запрос к backend; None — не дублировать."""
+        if CFG.hedge_after == 0 or sum(1 for b in self._serving(provider) if not b.overflow) < 2:
+            return None
+        if CFG.hedge_after > 0:
+            return CFG.hedge_after
+        with self._lock:
+            return backend.p95()
+
+    def has_untried(self, tried: set[Backend], provider: str | None = None) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            return any(b not in tried and b.breaker.available(now) for b in self._serving(provider))
+
+    def done(
+        self, backend: Backend, started: float, *, failed: bool | None, stream: bool = False,
+        overload: bool = False, ttft: float | None = None,
+    ) -> None:
+        """Итог запроса: failed=None — отменён (не ошибка хоста); p95 для хеджирования — без стримов.
+
+        overload — таймаут или 429/503; ttft — время до первого токена стрима.
+        Оба вместе с задержкой ответа подстраивают адаптивный лимит хоста.
+        """
+        now = time.monotonic()
+        with self._lock:
+            backend.outstanding -= 1
+            before = backend.capacity
+            resized = failed is not None and backend.limiter.on_sample(
+                started, now, inflight=backend.outstanding + 1, overload=overload,
+                latency=(ttft if stream else now - started) if failed is False else None,
+            )
+            provider = backend.provider if backend.routed else CFG.llm_provider
+            total = self.capacity_for(provider)
+            breaker = backend.breaker
+            was = breaker.state
+            if failed is None:
+                if was == "half_open":
+                    breaker.on_abort()
+            elif failed:
+                backend.failures_total += 1
+                breaker.on_failure(now)
+            else:
+                breaker.on_success()
+                if not stream:
+                    backend._latencies.append(now - started)
+                    if len(backend._latencies) > 512:
+                        del backend._latencies[:256]
+            state = breaker.state
+        if failed is False:
+            LLM_GENERATION_SECONDS.observe(now - started, backend=backend.name, mode="stream" if stream else "generate")
+        if resized:
+            log.info("Бэкенд %s: лимит одновременных генераций %d → %d%s", backend.name, before,
+                     backend.capacity, " (перегрузка)" if backend.capacity < before else "")
+            if self.on_resize is not None:
+                self.on_resize(provider, total)
+        if state != was and state == "open":
+            log.warning("Бэкенд %s: circuit breaker открыт на %.0f с", backend.name, breaker.cooldown)
+        elif state != was and state == "closed":
+            log.info("Бэкенд %s снова в строю", backend.name)
+
+    def observe_health(self, backend: Backend, reachable: bool) -> None:
+        """Результат health-check: оживший хост — на пробу, молчащий выключается
+        после VIORA_BREAKER_FAILURES проверок подряд, как и по ошибкам запросов.
+
+        Последний хост, который ещё обслуживает запросы, проверка не выключает:
+        один медленный /api/tags не должен валить все запросы без попытки —
+        решают ошибки самих запросов.
+        """
+        with self._lock:
+            backend.healthy = reachable
+            was = backend.breaker.state
+            backend.probe_failures = 0 if reachable else backend.probe_failures + 1
+            if reachable and was == "open":
+                backend.breaker.half_open()
+            tripped = (
+                not reachable and was != "open"
+                and backend.probe_failures >= backend.breaker.failures
+                and any(
+                    b is not backend and b.breaker.state != "open"
+                    for b in self._serving(backend.provider if backend.routed else None)
+                )
+            )
+            if tripped:
+                backend.breaker.trip(time.monotonic())
+        if tripped:
+            log.warning("Бэкенд %s не отвечает на health-check — выведен из ротации", backend.name)
+
+    def stats(self) -> list[dict[str, Any]]:
+        with self._lock:
+            result = []
+            for b in self.backends:
+                p95 = b.p95()
+                result.append({
+                    "name": b.name,
+                    "url": b.base_url,
+                    "overflow": b.overflow,
+                    "routed": b.routed,
+                    "state": b.breaker.state,
+                    "healthy": b.healthy,
+                    "outstanding": b.outstanding,
+                    "capacity": b.capacity,
+                    "capacity_max": b.limiter.ceiling,
+                    "limit_decreases": b.limiter.decreases,
+                    "requests": b.requests_total,
+                    "failures": b.failures_total,
+                    "hedges": b.hedges_total,
+                    "breaker_trips": b.breaker.trips,
+                    "latency_p95": round(p95, 3) if p95 is not None else None,
+                })
+            return result
+
+
+def _build_backends() -> BackendPool:
+    if CFG.llm_provider == "mistral":
+        backends = [Backend("mistral", CFG.mistral_base_url, capacity=CFG.mistral_concurrency)]
+    else:
+        backends = [Backend("ollama", url, capacity=CFG.ollama_concurrency) for url in CFG.ollama_urls]
+        if CFG.mistral_overflow and CFG.mistral_api_key:
+            backends.append(Backend("mistral", CFG.mistral_base_url, capacity=CFG.mistral_concurrency, overflow=True))
+    # Маршрут к другому провайдеру — его хосты, только для таких запросов (overflow-Mistral годится и так).
+    routed = {r.provider for r in (*CFG.model_routes.values(), *CFG.cascade.values())}
+    present = {b.provider for b in backends}
+    if "ollama" in routed - present:
+        backends += [Backend("ollama", url, capacity=CFG.ollama_concurrency, routed=True) for url in CFG.ollama_urls]
+    if "mistral" in routed - present:
+        backends.append(Backend("mistral", CFG.mistral_base_url, capacity=CFG.mistral_concurrency, routed=True))
+    return BackendPool(backends)
+
+
+BACKENDS = _build_backends()
+
+
+# ── Отмена: клиент ушёл — работа по запросу прекращается ─────────────────────
+_CANCEL_POLL = 0.5  # как часто проверяются сокеты клиентов и флаги отмены задач
+
+
+class RequestCancelled(BaseException):
+    """Результат больше никому не нужен: клиент закрыл соединение или задачу отменили.
+
+    Как asyncio.CancelledError — наследник BaseException: обработчики
+    `except Exception` не превращают отмену в ошибку модели, ретрай или
+    сбой хоста в circuit breaker.
+    """
+
+
+class CancelToken:
+    """Флаг отмены одного запроса для потокового кода.
+
+    cancel() выставляет флаг и вызывает подписанные колбэки: они будят ожидание
+    слота или single-flight и обрывают чтение ответа провайдера.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: list = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self) -> None:
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception:
+                log.exception("cancel callback failed")
+
+    def check(self) -> None:
+        if self._event.is_set():
+            raise RequestCancelled()
+
+    def sleep(self, seconds: float) -> None:
+        """time.sleep, прерываемый отменой."""
+        if self._event.wait(seconds):
+            raise RequestCancelled()
+
+    @contextmanager
+    def on_cancel(self, fn):
+        """fn() при отмене, пока открыт блок; если токен уже отменён — сразу."""
+        with self._lock:
+            registered = not self._event.is_set()
+            if registered:
+                self._callbacks.append(fn)
+        if not registered:
+            fn()
+        try:
+            yield
+        finally:
+            with self._lock:
+                if fn in self._callbacks:
+                    self._callbacks.remove(fn)
+
+
+def _sleep(seconds: float, cancel: CancelToken | None) -> None:
+    if cancel is None:
+        time.sleep(seconds)
+    else:
+        cancel.sleep(seconds)
+
+
+def _future_result(fut: Future, cancel: CancelToken | None) -> Any:
+    """fut.result(), прерываемый отменой."""
+    if cancel is not None and not fut.done():
+        finished = threading.Event()
+        fut.add_done_callback(lambda _: finished.set())
+        with cancel.on_cancel(finished.set):
+            finished.wait()
+        cancel.check()
+    return fut.result()
+
+
+def _socket_closed(sock: socket.socket) -> bool:
+    """Клиент закрыл соединение: неблокирующий MSG_PEEK видит EOF (или сброс).
+
+    Данных нет — BlockingIOError, клиент жив; сами данные не вычитываются.
+    """
+    try:
+        if sock.fileno() < 0:
+            return True
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+    except (BlockingIOError, InterruptedError):
+        return False
+    except ValueError:
+        return False  # TLS-сокет: recv с флагами не поддерживается — считаем клиента живым
+    except OSError:
+        return True
+
+
+class CancelMonitor:
+    """Фоновый поток, раз в interval проверяющий условия отмены токенов.
+
+    Во Flask-режиме WSGI-сервер не сообщает об обрыве, пока ответ не пишется, —
+    поэтому закрытие сокета клиента замечает монитор. Тот же поток ловит отмену
+    задачи из другого воркера (флаг в базе JobStore). Сработавший токен
+    отменяется и снимается с наблюдения.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._watched: dict[CancelToken, Any] = {}
+        self._pid: int | None = None
+
+    def watch(self, token: CancelToken, gone) -> None:
+        """gone() → True, когда работа больше не нужна; вызывается из потока монитора."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._watched = {}
+                threading.Thread(target=self._loop, name="viora-cancel", daemon=True).start()
+            self._watched[token] = gone
+            self._changed.notify()
+
+    def unwatch(self, token: CancelToken) -> None:
+        with self._lock:
+            self._watched.pop(token, None)
+
+    def _loop(self) -> None:
+        while True:
+            with self._lock:
+                while not self._watched:
+                    self._changed.wait()
+                watched = list(self._watched.items())
+            for token, gone in watched:
+                try:
+                    hit = gone()
+                except Exception:
+                    log.exception("cancel check failed")
+                    hit = False
+                if hit:
+                    self.unwatch(token)
+                    token.cancel()
+            time.sleep(self.interval)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {"watched": len(self._watched)}
+
+
+CANCELS = CancelMonitor(_CANCEL_POLL)
+
+
+def _request_cancel() -> CancelToken:
+    """Токен отмены текущего Flask-запроса.
+
+    Монитор следит за сокетом клиента (gunicorn и werkzeug кладут его в environ);
+    после отправки ответа — или обрыва SSE-потока — токен отменяется и снимается
+    с наблюдения (см. _release_request_cancel).
+    """
+    token = g.get("viora_cancel")
+    if token is not None:
+        return token
+    token = g.viora_cancel = CancelToken()
+    sock = request.environ.get("gunicorn.socket") or request.environ.get("werkzeug.socket")
+    if CFG.cancel_on_disconnect and isinstance(sock, socket.socket):
+        route = request.url_rule.rule if request.url_rule is not None else request.path
+
+        def gone() -> bool:
+            if not _socket_closed(sock):
+                return False
+            CLIENT_DISCONNECTS.inc(route=route)
+            log.info("client disconnected: %s — отменяем работу", route)
+            return True
+
+        CANCELS.watch(token, gone)
+    return token
+
+
+def _finish_cancel(token: CancelToken) -> None:
+    CANCELS.unwatch(token)
+    token.cancel()
+
+
+@app.after_request
+def _release_request_cancel(resp: Response) -> Response:
+    # after_request у SSE срабатывает до начала потока — отменяем по закрытию ответа.
+    token = g.pop("viora_cancel", None)
+    if token is not None:
+        resp.call_on_close(functools.partial(_finish_cancel, token))
+    return resp
+
+
+def _client_gone() -> Response:
+    """Ответ, который клиент уже не прочтёт: 499 (nginx «client closed request») — для метрик и логов."""
+    return Response(status=499)
+
+
+# ── Кэш ответов ИИ (LRU в памяти + SQLite на диске) ──────────────────────────
+class ResponseCache:
+    """Контентно-адресуемый кэш ответов модели.
+
+    Ключ — провайдер, модель, температура и sha256 промпта. Память: LRU с TTL
+    и лимитом по байтам. Диск (если задан path): SQLite в WAL-режиме, который
+    безопасно делят несколько воркеров gunicorn.
+    """
+
+    def __init__(self, *, ttl: int, max_bytes: int, path: str = ""):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.path = path
+        self._mem: OrderedDict[str, tuple[float, str, int]] = OrderedDict()
+        self._mem_bytes = 0
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        self._db_pid: int | None = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypasses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_bytes > 0
+
+    @staticmethod
+    def make_key(provider: str, model: str, temperature: float, prompt: str, options: Any = None) -> str:
+        """options — прочие параметры генерации (JSON-сериализуемые), хешируются вместе с промптом."""
+        digest = hashlib.sha256(prompt.encode("utf-8"))
+        if options is not None:
+            digest.update(json.dumps(options, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        return f"{provider}:{model}:{temperature:.3f}:{digest.hexdigest()}"
+
+    def _conn(self) -> sqlite3.Connection | None:
+        # Вызывается под self._lock. Соединение на процесс: после fork открываем заново.
+        if not self.path:
+            return None
+        pid = os.getpid()
+        if self._db is None or self._db_pid != pid:
+            db = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, size INTEGER NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS llm_cache_created ON llm_cache(created)")
+            self._db, self._db_pid = db, pid
+        return self._db
+
+    def _mem_put(self, key: str, created: float, value: str) -> None:
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._mem_bytes -= old[2]
+        self._mem[key] = (created, value, size)
+        self._mem_bytes += size
+        while self._mem_bytes > self.max_bytes and self._mem:
+            _, (_, _, evicted) = self._mem.popitem(last=False)
+            self._mem_bytes -= evicted
+
+    def get(self, key: str, *, count: bool = True) -> str | None:
+        """count=False — служебная проверка, не влияет на счётчики hit/miss."""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is not None:
+                created, value, size = entry
+                if now - created <= self.ttl:
+                    self._mem.move_to_end(key)
+                    self.hits += count
+                    return value
+                del self._mem[key]
+                self._mem_bytes -= size
+            try:
+                db = self._conn()
+                row = db.execute(
+                    "SELECT value, created FROM llm_cache WHERE key = ? AND created >= ?",
+                    (key, now - self.ttl),
+                ).fetchone() if db else None
+            except sqlite3.Error as e:
+                log.warning("cache: чтение с диска не удалось: %s", e)
+                row = None
+            if row is not None:
+                self._mem_put(key, row[1], row[0])
+                self.hits += count
+                self.disk_hits += count
+                return row[0]
+            self.misses += count
+            return None
+
+    def put(self, key: str, value: str) -> None:
+        if not self.enabled or not value:
+            return
+        now = time.time()
+        with self._lock:
+            self._mem_put(key, now, value)
+            try:
+                db = self._conn()
+                if db is None:
+                    return
+                db.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, value, created, size) VALUES (?, ?, ?, ?)",
+                    (key, value, now, len(value.encode("utf-8"))),
+                )
+                db.execute("DELETE FROM llm_cache WHERE created < ?", (now - self.ttl,))
+                total = db.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+                if total > self.max_bytes:
+                    # Вытесняем самые старые записи, пока не уложимся в лимит.
+                    db.execute(
+                        "DELETE FROM llm_cache WHERE key IN ("
+                        " SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY created DESC) AS acc"
+                        " FROM llm_cache) WHERE acc > ?)",
+                        (self.max_bytes,),
+                    )
+            except sqlite3.Error as e:
+                log.warning("cache: запись на диск не удалась: %s", e)
+
+    def note_bypass(self) -> None:
+        with self._lock:
+            self.bypasses += 1
+
+    def note_hit(self) -> None:
+        """Попадание, найденное служебной проверкой get(count=False)."""
+        with self._lock:
+            self.hits += 1
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "disk": bool(self.path),
+                "entries": len(self._mem),
+                "bytes": self._mem_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "bypasses": self.bypasses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+            }
+
+
+RESPONSE_CACHE = ResponseCache(ttl=CFG.cache_ttl, max_bytes=CFG.cache_max_bytes, path=CFG.cache_path)
+
+
+class _StreamFeed:
+    """События стрима лидера SingleFlight.stream/astream.
+
+    Присоединившиеся читают их с начала и дальше по мере появления; после
+    close() — итог (outcome) или ошибку лидера.
+    """
+
+    def __init__(self):
+        self.events: list[tuple[str, Any]] = []
+        self.closed = False
+        self.outcome: Any = None
+        self.error: BaseException | None = None
+        self._cond = threading.Condition()
+        self._changed: asyncio.Event | None = None  # для astream: будит ожидающих в loop
+
+    def push(self, event: tuple[str, Any]) -> None:
+        with self._cond:
+            self.events.append(event)
+            self._cond.notify_all()
+        if self._changed is not None:
+            self._changed.set()
+
+    def close(self, outcome: Any = None, error: BaseException | None = None) -> None:
+        with self._cond:
+            self.closed, self.outcome, self.error = True, outcome, error
+            self._cond.notify_all()
+        if self._changed is not None:
+            self._changed.set()
+
+    def _wake(self) -> None:
+        with self._cond:
+            self._cond.notify_all()
+
+    def follow(self, cancel: CancelToken | None) -> Generator[tuple[str, Any], None, Any]:
+        seen = 0
+        with cancel.on_cancel(self._wake) if cancel is not None else nullcontext():
+            while True:
+                with self._cond:
+                    while seen == len(self.events) and not self.closed:
+                        if cancel is not None:
+                            cancel.check()
+                        self._cond.wait()
+                    batch, done = self.events[seen:], self.closed
+                seen += len(batch)
+                yield from batch
+                if done:
+                    if self.error is not None:
+                        raise self.error
+                    return self.outcome
+
+    async def afollow(self) -> AsyncGenerator[tuple[str, Any], None]:
+        seen = 0
+        while True:
+            while seen == len(self.events) and not self.closed:
+                if self._changed is None or self._changed.is_set():
+                    self._changed = asyncio.Event()
+                await self._changed.wait()
+            batch, done = self.events[seen:], self.closed
+            seen += len(batch)
+            for event in batch:
+                yield event
+            if done:
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class SingleFlight:
+    """Склейка одновременных одинаковых генераций.
+
+    Первый вызов с ключом выполняет работу, остальные ждут его Future и
+    получают тот же результат (или ту же ошибку). Если задан lock_dir,
+    лидер дополнительно берёт flock на файл ключа — так воркеры gunicorn
+    ждут друг друга, а второй затем находит ответ в дисковом кэше. Чужой
+    flock ждём не дольше lock_wait секунд (и не дольше, чем нужен клиенту),
+    потом генерируем без склейки.
+    """
+
+    _LOCK_POLL = 0.05
+
+    def __init__(self, lock_dir: str = "", lock_wait: float = 90.0):
+        self.lock_dir = lock_dir if fcntl is not None else ""
+        self.lock_wait = lock_wait
+        if lock_dir and fcntl is None:
+            log.warning("single-flight: fcntl недоступен — склейка только внутри процесса")
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+        self._calls: dict[str, Future] = {}
+        self._acalls: dict[str, asyncio.Future] = {}
+        self._feeds: dict[str, _StreamFeed] = {}
+        self._afeeds: dict[str, _StreamFeed] = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    @property
+    def cross_process(self) -> bool:
+        return bool(self.lock_dir)
+
+    def do(self, key: str, fn, cancel: CancelToken | None = None) -> Any:
+        """cancel прерывает ожидание чужого результата; отмена лидера не роняет
+        остальных — работу берёт на себя следующий ожидающий."""
+        while True:
+            with self._lock:
+                fut = self._calls.get(key)
+                if fut is None:
+                    fut = self._calls[key] = Future()
+                    break
+                self.coalesced += 1
+            try:
+                return _future_result(fut, cancel)
+            except RequestCancelled:
+                if cancel is not None and cancel.cancelled:
+                    raise
+        try:
+            result = self._run_locked(key, fn, cancel)
+        except BaseException as e:
+            # Ключ убираем до публикации: ожидающий, проснувшись после отмены
+            # лидера, должен стать новым лидером, а не найти тот же Future.
+            self._forget(key)
+            fut.set_exception(e)
+            raise
+        self._forget(key)
+        fut.set_result(result)
+        return result
+
+    def _forget(self, key: str) -> None:
+        with self._lock:
+            self._calls.pop(key, None)
+
+    async def ado(self, key: str, fn) -> Any:
+        """То же для ASGI-режима: fn — корутинная функция, ожидание не занимает поток."""
+        while (fut := self._acalls.get(key)) is not None:
+            self.coalesced += 1
+            try:
+                # shield: отмена одного ожидающего не должна отменять работу лидера.
+                return await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                if not fut.cancelled():
+                    raise
+                # Отменили лидера (клиент ушёл) — работу берёт на себя следующий.
+        fut = self._acalls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await self._arun_locked(key, fn)
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                fut.cancel()
+            else:
+                fut.set_exception(e)
+                fut.exception()  # без ожидающих исключение не должно попасть в лог loop'а
+            raise
+        else:
+            fut.set_result(result)
+            return result
+        finally:
+            self._acalls.pop(key, None)
+
+    def stream(
+        self, key: str, fn, cancel: CancelToken | None = None, reset: tuple[str, Any] | None = None,
+    ) -> Generator[tuple[str, Any], None, Any]:
+        """do() для стримов: fn() — генератор событий, его return-значение — итог.
+
+        Одинаковый одновременный запрос не запускает вторую генерацию, а получает
+        события лидера с начала и дальше по мере появления. Если лидера отменили,
+        работу берёт следующий; уже показанное он сбрасывает событием reset.
+        """
+        while True:
+            with self._lock:
+                feed = self._feeds.get(key)
+                if feed is None:
+                    feed = self._feeds[key] = _StreamFeed()
+                    break
+                self.coalesced += 1
+            try:
+                return (yield from feed.follow(cancel))
+            except RequestCancelled:
+                if cancel is not None and cancel.cancelled:
+                    raise
+            if feed.events and reset is not None:
+                yield reset
+        events = self._stream_locked(key, fn, cancel)
+        try:
+            while True:
+                try:
+                    event = next(events)
+                except StopIteration as stop:
+                    outcome = stop.value
+                    break
+                feed.push(event)
+                yield event
+        except BaseException as e:
+            # Как в do(): ключ убираем до публикации, чтобы ожидающий стал новым лидером.
+            self._forget_feed(self._feeds, key)
+            feed.close(error=e if isinstance(e, Exception) else RequestCancelled())
+            events.close()
+            raise
+        self._forget_feed(self._feeds, key)
+        feed.close(outcome)
+        return outcome
+
+    async def astream(
+        self, key: str, fn, reset: tuple[str, Any] | None = None,
+    ) -> AsyncGenerator[tuple[str, Any], None]:
+        """stream() для ASGI-режима: fn() — async-генератор событий, итог — в его последнем событии."""
+        while (feed := self._afeeds.get(key)) is not None:
+            self.coalesced += 1
+            try:
+                async with aclosing(feed.afollow()) as events:
+                    async for event in events:
+                        yield event
+                return
+            except RequestCancelled:
+                # Лидера отменили (клиент ушёл) — работу берёт на себя следующий.
+                if feed.events and reset is not None:
+                    yield reset
+        feed = self._afeeds[key] = _StreamFeed()
+        try:
+            async with aclosing(self._astream_locked(key, fn)) as events:
+                async for event in events:
+                    feed.push(event)
+                    yield event
+        except BaseException as e:
+            self._forget_feed(self._afeeds, key)
+            feed.close(error=e if isinstance(e, Exception) else RequestCancelled())
+            raise
+        self._forget_feed(self._afeeds, key)
+        feed.close()
+
+    def _forget_feed(self, feeds: dict[str, _StreamFeed], key: str) -> None:
+        with self._lock:
+            feeds.pop(key, None)
+
+    def _lock_path(self, key: str) -> str:
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.lock_dir, f"{name}.lock")
+
+    def _try_flock(self, fh) -> bool:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def _flock(self, fh, cancel: CancelToken | None) -> bool:
+        """Ждёт flock опросом: между попытками проверяет отмену. False — не дождались
+        за lock_wait (лидер в другом воркере завис или генерирует слишком долго)."""
+        deadline = time.monotonic() + self.lock_wait
+        while not self._try_flock(fh):
+            if time.monotonic() >= deadline:
+                log.warning("single-flight: flock ждали дольше %g с — генерация без склейки", self.lock_wait)
+                return False
+            _sleep(self._LOCK_POLL, cancel)  # при отмене бросает RequestCancelled
+        return True
+
+    async def _aflock(self, fh) -> bool:
+        """_flock для корутин: опрос через asyncio.sleep, отмена — обычный CancelledError."""
+        deadline = time.monotonic() + self.lock_wait
+        while not self._try_flock(fh):
+            if time.monotonic() >= deadline:
+                log.warning("single-flight: flock ждали дольше %g с — генерация без склейки", self.lock_wait)
+                return False
+            await asyncio.sleep(self._LOCK_POLL)
+        return True
+
+    def _run_locked(self, key: str, fn, cancel: CancelToken | None = None) -> Any:
+        if not self.lock_dir:
+            return fn()
+        with open(self._lock_path(key), "a") as fh:
+            if not self._flock(fh, cancel):
+                return fn()
+            try:
+                return fn()
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    async def _arun_locked(self, key: str, fn) -> Any:
+        if not self.lock_dir:
+            return await fn()
+        with open(self._lock_path(key), "a") as fh:
+            if not await self._aflock(fh):
+                return await fn()
+            try:
+                return await fn()
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def _stream_locked(
+        self, key: str, fn, cancel: CancelToken | None = None,
+    ) -> Generator[tuple[str, Any], None, Any]:
+        if not self.lock_dir:
+            return (yield from fn())
+        with open(self._lock_path(key), "a") as fh:
+            if not self._flock(fh, cancel):
+                return (yield from fn())
+            try:
+                return (yield from fn())
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    async def _astream_locked(self, key: str, fn) -> AsyncGenerator[tuple[str, Any], None]:
+        if not self.lock_dir:
+            async with aclosing(fn()) as events:
+                async for event in events:
+                    yield event
+            return
+        with open(self._lock_path(key), "a") as fh:
+            locked = await self._aflock(fh)
+            try:
+                async with aclosing(fn()) as events:
+                    async for event in events:
+                        yield event
+            finally:
+                if locked:
+                    fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "inflight": len(self._calls) + len(self._acalls) + len(self._feeds) + len(self._afeeds),
+                "coalesced": self.coalesced,
+                "cross_process": self.cross_process,
+            }
+
+
+SINGLE_FLIGHT = SingleFlight(CFG.singleflight_dir, CFG.singleflight_wait)
+
+
+# ── Фоновые задачи (jobs): статус и журнал событий ───────────────────────────
+_JOB_FINAL_EVENTS = {"done": "done", "cancelled": "cancelled", "error": "failed"}
+
+
+class JobStore:
+    """Фоновые задачи и их события с порядковыми номерами (id для SSE).
+
+    Хранилище — SQLite: в памяти процесса или файл (path) в WAL-режиме, тогда
+    статус и события видят все воркеры gunicorn (по умолчанию — файл, см.
+    _jobs_path). Выполняется задача в том процессе, где её создали; отмена из
+    другого воркера — через флаг в базе, который раннер периодически проверяет.
+    Записи старше ttl (по последнему событию) удаляются.
+    """
+
+    def __init__(self, *, ttl: int, path: str = ""):
+        self.ttl = ttl
+        self.path = path
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._db: sqlite3.Connection | None = None
+        self._db_pid: int | None = None
+        self._cancels: dict[str, Any] = {}  # job_id → отмена задачи, идущей в этом процессе
+        self._async_waiters: dict[str, set[tuple[asyncio.AbstractEventLoop, asyncio.Event]]] = {}
+        self._purged = 0.0
+        self.created = 0
+        self.cancelled = 0
+
+    def _conn(self) -> sqlite3.Connection:
+        # Вызывается под self._lock. Соединение на процесс: после fork открываем заново.
+        pid = os.getpid()
+        if self._db is None or self._db_pid != pid:
+            if self.path:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.path or ":memory:", timeout=5, check_same_thread=False, isolation_level=None)
+            if self.path:
+                db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL, total INTEGER NOT NULL, "
+                "completed INTEGER NOT NULL DEFAULT 0, last_event INTEGER NOT NULL DEFAULT 0, "
+                "cancel INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS job_events ("
+                "job_id TEXT NOT NULL, seq INTEGER NOT NULL, event TEXT NOT NULL, data TEXT NOT NULL, "
+                "PRIMARY KEY (job_id, seq))"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_updated ON jobs(updated)")
+            self._db, self._db_pid, self._cancels = db, pid, {}
+        return self._db
+
+    def _purge(self, db: sqlite3.Connection, now: float) -> None:
+        if now - self._purged < 60:
+            return
+        self._purged = now
+        expired = [row[0] for row in db.execute("SELECT id FROM jobs WHERE updated < ?", (now - self.ttl,))]
+        for job_id in expired:
+            db.execute("DELETE FROM job_events WHERE job_id = ?", (job_id,))
+            db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def create(self, kind: str, total: int, cancel) -> str:
+        """Новая задача в статусе running; cancel() останавливает её в этом процессе."""
+        job_id = secrets.token_urlsafe(16)
+        now = time.time()
+        with self._lock:
+            db = self._conn()
+            self._purge(db, now)
+            db.execute(
+                "INSERT INTO jobs (id, kind, status, total, created, updated) VALUES (?, ?, 'running', ?, ?, ?)",
+                (job_id, kind, total, now, now),
+            )
+            self._cancels[job_id] = cancel
+            self.created += 1
+        return job_id
+
+    def add_event(self, job_id: str, event: str, payload: Any) -> int:
+        """Дописывает событие; done/cancelled/error завершают задачу. 0 — задачи уже нет."""
+        data = json.dumps(payload, ensure_ascii=False)
+        status = _JOB_FINAL_EVENTS.get(event)
+        with self._changed:
+            db = self._conn()
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                row = db.execute("SELECT last_event, status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                if row is None or row[1] != "running":
+                    db.execute("ROLLBACK")
+                    return 0
+                seq = row[0] + 1
+                db.execute("INSERT INTO job_events (job_id, seq, event, data) VALUES (?, ?, ?, ?)",
+                           (job_id, seq, event, data))
+                db.execute(
+                    "UPDATE jobs SET last_event = ?, updated = ?, completed = completed + ?, "
+                    "status = COALESCE(?, status) WHERE id = ?",
+                    (seq, time.time(), event == "result", status, job_id),
+                )
+                db.execute("COMMIT")
+            except sqlite3.Error:
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+                raise
+            if status is not None:
+                self._cancels.pop(job_id, None)
+            self._changed.notify_all()
+            for loop, woken in self._async_waiters.pop(job_id, ()):
+                loop.call_soon_threadsafe(woken.set)
+            return seq
+
+    def get(self, job_id: str) -> dict[str, Any] | None:
+        with self._lock:
+            row = self._conn().execute(
+                "SELECT kind, status, total, completed, last_event, created, updated FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        kind, status, total, completed, last_event, created, updated = row
+        return {
+            "job_id": job_id, "kind": kind, "status": status, "total": total, "completed": completed,
+            "last_event_id": last_event, "created": created, "updated": updated,
+        }
+
+    def events(self, job_id: str, after: int = 0) -> list[tuple[int, str, str]]:
+        """(seq, event, data JSON) с номером больше after."""
+        with self._lock:
+            return self._conn().execute(
+                "SELECT seq, event, data FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq",
+                (job_id, after),
+            ).fetchall()
+
+    def wait(self, job_id: str, after: int, timeout: float) -> bool:
+        """Ждёт события после after: локальные будят сразу, чужие (другой воркер) — по таймауту.
+
+        False — задачи больше нет.
+        """
+        with self._changed:
+            row = self._conn().execute("SELECT last_event FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return False
+            if row[0] <= after:
+                self._changed.wait(timeout)
+            return True
+
+    async def await_events(self, job_id: str, after: int, timeout: float) -> bool:
+        """wait() для корутин: не занимает поток, будится из add_event.
+
+        С файлом базы self._lock может ждать чужую запись (до таймаута SQLite),
+        поэтому и проверка, и снятие ожидания идут в потоке, а не в цикле событий.
+        """
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        state = await _jobs_call(self._add_async_waiter, job_id, after, waiter)
+        if state is not None:
+            return state
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            await _jobs_call(self._drop_async_waiter, job_id, waiter)
+        return True
+
+    def _add_async_waiter(self, job_id: str, after: int, waiter) -> bool | None:
+        """False — задачи нет, True — события уже есть, None — ожидание поставлено."""
+        with self._lock:
+            row = self._conn().execute("SELECT last_event FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return False
+            if row[0] > after:
+                return True
+            self._async_waiters.setdefault(job_id, set()).add(waiter)
+            return None
+
+    def _drop_async_waiter(self, job_id: str, waiter) -> None:
+        with self._lock:
+            waiters = self._async_waiters.get(job_id)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._async_waiters[job_id]
+
+    def request_cancel(self, job_id: str) -> dict[str, Any] | None:
+        """Просит остановить задачу; None — такой задачи нет."""
+        with self._lock:
+            db = self._conn()
+            db.execute("UPDATE jobs SET cancel = 1 WHERE id = ? AND status = 'running'", (job_id,))
+            cancel = self._cancels.get(job_id)
+        if cancel is not None:
+            cancel()
+        return self.get(job_id)
+
+    def cancel_requested(self, job_id: str) -> bool:
+        with self._lock:
+            row = self._conn().execute("SELECT cancel FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row is None or bool(row[0])
+
+    def finish_cancelled(self, job_id: str) -> None:
+        if self.add_event(job_id, "cancelled", {}):
+            with self._lock:
+                self.cancelled += 1
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            counts = dict(self._conn().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            return {
+                "disk": bool(self.path),
+                "running_here": len(self._cancels),
+                "by_status": counts,
+                "created": self.created,
+                "cancelled": self.cancelled,
+            }
+
+
+JOBS = JobStore(ttl=CFG.job_ttl, path=CFG.jobs_path)
+
+
+# ── Планировщик: общий лимит запросов к провайдеру с честной очередью ────────
+PRIORITY_INTERACTIVE = 0  # flow: пользователь ждёт ответа на клик
+PRIORITY_BATCH = 1        # life: пакетный анализ исходов
+PRIORITY_SPECULATIVE = 2  # flow: заранее готовим ответ — только на свободный слот, без очереди
+
+
+class QueueFullError(Exception):
+    """Очередь к провайдеру переполнена — клиенту нужно повторить позже (HTTP 429)."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    """Ожидающий слота: поток (threading.Event) или корутина (asyncio.Future своего loop)."""
+
+    __slots__ = ("event", "future", "loop", "enqueued", "granted")
+
+    def __init__(self, loop: asyncio.AbstractEventLoop | None = None):
+        self.loop = loop
+        self.event = threading.Event() if loop is None else None
+        self.future = loop.create_future() if loop is not None else None
+        self.enqueued = time.monotonic()
+        self.granted = False
+
+    def wake(self) -> None:
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve_future, self.future)
+
+
+def _resolve_future(fut: asyncio.Future) -> None:
+    if not fut.done():
+        fut.set_result(None)
+
+
+class LLMScheduler:
+    """Глобальный (на процесс) лимит одновременных генераций у одного провайдера.
+
+    Слоты выдаются по приоритету, а внутри приоритета — по кругу между клиентами,
+    поэтому пакет из 15 исходов одного пользователя не блокирует одиночный
+    запрос flow другого. Слот занимает только реальный поход к модели:
+    попадания в кэш и ожидающие single-flight очередь не расходуют.
+    """
+
+    def __init__(self, name: str, *, concurrency: int, max_queue: int):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max(0, max_queue)
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queued = 0
+        # priority -> client -> очередь ожидающих; порядок клиентов = round-robin.
+        self._waiters: dict[int, OrderedDict[str, list[_Waiter]]] = {}
+        self._service_ewma = 5.0
+        self._waits: list[float] = []
+        self.granted_total = 0
+        self.rejected_total = 0
+        self.wait_max = 0.0
+        # Вызывается, когда запрос встал в очередь: спекулятивная работа уступает слот.
+        self.on_contention = None
+
+    def retry_after(self) -> int:
+        with self._lock:
+            return self._retry_after_locked()
+
+    def _retry_after_locked(self) -> int:
+        rounds = (self._queued // self.concurrency) + 1
+        return max(1, int(rounds * self._service_ewma + 0.5))
+
+    def admit(self, n: int = 1) -> None:
+        """Проверка перед постановкой n задач: бросает QueueFullError, если они не влезут."""
+        with self._lock:
+            free = self.concurrency - self._active
+            if self._queued + max(0, n - free) > self.max_queue:
+                self.rejected_total += 1
+                raise QueueFullError(
+                    f"Очередь к {self.name} переполнена ({self._queued}/{self.max_queue})",
+                    self._retry_after_locked(),
+                )
+
+    def idle(self) -> bool:
+        """Есть свободный слот и никто не ждёт."""
+        with self._lock:
+            return self._active < self.concurrency and not self._queued
+
+    def _enqueue_locked(self, client: str, priority: int, loop=None) -> _Waiter | None:
+        """Свободный слот — занимает и возвращает None, иначе ставит ожидающего в очередь."""
+        if self._active < self.concurrency and not self._queued:
+            self._active += 1
+            self._record_wait_locked(0.0)
+            return None
+        if priority >= PRIORITY_SPECULATIVE:
+            raise QueueFullError(f"Нет свободных слотов {self.name} для спекулятивной генерации",
+                                 self._retry_after_locked())
+        if self._queued >= self.max_queue:
+            self.rejected_total += 1
+            raise QueueFullError(
+                f"Очередь к {self.name} переполнена ({self._queued}/{self.max_queue})",
+                self._retry_after_locked(),
+            )
+        waiter = _Waiter(loop)
+        self._waiters.setdefault(priority, OrderedDict()).setdefault(client, []).append(waiter)
+        self._queued += 1
+        return waiter
+
+    def acquire(self, *, client: str, priority: int, cancel: CancelToken | None = None) -> float:
+        """Ждёт слот; возвращает время ожидания в очереди (сек).
+
+        Отмена cancel снимает ожидающего с очереди (RequestCancelled).
+        """
+        if cancel is not None:
+            cancel.check()
+        with self._lock:
+            waiter = self._enqueue_locked(client, priority)
+        if waiter is None:
+            return 0.0
+        self._contended()
+        if cancel is None:
+            waiter.event.wait()
+        else:
+            with cancel.on_cancel(waiter.event.set):
+                waiter.event.wait()
+            if cancel.cancelled:
+                with self._lock:
+                    granted = waiter.granted
+                    if not granted:
+                        self._drop_waiter_locked(waiter, client, priority)
+                if granted:
+                    self.release()
+                raise RequestCancelled()
+        waited = time.monotonic() - waiter.enqueued
+        with self._lock:
+            self._record_wait_locked(waited)
+        return waited
+
+    async def acquire_async(self, *, client: str, priority: int) -> float:
+        """acquire для ASGI-режима: ожидание в очереди не занимает поток."""
+        with self._lock:
+            waiter = self._enqueue_locked(client, priority, asyncio.get_running_loop())
+        if waiter is None:
+            return 0.0
+        self._contended()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                granted = waiter.granted
+                if not granted:
+                    self._drop_waiter_locked(waiter, client, priority)
+            if granted:
+                # Слот успели выдать, пока задачу отменяли, — возвращаем его.
+                self.release()
+            raise
+        waited = time.monotonic() - waiter.enqueued
+        with self._lock:
+            self._record_wait_locked(waited)
+        return waited
+
+    def _contended(self) -> None:
+        if self.on_contention is not None:
+            try:
+                self.on_contention()
+            except Exception:
+                log.exception("on_contention failed")
+
+    def release(self, service_time: float | None = None) -> None:
+        with self._lock:
+            if service_time is not None:
+                self._service_ewma = 0.8 * self._service_ewma + 0.2 * service_time
+            self._active -= 1
+            self._grant_locked()
+
+    def resize(self, concurrency: int) -> None:
+        """Новое число слотов (адаптивный лимит хостов). При уменьшении лишние
+        генерации дорабатывают, новые слоты не выдаются до освобождения."""
+        with self._lock:
+            self.concurrency = max(1, concurrency)
+            self._grant_locked()
+
+    def _grant_locked(self) -> None:
+        while self._active < self.concurrency:
+            waiter = self._next_waiter_locked()
+            if waiter is None:
+                return
+            self._active += 1
+            waiter.wake()
+
+    def _next_waiter_locked(self) -> _Waiter | None:
+        for priority in sorted(self._waiters):
+            clients = self._waiters[priority]
+            while clients:
+                client, queue = next(iter(clients.items()))
+                waiter = queue.pop(0)
+                if queue:
+                    clients.move_to_end(client)
+                else:
+                    del clients[client]
+                self._queued -= 1
+                return waiter
+        return None
+
+    def _drop_waiter_locked(self, waiter: _Waiter, client: str, priority: int) -> None:
+        clients = self._waiters.get(priority) or {}
+        queue = clients.get(client) or []
+        if waiter in queue:
+            queue.remove(waiter)
+            self._queued -= 1
+            if not queue:
+                del clients[client]
+
+    def _record_wait_locked(self, waited: float) -> None:
+        self.granted_total += 1
+        self.wait_max = max(self.wait_max, waited)
+        QUEUE_WAIT_SECONDS.observe(waited, provider=self.name)
+        self._waits.append(waited)
+        if len(self._waits) > 1024:
+            del self._waits[:512]
+
+    @contextmanager
+    def slot(self, *, client: str, priority: int, cancel: CancelToken | None = None):
+        self.acquire(client=client, priority=priority, cancel=cancel)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    @asynccontextmanager
+    async def async_slot(self, *, client: str, priority: int):
+        await self.acquire_async(client=client, priority=priority)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            waits = sorted(self._waits)
+
+            def pct(p: float) -> float | None:
+                return round(waits[min(len(waits) - 1, int(p * len(waits)))], 3) if waits else None
+
+            return {
+                "concurrency": self.concurrency,
+                "active": self._active,
+                "queued": self._queued,
+                "max_queue": self.max_queue,
+                "granted": self.granted_total,
+                "rejected": self.rejected_total,
+                "queue_wait_p50": pct(0.50),
+                "queue_wait_p99": pct(0.99),
+                "queue_wait_max": round(self.wait_max, 3),
+            }
+
+
+_SCHEDULERS = {
+    # Лимит Ollama задан на хост: общий — сумма по OLLAMA_URLS (+ Mistral-overflow).
+    "ollama": LLMScheduler(
+        "ollama", concurrency=BACKENDS.capacity_for("ollama") or CFG.ollama_concurrency, max_queue=CFG.queue_limit,
+    ),
+    "mistral": LLMScheduler("mistral", concurrency=CFG.mistral_concurrency, max_queue=CFG.queue_limit),
+}
+
+
+def get_scheduler(provider: str | None = None) -> LLMScheduler:
+    return _SCHEDULERS[provider or CFG.llm_provider]
+
+
+def _resize_scheduler(provider: str, capacity: int) -> None:
+    # Лимит хоста маршрута меняет слоты его провайдера, а не провайдера по умолчанию.
+    get_scheduler(provider).resize(capacity)
+
+
+BACKENDS.on_resize = _resize_scheduler
+
+
+_fanout: ThreadPoolExecutor | None = None
+_fanout_pid: int | None = None
+_fanout_lock = threading.Lock()
+
+
+def fanout_pool() -> ThreadPoolExecutor:
+    """Общий на процесс пул потоков для параллельных задач запросов.
+
+    Потоки здесь только ждут: реальный лимит на провайдера держит LLMScheduler.
+    Размер — с запасом на всю допустимую очередь, чтобы честность решал планировщик.
+    """
+    global _fanout, _fanout_pid
+    pid = os.getpid()
+    with _fanout_lock:
+        if _fanout is None or _fanout_pid != pid:
+            size = CFG.queue_limit + max(BACKENDS.max_capacity, *(s.concurrency for s in _SCHEDULERS.values()))
+            _fanout = ThreadPoolExecutor(max_workers=max(4, size), thread_name_prefix="viora-fanout")
+            _fanout_pid = pid
+        return _fanout
+
+
+def _client_id(headers: Headers | None = None, remote_addr: str | None = None) -> str:
+    """Идентификатор клиента для честной очереди (IP; за прокси — X-Forwarded-For).
+
+    Без аргументов берётся текущий Flask-запрос.
+    """
+    if headers is None:
+        headers, remote_addr = request.headers, request.remote_addr
+    if CFG.trust_proxy:
+        forwarded = (headers.get("X-Forwarded-For") or "").split(",")[0].strip()
+        if forwarded:
+            return forwarded
+    return remote_addr or "-"
+
+
+def _too_busy_body(e: QueueFullError) -> dict[str, Any]:
+    reason = "Слишком много запросов" if isinstance(e, RateLimited) else "Сервер перегружен"
+    return {"error": f"{reason}, повторите через {e.retry_after} с", "retry_after": e.retry_after}
+
+
+def _too_busy(e: QueueFullError) -> tuple[Response, int]:
+    resp = app.json.response(_too_busy_body(e))
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return resp, 429
+
+
+def _charge(client: str, cost: int, provider: str | None = None, *, tasks: int = 1) -> None:
+    """Списание с лимита клиента за генерации, которых нет в кэше (cost 0 — ничего).
+
+    Сначала admit() планировщика: запрос, отклонённый перегрузкой, бюджет не тратит.
+    """
+    if cost > 0:
+        get_scheduler(provider).admit(tasks)
+        RATE_LIMITER.take(client, cost)
+
+
+async def _acharge(client: str, cost: int, provider: str | None = None, *, tasks: int = 1) -> None:
+    """_charge для ASGI-режима."""
+    if cost > 0:
+        get_scheduler(provider).admit(tasks)
+        await RATE_LIMITER.atake(client, cost)
+
+
+# ── Лимит запросов на клиента (token bucket) ──────────────────────────────────
+_CHARS_PER_TOKEN = 3     # грубая оценка для русского текста у BPE-токенизаторов
+_RESPONSE_TOKENS = 1000  # ожидаемый ответ вместе с <think>, если у промпта нет бюджета ответа
+
+
+class RateLimited(QueueFullError):
+    """Клиент исчерпал свой бюджет токенов — повторить позже (HTTP 429)."""
+
+
+def request_cost(prompts: list[str], items: list[int] | None = None) -> int:
+    """Оценка токенов запроса: промпты плюс лимит ответа на каждый вызов модели.
+    items — пункты пакетных промптов (см. output_budget)."""
+    return sum(len(prompt) // _CHARS_PER_TOKEN + _response_cost(prompt, items) for prompt in prompts)
+
+
+def _response_cost(prompt: str, items: list[int] | None = None) -> int:
+    if CFG.ollama_num_predict > 0:
+        return CFG.ollama_num_predict
+    return output_budget(prompt, items=items) or _RESPONSE_TOKENS
+
+
+class RateLimiter:
+    """Token bucket на клиента (_client_id): бюджет burst оценочных токенов
+    пополняется со скоростью per_minute в минуту, запрос списывает request_cost
+    генераций, которых нет в кэше (_charge — после admit планировщика).
+
+    Состояние — SQLite: в памяти процесса или файл (path) в WAL-режиме, тогда
+    лимит общий для воркеров gunicorn (BEGIN IMMEDIATE сериализует списания).
+    Запрос дороже burst проходит только с полным бюджетом. Ошибка базы
+    пропускает запрос — лимит не должен ронять API.
+    """
+
+    def __init__(self, *, per_minute: int, burst: int, path: str = ""):
+        self.rate = max(per_minute, 0) / 60.0
+        self.burst = float(burst if burst > 0 else per_minute)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        self._db_pid: int | None = None
+        self._purged = 0.0
+        self.charged = 0
+        self.limited = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def _conn(self) -> sqlite3.Connection:
+        # Вызывается под self._lock. Соединение на процесс: после fork открываем заново.
+        pid = os.getpid()
+        if self._db is None or self._db_pid != pid:
+            db = sqlite3.connect(self.path or ":memory:", timeout=5, check_same_thread=False, isolation_level=None)
+            if self.path:
+                db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS rate_buckets ("
+                "client TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            self._db, self._db_pid = db, pid
+        return self._db
+
+    def _purge(self, db: sqlite3.Connection, now: float) -> None:
+        # Бюджет, не тронутый дольше burst/rate, уже полон — такая запись ничем не отличается от отсутствующей.
+        if now - self._purged < 60:
+            return
+        self._purged = now
+        db.execute("DELETE FROM rate_buckets WHERE updated < ?", (now - self.burst / self.rate,))
+
+    def take(self, client: str, cost: int) -> None:
+        """Списывает cost с бюджета клиента или бросает RateLimited с временем до пополнения."""
+        if not self.enabled or cost <= 0:
+            return
+        need = min(float(cost), self.burst)
+        now = time.time()
+        with self._lock:
+            db = self._conn()
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    row = db.execute(
+                        "SELECT tokens, updated FROM rate_buckets WHERE client = ?", (client,),
+                    ).fetchone()
+                    tokens = self.burst if row is None else min(self.burst, row[0] + (now - row[1]) * self.rate)
+                    if tokens >= need:
+                        db.execute(
+                            "INSERT OR REPLACE INTO rate_buckets (client, tokens, updated) VALUES (?, ?, ?)",
+                            (client, tokens - need, now),
+                        )
+                        self._purge(db, now)
+                finally:
+                    db.execute("COMMIT")
+            except sqlite3.Error as e:
+                log.warning("rate limit: база недоступна, запрос пропущен: %s", e)
+                return
+            if tokens >= need:
+                self.charged += cost
+                return
+            self.limited += 1
+        retry_after = int((need - tokens) / self.rate) + 1
+        raise RateLimited(f"Клиент {client} исчерпал лимит запросов", retry_after)
+
+    async def atake(self, client: str, cost: int) -> None:
+        """take из корутины: с SQLite-файлом — в потоке, чтобы не блокировать loop."""
+        if self.path and self.enabled:
+            return await asyncio.to_thread(self.take, client, cost)
+        self.take(client, cost)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "per_minute": round(self.rate * 60),
+                "burst": int(self.burst),
+                "shared": bool(self.path),
+                "charged": self.charged,
+                "limited": self.limited,
+            }
+
+
+RATE_LIMITER = RateLimiter(per_minute=CFG.rate_limit, burst=CFG.rate_burst, path=CFG.rate_path)
+
+
+def _cache_bypass(data: dict, headers: Headers | None = None) -> bool:
+    """Обход кэша для конкретного запроса: {"no_cache": true} или Cache-Control: no-cache."""
+    if data.get("no_cache") is True:
+        return True
+    if headers is None:
+        headers = request.headers
+    return "no-cache" in (headers.get("Cache-Control") or "").lower()
+
+
+# ── LLM: Ollama и Mistral API ─────────────────────────────────────────────────
+class LLMError(Exception):
+    """Ошибка запроса к провайдеру ИИ."""
+
+
+class LLMOverloaded(LLMError):
+    """Провайдер перегружен: 429 (лимит Mistral) или 503 (очередь Ollama полна)."""
+
+
+OllamaError = LLMError  # обратная совместимость
+
+
+_TIMEOUT_ERRORS: tuple[type[BaseException], ...] = (requests.exceptions.Timeout,) + (
+    (httpx.TimeoutException,) if httpx is not None else ()
+)
+
+
+def _status_error(label: str, r, limit: int = 200) -> LLMError:
+    error = LLMOverloaded if r.status_code in (429, 503) else LLMError
+    return error(f"{label} {r.status_code}: {r.text[:limit]}")
+
+
+def _is_overload(e: BaseException) -> bool:
+    return isinstance(e, (LLMOverloaded, *_TIMEOUT_ERRORS))
+
+
+def _retry_delay(attempt: int) -> float:
+    """Экспоненциальная пауза с полным джиттером: ретраи разных запросов не идут залпом."""
+    return random.uniform(0, min(8.0, 0.5 * 2 ** (attempt - 1)))
+
+
+def _run_on(backend: Backend, call) -> str:
+    started, failed, overload = time.monotonic(), None, False
+    try:
+        result = call(backend)
+        failed = False
+        return result
+    except Exception as e:
+        failed, overload = True, _is_overload(e)
+        raise
+    finally:
+        BACKENDS.done(backend, started, failed=failed, overload=overload)
+
+
+async def _arun_on(backend: Backend, call) -> str:
+    started, failed, overload = time.monotonic(), None, False
+    try:
+        result = await call(backend)
+        failed = False
+        return result
+    except Exception as e:
+        failed, overload = True, _is_overload(e)
+        raise
+    finally:
+        BACKENDS.done(backend, started, failed=failed, overload=overload)
+
+
+_hedge_executor: ThreadPoolExecutor | None = None
+_hedge_pid: int | None = None
+_hedge_lock = threading.Lock()
+
+
+def _hedge_pool() -> ThreadPoolExecutor:
+    """Потоки для хеджированных запросов: основной и дубль идут параллельно."""
+    global _hedge_executor, _hedge_pid
+    pid = os.getpid()
+    with _hedge_lock:
+        if _hedge_executor is None or _hedge_pid != pid:
+            _hedge_executor = ThreadPoolExecutor(
+                max_workers=max(4, BACKENDS.max_capacity * 2), thread_name_prefix="viora-hedge",
+            )
+            _hedge_pid = pid
+        return _hedge_executor
+
+
+def _hedged_call(
+    call, tried: set[Backend], provider: str | None = None, cancel: CancelToken | None = None,
+) -> str:
+    """Запрос на наименее загруженный бэкенд; если ответа нет дольше задержки
+    хеджирования — дубль на другой свободный хост, берётся первый успешный ответ.
+
+    call(backend, cancel) — попытка на хосте. У каждой попытки хеджа свой
+    CancelToken (отмена cancel отменяет их все): проигравшая обрывается, как
+    при уходе клиента, и хост освобождается. provider — см. BackendPool.
+    """
+    primary = BACKENDS.acquire(avoid=tried, provider=provider)
+    tried.add(primary)
+    delay = BACKENDS.hedge_delay(primary, provider)
+    if delay is None:
+        return _run_on(primary, lambda backend: call(backend, cancel))
+    tokens: list[CancelToken] = []
+
+    def attempt(backend: Backend) -> Future:
+        token = CancelToken()
+        tokens.append(token)
+        return pool.submit(_run_on, backend, lambda b: call(b, token))
+
+    def cancel_all() -> None:
+        for token in tokens:
+            token.cancel()
+
+    pool = _hedge_pool()
+    with cancel.on_cancel(cancel_all) if cancel is not None else nullcontext():
+        pending = {attempt(primary)}
+        try:
+            done, _ = wait(pending, timeout=delay)
+            if not done:
+                backup = BACKENDS.acquire_hedge(avoid=tried, provider=provider)
+                if backup is not None:
+                    tried.add(backup)
+                    log.info("hedge: %s молчит %.1f с, дублируем на %s", primary.name, delay, backup.name)
+                    pending.add(attempt(backup))
+            error: BaseException | None = None
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    if fut.exception() is None:
+                        return fut.result()
+                    error = fut.exception()
+            raise error
+        finally:
+            cancel_all()
+
+
+async def _ahedged_call(call, tried: set[Backend], provider: str | None = None) -> str:
+    """_hedged_call для корутин: проигравший запрос отменяется."""
+    primary = BACKENDS.acquire(avoid=tried, provider=provider)
+    tried.add(primary)
+    delay = BACKENDS.hedge_delay(primary, provider)
+    if delay is None:
+        return await _arun_on(primary, call)
+    tasks = [asyncio.ensure_future(_arun_on(primary, call))]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            backup = BACKENDS.acquire_hedge(avoid=tried, provider=provider)
+            if backup is not None:
+                tried.add(backup)
+                log.info("hedge: %s молчит %.1f с, дублируем на %s", primary.name, delay, backup.name)
+                tasks.append(asyncio.ensure_future(_arun_on(backup, call)))
+        pending, error = set(tasks), None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        await _cancel_tasks([t for t in tasks if not t.done()])
+
+
+def _retry_generate(
+    label: str, call, cancel: CancelToken | None = None, provider: str | None = None, slot=None,
+) -> str:
+    """Генерация с ретраями; call(backend, cancel) — один запрос к конкретному хосту.
+
+    Следующая попытка уходит на ещё не пробованный хост сразу, на уже
+    пробованный — после паузы _retry_delay. Отмена cancel прерывает паузу
+    и не даёт начать новую попытку. provider — хосты маршрута (см. BackendPool).
+    slot() — место в планировщике на одну попытку: на паузу оно отдаётся
+    другим запросам и занимается заново перед следующей попыткой.
+    """
+    last_err: Exception | None = None
+    tried: set[Backend] = set()
+    for attempt in range(1, CFG.max_retries + 2):
+        if cancel is not None:
+            cancel.check()
+        with slot() if slot is not None else nullcontext():
+            try:
+                return _hedged_call(call, tried, provider, cancel)
+            except _TIMEOUT_ERRORS as e:
+                last_err = e
+                LLM_TIMEOUTS.inc(provider=provider or CFG.llm_provider)
+                log.warning("%s timeout (attempt %d)", label, attempt)
+            except LLMError as e:
+                last_err = e
+                log.warning("%s failed (attempt %d): %s", label, attempt, e)
+            except Exception as e:
+                last_err = e
+                log.warning("%s error (attempt %d): %s", label, attempt, e)
+        if attempt <= CFG.max_retries:
+            LLM_RETRIES.inc(provider=provider or CFG.llm_provider)
+            if not BACKENDS.has_untried(tried, provider):
+                _sleep(_retry_delay(attempt), cancel)
+    raise LLMError(f"Все попытки исчерпаны: {last_err}")
+
+
+async def _retry_generate_async(label: str, call, provider: str | None = None, slot=None) -> str:
+    """_retry_generate для корутин: паузы между попытками через asyncio.sleep;
+    slot() — асинхронный контекст места в планировщике на одну попытку."""
+    last_err: Exception | None = None
+    tried: set[Backend] = set()
+    for attempt in range(1, CFG.max_retries + 2):
+        async with slot() if slot is not None else nullcontext():
+            try:
+                return await _ahedged_call(call, tried, provider)
+            except _TIMEOUT_ERRORS as e:
+                last_err = e
+                LLM_TIMEOUTS.inc(provider=provider or CFG.llm_provider)
+                log.warning("%s timeout (attempt %d)", label, attempt)
+            except LLMError as e:
+                last_err = e
+                log.warning("%s failed (attempt %d): %s", label, attempt, e)
+            except Exception as e:
+                last_err = e
+                log.warning("%s error (attempt %d): %s", label, attempt, e)
+        if attempt <= CFG.max_retries:
+            LLM_RETRIES.inc(provider=provider or CFG.llm_provider)
+            if not BACKENDS.has_untried(tried, provider):
+                await asyncio.sleep(_retry_delay(attempt))
+    raise LLMError(f"Все попытки исчерпаны: {last_err}")
+
+
+# Тела запросов и разбор ответов общие для синхронного и async-клиентов.
+def _ollama_keep_alive() -> str | int:
+    # Ollama принимает длительность («30m») или число секунд (-1 — не выгружать).
+    try:
+        return int(CFG.ollama_keep_alive)
+    except ValueError:
+        return CFG.ollama_keep_alive
+
+
+def _ollama_request(
+    prompt: str, *, temperature: float, stream: bool, model: str | None = None, items: list[int] | None = None,
+) -> tuple[str, dict[str, Any]]:
+    """(путь, тело) запроса к Ollama.
+
+    Параметры сэмплинга — внутри options (верхнеуровневые Ollama игнорирует).
+    num_predict — VIORA_OLLAMA_NUM_PREDICT, если задан, иначе output_budget;
+    think — ollama_think (рассуждение приходит в поле thinking, а не в тексте).
+    VIORA_OLLAMA_API=chat — /api/chat, где неизменные инструкции промпта идут
+    system-сообщением, а данные запроса — user-сообщением. model — модель
+    маршрута (ModelRoute.model_for), по умолчанию VIORA_MODEL; items — пункты
+    пакетного промпта (см. output_budget).
+    """
+    model = model or CFG.ollama_model
+    options: dict[str, Any] = {"temperature": temperature}
+    if CFG.ollama_num_ctx > 0:
+        options["num_ctx"] = CFG.ollama_num_ctx
+    num_predict = CFG.ollama_num_predict or output_budget(prompt, model, "ollama", items)
+    if num_predict:
+        options["num_predict"] = num_predict
+    stop = stop_sequences(prompt, model, "ollama")
+    if stop:
+        options["stop"] = stop
+    body: dict[str, Any] = {"model": model, "stream": stream, "options": options}
+    think = ollama_think(prompt, model)
+    if think is not None:
+        body["think"] = think
+    if CFG.ollama_keep_alive:
+        body["keep_alive"] = _ollama_keep_alive()
+    if CFG.ollama_api == "chat":
+        system, user = split_system_prompt(prompt)
+        messages = [{"role": "system", "content": system}] if system else []
+        messages.append({"role": "user", "content": user})
+        return "/api/chat", {**body, "messages": messages}
+    return "/api/generate", {**body, "prompt": prompt}
+
+
+def _ollama_text(data: dict) -> str:
+    """Текст ответа /api/generate ("response") или /api/chat ("message.content")."""
+    if "message" in data:
+        return (data.get("message") or {}).get("content") or ""
+    return data.get("response") or ""
+
+
+def _ollama_thinking(data: dict) -> str:
+    """Рассуждение из поля thinking (/api/generate) или message.thinking (/api/chat)."""
+    if "message" in data:
+        return (data.get("message") or {}).get("thinking") or ""
+    return data.get("thinking") or ""
+
+
+def _ollama_usage(data: dict) -> tuple[int, int] | None:
+    """(токены промпта, токены ответа) из финального ответа Ollama (prompt_eval_count/eval_count)."""
+    if "eval_count" not in data and "prompt_eval_count" not in data:
+        return None
+    return int(data.get("prompt_eval_count") or 0), int(data.get("eval_count") or 0)
+
+
+def _mistral_usage(data: dict) -> tuple[int, int] | None:
+    usage = data.get("usage")
+    if not isinstance(usage, dict):
+        return None
+    return int(usage.get("prompt_tokens") or 0), int(usage.get("completion_tokens") or 0)
+
+
+def _count_tokens(backend: Backend, usage: tuple[int, int] | None) -> None:
+    if usage is None:
+        return
+    prompt_tokens, completion_tokens = usage
+    LLM_TOKENS.inc(prompt_tokens, backend=backend.name, type="prompt")
+    LLM_TOKENS.inc(completion_tokens, backend=backend.name, type="completion")
+
+
+def _mistral_body(
+    prompt: str, *, temperature: float, stream: bool, model: str | None = None, items: list[int] | None = None,
+) -> dict[str, Any]:
+    if not CFG.mistral_api_key:
+        raise LLMError("MISTRAL_API_KEY не задан (нужен для VIORA_LLM_PROVIDER=mistral)")
+    model = model or CFG.mistral_model
+    body: dict[str, Any] = {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": temperature,
+    }
+    max_tokens = output_budget(prompt, model, "mistral", items)
+    if max_tokens:
+        body["max_tokens"] = max_tokens
+    stop = stop_sequences(prompt, model, "mistral")
+    if stop:
+        body["stop"] = stop
+    if stream:
+        body["stream"] = True
+    return body
+
+
+def _mistral_message(data: dict) -> tuple[str, str]:
+    """(текст, рассуждение) ответа Mistral без потока."""
+    choices = data.get("choices") or []
+    if not choices:
+        raise LLMError("Mistral: пустой ответ (нет choices)")
+    message = choices[0].get("message") or {}
+    return _mistral_content(message.get("content", ""))
+
+
+def _mistral_content(content: Any, sep: str = "\n") -> tuple[str, str]:
+    """content Mistral → (текст, рассуждение). Некоторые модели отдают content
+    массивом блоков: text — ответ, thinking (Magistral) — рассуждение."""
+    if not isinstance(content, list):
+        return str(content or ""), ""
+    parts, thinking = [], []
+    for block in content:
+        if isinstance(block, str):
+            parts.append(block)
+        elif isinstance(block, dict) and block.get("type") == "text":
+            parts.append(block.get("text", ""))
+        elif isinstance(block, dict) and block.get("type") == "thinking":
+            thinking.extend(part.get("text", "") for part in block.get("thinking") or [] if isinstance(part, dict))
+    return sep.join(p for p in parts if p), "".join(thinking)
+
+
+def _ollama_stream_chunk(line: str | bytes) -> tuple[str, str, bool, tuple[int, int] | None]:
+    """Строка NDJSON-стрима Ollama → (кусок текста, кусок рассуждения, конец потока,
+    токены из финального чанка)."""
+    if not line:
+        return "", "", False, None
+    try:
+        chunk = json.loads(line)
+    except json.JSONDecodeError:
+        return "", "", False, None
+    done = bool(chunk.get("done"))
+    return _ollama_text(chunk), _ollama_thinking(chunk), done, _ollama_usage(chunk) if done else None
+
+
+def _mistral_stream_chunk(line: str | bytes) -> tuple[str, str, bool, tuple[int, int] | None]:
+    """Строка SSE-стрима Mistral → (кусок текста, кусок рассуждения, конец потока,
+    токены из usage последнего чанка)."""
+    if isinstance(line, bytes):
+        line = line.decode("utf-8", "replace")
+    if not line.startswith("data:"):
+        return "", "", False, None
+    data = line[5:].strip()
+    if data == "[DONE]":
+        return "", "", True, None
+    try:
+        chunk = json.loads(data)
+    except json.JSONDecodeError:
+        return "", "", False, None
+    pieces, thinking = [], []
+    for choice in chunk.get("choices") or []:
+        piece, thought = _mistral_content((choice.get("delta") or {}).get("content"), sep="")
+        pieces.append(piece)
+        thinking.append(thought)
+    return "".join(pieces), "".join(thinking), False, _mistral_usage(chunk)
+
+
+def _ollama_generate_once(
+    backend: Backend, prompt: str, *, temperature: float, max_len: int = 4000,
+    model: str | None = None, items: list[int] | None = None,
+) -> str:
+    path, body = _ollama_request(prompt, temperature=temperature, stream=False, model=model, items=items)
+    r = backend.client().request("POST", path, json_body=body)
+    if r.status_code != 200:
+        raise _status_error("Ollama HTTP", r)
+    data = r.json()
+    _count_tokens(backend, _ollama_usage(data))
+    count_reasoning(prompt, _ollama_thinking(data))
+    return sanitize_ai_text(_ollama_text(data), max_len=max_len)
+
+
+def _mistral_generate_once(
+    backend: Backend, prompt: str, *, temperature: float, max_len: int = 4000,
+    model: str | None = None, items: list[int] | None = None,
+) -> str:
+    body = _mistral_body(prompt, temperature=temperature, stream=False, model=model, items=items)
+    r = backend.client().request("POST", "/chat/completions", json_body=body)
+    if r.status_code != 200:
+        raise _status_error("Mistral HTTP", r, 300)
+    data = r.json()
+    _count_tokens(backend, _mistral_usage(data))
+    text, thinking = _mistral_message(data)
+    count_reasoning(prompt, thinking)
+    return sanitize_ai_text(text, max_len=max_len)
+
+
+def _generate_once(
+    backend: Backend, prompt: str, *, temperature: float, max_len: int = 4000,
+    cancel: CancelToken | None = None, model: str | None = None, items: list[int] | None = None,
+) -> str:
+    watchdog = answer_watchdog(prompt)
+    if cancel is not None or watchdog is not None or _capped(backend, prompt, model):
+        return _generate_streamed(
+            backend, prompt, temperature=temperature, max_len=max_len, cancel=cancel, watchdog=watchdog,
+            model=model, items=items,
+        )
+    once = _mistral_generate_once if backend.provider == "mistral" else _ollama_generate_once
+    return once(backend, prompt, temperature=temperature, max_len=max_len, model=model, items=items)
+
+
+def _capped(backend: Backend, prompt: str, model: str | None) -> bool:
+    """Нужен ли поток ради лимита рассуждения: без потока его не оборвать."""
+    return backend.provider == "ollama" and bool(reasoning_cap(prompt, model or CFG.ollama_model))
+
+
+def _generate_streamed(
+    backend: Backend, prompt: str, *, temperature: float, max_len: int,
+    cancel: CancelToken | None, watchdog: AnswerWatchdog | None,
+    model: str | None = None, items: list[int] | None = None,
+) -> str:
+    """Полный ответ, собранный потоковым запросом, — чтобы его можно было прервать.
+
+    Ответ без stream блокирует поток до конца генерации; в потоке же отмена
+    проверяется на каждом куске и закрывает соединение, а Ollama, увидев
+    закрытое соединение, прекращает генерацию. Так же поток обрывается,
+    когда watchdog видит конец формата ответа, а рассуждение — на лимите
+    VIORA_REASONING (см. ollama_stream).
+    """
+    source = _mistral_stream if backend.provider == "mistral" else ollama_stream
+    pieces: list[str] = []
+    stream = source(prompt, temperature=temperature, backend=backend, cancel=cancel, model=model, items=items)
+    with closing(stream):
+        for piece in stream:
+            pieces.append(piece)
+            if watchdog is not None and watchdog.feed(piece):
+                break
+    return sanitize_ai_text("".join(pieces), max_len=max_len)
+
+
+async def _ollama_agenerate_once(
+    backend: Backend, prompt: str, *, temperature: float, max_len: int = 4000,
+    model: str | None = None, items: list[int] | None = None,
+) -> str:
+    path, body = _ollama_request(prompt, temperature=temperature, stream=False, model=model, items=items)
+    r = await backend.async_client().post(path, json=body)
+    if r.status_code != 200:
+        raise _status_error("Ollama HTTP", r)
+    data = r.json()
+    _count_tokens(backend, _ollama_usage(data))
+    count_reasoning(prompt, _ollama_thinking(data))
+    return sanitize_ai_text(_ollama_text(data), max_len=max_len)
+
+
+async def _mistral_agenerate_once(
+    backend: Backend, prompt: str, *, temperature: float, max_len: int = 4000,
+    model: str | None = None, items: list[int] | None = None,
+) -> str:
+    body = _mistral_body(prompt, temperature=temperature, stream=False, model=model, items=items)
+    r = await backend.async_client().post("/chat/completions", json=body)
+    if r.status_code != 200:
+        raise _status_error("Mistral HTTP", r, 300)
+    data = r.json()
+    _count_tokens(backend, _mistral_usage(data))
+    text, thinking = _mistral_message(data)
+    count_reasoning(prompt, thinking)
+    return sanitize_ai_text(text, max_len=max_len)
+
+
+async def _agenerate_once(
+    backend: Backend, prompt: str, *, temperature: float, max_len: int = 4000,
+    model: str | None = None, items: list[int] | None = None,
+) -> str:
+    watchdog = answer_watchdog(prompt)
+    if watchdog is not None or _capped(backend, prompt, model):
+        return await _agenerate_streamed(
+            backend, prompt, temperature=temperature, max_len=max_len, watchdog=watchdog, model=model, items=items,
+        )
+    once = _mistral_agenerate_once if backend.provider == "mistral" else _ollama_agenerate_once
+    return await once(backend, prompt, temperature=temperature, max_len=max_len, model=model, items=items)
+
+
+async def _agenerate_streamed(
+    backend: Backend, prompt: str, *, temperature: float, max_len: int, watchdog: AnswerWatchdog | None,
+    model: str | None = None, items: list[int] | None = None,
+) -> str:
+    """_generate_streamed для ASGI-режима: поток обрывается по watchdog."""
+    pieces: list[str] = []
+    async with aclosing(_backend_astream(backend, prompt, temperature=temperature, model=model, items=items)) as stream:
+        async for piece in stream:
+            pieces.append(piece)
+            if watchdog is not None and watchdog.feed(piece):
+                break
+    return sanitize_ai_text("".join(pieces), max_len=max_len)
+
+
+def llm_generate(
+    prompt: str,
+    *,
+    temperature: float = 0.7,
+    use_cache: bool = True,
+    client: str = "-",
+    priority: int = PRIORITY_BATCH,
+    max_len: int = 4000,
+    cancel: CancelToken | None = None,
+    items: list[int] | None = None,
+) -> str:
+    """Единая точка генерации: провайдер из VIORA_LLM_PROVIDER.
+
+    use_cache=False — не читать кэш (свежий ответ всё равно туда запишется).
+    client/priority — место в очереди планировщика провайдера.
+    max_len — лимит очищенного ответа (см. sanitize_ai_text).
+    cancel — отмена (клиент ушёл): снимает с очереди, обрывает запрос к модели,
+    бросает RequestCancelled.
+    items — номера пунктов пакетного промпта (исходов, кадров): от них бюджет ответа.
+    Модель — по маршруту вида промпта (model_route); при каскаде сначала
+    отвечает быстрая, и основная вызывается, только если её ответ не принят.
+    """
+    key = response_key(prompt, temperature, items)
+    if use_cache:
+        cached = RESPONSE_CACHE.get(key)
+        if cached is not None:
+            return cached
+    else:
+        RESPONSE_CACHE.note_bypass()
+
+    def produce() -> str:
+        if use_cache and SINGLE_FLIGHT.cross_process:
+            # Пока ждали flock, ответ мог сгенерировать другой воркер.
+            cached = RESPONSE_CACHE.get(key, count=False)
+            if cached is not None:
+                return cached
+        options = dict(
+            temperature=temperature, client=client, priority=priority, max_len=max_len, cancel=cancel, items=items,
+        )
+        result, fast = None, cascade_route(prompt)
+        if fast is not None:
+            try:
+                result = _generate_on(fast, prompt, **options)
+            except LLMError as e:
+                log.warning("Каскад: быстрая модель %s не ответила: %s", fast.model, e)
+            result = cascade_result(prompt, result, items)
+        if result is None:
+            result = _generate_on(model_route(prompt), prompt, **options)
+        RESPONSE_CACHE.put(key, result)
+        return result
+
+    return SINGLE_FLIGHT.do(key, produce, cancel)
+
+
+def _generate_on(
+    route: ModelRoute, prompt: str, *, temperature: float, client: str, priority: int, max_len: int,
+    cancel: CancelToken | None, items: list[int] | None,
+) -> str:
+    """Генерация моделью маршрута: слот планировщика её провайдера, ретраи по её хостам.
+
+    Слот занимается на каждую попытку отдельно — пауза перед ретраем его не держит.
+    """
+    scheduler = get_scheduler(route.provider)
+    return _retry_generate(
+        f"{route.provider}_generate", lambda backend, cancel: _generate_once(
+            backend, prompt, temperature=temperature, max_len=max_len, cancel=cancel,
+            model=route.model_for(backend.provider), items=items),
+        cancel, route.provider, slot=lambda: scheduler.slot(client=client, priority=priority, cancel=cancel),
+    )
+
+
+async def _cache_call(fn, *args, **kwargs):
+    """Вызов кэша из корутины: с SQLite-файлом — в потоке, чтобы не блокировать loop."""
+    if RESPONSE_CACHE.path:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+    return fn(*args, **kwargs)
+
+
+async def _jobs_call(fn, *args, **kwargs):
+    """Вызов JOBS из корутины: с файлом базы (VIORA_JOBS_PATH) — в потоке, как _cache_call."""
+    if JOBS.path:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+    return fn(*args, **kwargs)
+
+
+async def llm_agenerate(
+    prompt: str,
+    *,
+    temperature: float = 0.7,
+    use_cache: bool = True,
+    client: str = "-",
+    priority: int = PRIORITY_BATCH,
+    max_len: int = 4000,
+    items: list[int] | None = None,
+) -> str:
+    """llm_generate для ASGI-режима: тот же кэш, single-flight, планировщик и каскад, без потоков."""
+    key = response_key(prompt, temperature, items)
+    if use_cache:
+        cached = await _cache_call(RESPONSE_CACHE.get, key)
+        if cached is not None:
+            return cached
+    else:
+        RESPONSE_CACHE.note_bypass()
+
+    async def produce() -> str:
+        if use_cache and SINGLE_FLIGHT.cross_process:
+            cached = await _cache_call(RESPONSE_CACHE.get, key, count=False)
+            if cached is not None:
+                return cached
+        options = dict(temperature=temperature, client=client, priority=priority, max_len=max_len, items=items)
+        result, fast = None, cascade_route(prompt)
+        if fast is not None:
+            try:
+                result = await _agenerate_on(fast, prompt, **options)
+            except LLMError as e:
+                log.warning("Каскад: быстрая модель %s не ответила: %s", fast.model, e)
+            result = cascade_result(prompt, result, items)
+        if result is None:
+            result = await _agenerate_on(model_route(prompt), prompt, **options)
+        await _cache_call(RESPONSE_CACHE.put, key, result)
+        return result
+
+    return await SINGLE_FLIGHT.ado(key, produce)
+
+
+async def _agenerate_on(
+    route: ModelRoute, prompt: str, *, temperature: float, client: str, priority: int, max_len: int,
+    items: list[int] | None,
+) -> str:
+    """_generate_on для ASGI-режима."""
+    scheduler = get_scheduler(route.provider)
+    return await _retry_generate_async(
+        f"{route.provider}_generate", lambda backend: _agenerate_once(
+            backend, prompt, temperature=temperature, max_len=max_len,
+            model=route.model_for(backend.provider), items=items),
+        route.provider, slot=lambda: scheduler.async_slot(client=client, priority=priority),
+    )
+
+
+def ollama_generate(prompt: str, *, temperature: float = 0.7, stream: bool = False) -> str:
+    """Алиас для совместимости; stream игнорируется (используйте llm_generate)."""
+    if stream:
+        log.debug("ollama_generate(stream=True): стриминг только для Ollama, batch через llm_generate")
+    if CFG.llm_provider == "mistral":
+        return llm_generate(prompt, temperature=temperature)
+    return _retry_generate("ollama_generate", lambda backend, cancel: _generate_once(
+        backend, prompt, temperature=temperature, cancel=cancel))
+
+
+def _abort_response(r) -> None:
+    """Обрывает соединение потокового ответа requests: shutdown будит поток,
+    заблокированный в чтении, а провайдер видит закрытое соединение."""
+    sock = getattr(getattr(getattr(r, "raw", None), "connection", None), "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def _stream_lines(r, cancel: CancelToken | None) -> Generator[Any, None, None]:
+    """r.iter_lines() с отменой: проверка на каждой строке и обрыв чтения по cancel()."""
+    if cancel is None:
+        yield from r.iter_lines()
+        return
+    with cancel.on_cancel(functools.partial(_abort_response, r)):
+        try:
+            for line in r.iter_lines():
+                cancel.check()
+                yield line
+        except Exception:
+            cancel.check()  # ошибка чтения оборванного соединения — это отмена, а не сбой хоста
+            raise
+
+
+def ollama_stream(
+    prompt: str, *, temperature: float = 0.7, backend: Backend | None = None, cancel: CancelToken | None = None,
+    model: str | None = None, items: list[int] | None = None,
+) -> Generator[str, None, None]:
+    """Стрим токенов из Ollama; backend — конкретный хост (без него — только при провайдере ollama).
+
+    Рассуждение (поле thinking) не отдаётся, а считается; если оно превысило
+    лимит VIORA_REASONING, запрос повторяется с think: false.
+    """
+    if backend is None and CFG.llm_provider == "mistral":
+        raise LLMError("Стриминг через ollama_stream недоступен при VIORA_LLM_PROVIDER=mistral")
+    path, body = _ollama_request(prompt, temperature=temperature, stream=True, model=model, items=items)
+    backend = backend or BACKENDS.backends[0]
+    meter = ReasoningMeter(prompt, reasoning_cap(prompt, body["model"]))
+    try:
+        while True:
+            r = backend.client().request("POST", path, json_body=body, stream=True)
+            try:
+                if r.status_code != 200:
+                    raise _status_error("HTTP", r)
+                for line in _stream_lines(r, cancel):
+                    piece, thinking, done, usage = _ollama_stream_chunk(line)
+                    _count_tokens(backend, usage)
+                    if meter.feed(thinking):
+                        break
+                    if piece:
+                        yield piece
+                    if done:
+                        return
+                else:
+                    return
+            finally:
+                # Возвращаем соединение в пул (или закрываем, если поток не дочитан).
+                r.close()
+            # Рассуждение упёрлось в лимит: ответа ещё не было — просим ответить без него.
+            meter.cut()
+            body = {**body, "think": False}
+    finally:
+        meter.close()
+
+
+def _mistral_stream(
+    prompt: str, *, temperature: float, backend: Backend, cancel: CancelToken | None = None,
+    model: str | None = None, items: list[int] | None = None,
+) -> Generator[str, None, None]:
+    """Стрим токенов из Mistral (/chat/completions со stream: true, SSE-формат)."""
+    body = _mistral_body(prompt, temperature=temperature, stream=True, model=model, items=items)
+    meter = ReasoningMeter(prompt)
+    r = backend.client().request("POST", "/chat/completions", json_body=body, stream=True)
+    try:
+        if r.status_code != 200:
+            raise _status_error("Mistral HTTP", r, 300)
+        for line in _stream_lines(r, cancel):
+            piece, thinking, done, usage = _mistral_stream_chunk(line)
+            _count_tokens(backend, usage)
+            meter.feed(thinking)
+            if piece:
+                yield piece
+            if done:
+                return
+    finally:
+        meter.close()
+        r.close()
+
+
+def _provider_stream(
+    prompt: str, *, temperature: float, cancel: CancelToken | None = None, watchdog: AnswerWatchdog | None = None,
+    route: ModelRoute | None = None,
+) -> Generator[str, None, None]:
+    """Стрим токенов с выбором бэкенда: пока не пришёл первый токен,
+    ошибка хоста переводит запрос на следующий; после — пробрасывается.
+    watchdog — обрыв генерации после последней секции ответа (успешный конец);
+    route — провайдер и модель (по умолчанию model_route промпта)."""
+    route = route or model_route(prompt)
+    last_err: Exception | None = None
+    tried: set[Backend] = set()
+    for attempt in range(1, CFG.max_retries + 2):
+        if cancel is not None:
+            cancel.check()
+        backend = BACKENDS.acquire(avoid=tried, provider=route.provider)
+        tried.add(backend)
+        source = _mistral_stream if backend.provider == "mistral" else ollama_stream
+        started, failed, overload, ttft = time.monotonic(), None, False, None
+        model = route.model_for(backend.provider)
+        try:
+            with closing(source(prompt, temperature=temperature, backend=backend, cancel=cancel, model=model)) as stream:
+                for piece in stream:
+                    if ttft is None:
+                        ttft = time.monotonic() - started
+                        LLM_TTFT_SECONDS.observe(ttft, backend=backend.name)
+                    yield piece
+                    if watchdog is not None and watchdog.feed(piece):
+                        break
+            failed = False
+            return
+        except Exception as e:
+            failed, overload = True, _is_overload(e)
+            if isinstance(e, _TIMEOUT_ERRORS):
+                LLM_TIMEOUTS.inc(provider=route.provider)
+            if ttft is not None:
+                raise
+            last_err = e
+            log.warning("%s stream failed (attempt %d): %s", backend.name, attempt, e)
+        finally:
+            BACKENDS.done(backend, started, failed=failed, stream=True, overload=overload, ttft=ttft)
+        if attempt <= CFG.max_retries:
+            LLM_RETRIES.inc(provider=route.provider)
+            if not BACKENDS.has_untried(tried, route.provider):
+                _sleep(_retry_delay(attempt), cancel)
+    raise LLMError(f"Все попытки исчерпаны: {last_err}")
+
+
+async def _backend_astream(
+    backend: Backend, prompt: str, *, temperature: float, model: str | None = None, items: list[int] | None = None,
+) -> AsyncGenerator[str, None]:
+    """Async-стрим токенов одного хоста (httpx.AsyncClient); рассуждение — как в ollama_stream."""
+    if backend.provider == "mistral":
+        path, body, chunk_fn, label = (
+            "/chat/completions", _mistral_body(prompt, temperature=temperature, stream=True, model=model, items=items),
+            _mistral_stream_chunk, "Mistral HTTP",
+        )
+        meter = ReasoningMeter(prompt)
+    else:
+        path, body = _ollama_request(prompt, temperature=temperature, stream=True, model=model, items=items)
+        chunk_fn, label = _ollama_stream_chunk, "HTTP"
+        meter = ReasoningMeter(prompt, reasoning_cap(prompt, body["model"]))
+    try:
+        while True:
+            async with backend.async_client().stream("POST", path, json=body) as r:
+                if r.status_code != 200:
+                    await r.aread()
+                    raise _status_error(label, r, 300)
+                async for line in r.aiter_lines():
+                    piece, thinking, done, usage = chunk_fn(line)
+                    _count_tokens(backend, usage)
+                    if meter.feed(thinking):
+                        break
+                    if piece:
+                        yield piece
+                    if done:
+                        return
+                else:
+                    return
+            meter.cut()
+            body = {**body, "think": False}
+    finally:
+        meter.close()
+
+
+async def _provider_astream(
+    prompt: str, *, temperature: float, watchdog: AnswerWatchdog | None = None, route: ModelRoute | None = None,
+) -> AsyncGenerator[str, None]:
+    """_provider_stream для ASGI-режима."""
+    route = route or model_route(prompt)
+    last_err: Exception | None = None
+    tried: set[Backend] = set()
+    for attempt in range(1, CFG.max_retries + 2):
+        backend = BACKENDS.acquire(avoid=tried, provider=route.provider)
+        tried.add(backend)
+        started, failed, overload, ttft = time.monotonic(), None, False, None
+        model = route.model_for(backend.provider)
+        try:
+            async with aclosing(_backend_astream(backend, prompt, temperature=temperature, model=model)) as stream:
+                async for piece in stream:
+                    if ttft is None:
+                        ttft = time.monotonic() - started
+                        LLM_TTFT_SECONDS.observe(ttft, backend=backend.name)
+                    yield piece
+                    if watchdog is not None and watchdog.feed(piece):
+                        break
+            failed = False
+            return
+        except Exception as e:
+            failed, overload = True, _is_overload(e)
+            if isinstance(e, _TIMEOUT_ERRORS):
+                LLM_TIMEOUTS.inc(provider=route.provider)
+            if ttft is not None:
+                raise
+            last_err = e
+            log.warning("%s stream failed (attempt %d): %s", backend.name, attempt, e)
+        finally:
+            BACKENDS.done(backend, started, failed=failed, stream=True, overload=overload, ttft=ttft)
+        if attempt <= CFG.max_retries:
+            LLM_RETRIES.inc(provider=route.provider)
+            if not BACKENDS.has_untried(tried, route.provider):
+                await asyncio.sleep(_retry_delay(attempt))
+    raise LLMError(f"Все попытки исчерпаны: {last_err}")
+
+
+def _ready_stream(kind: str, text: str) -> Generator[tuple[str, Any], None, tuple[str, dict[str, Any]]]:
+    """Готовый ответ (кэш, спекуляция) в событиях llm_stream: весь текст одним куском."""
+    parsed = _SECTION_PARSERS[kind](text)
+    yield "token", text
+    for item in parsed.items():
+        if item[1]:
+            yield "section", item
+    return text, parsed
+
+
+def llm_stream(
+    prompt: str,
+    *,
+    kind: str,
+    temperature: float = 0.7,
+    use_cache: bool = True,
+    client: str = "-",
+    priority: int = PRIORITY_INTERACTIVE,
+    cancel: CancelToken | None = None,
+) -> Generator[tuple[str, Any], None, tuple[str, dict[str, Any]]]:
+    """Стрим ответа активного провайдера с разбором на лету.
+
+    Отдаёт ("token", видимый текст без <think>) и ("section", (ключ, значение))
+    по мере готовности; возвращает (через StopIteration.value) пару
+    (очищенный текст, секции) — ту же, что дали бы llm_generate и parse_*.
+    Текст кладётся в кэш; при попадании в кэш модель не вызывается.
+    cancel — как у llm_generate.
+
+    При каскаде сначала стримится быстрая модель; если её ответ не принят,
+    приходит ("reset", {"model": …}) — показанное надо сбросить — и затем
+    поток основной модели.
+
+    Одинаковые одновременные стримы склеиваются (SINGLE_FLIGHT.stream): модель
+    генерирует один раз, остальные получают те же события.
+    """
+    key = response_key(prompt, temperature)
+    if use_cache:
+        cached = RESPONSE_CACHE.get(key)
+        if cached is not None:
+            return (yield from _ready_stream(kind, cached))
+    else:
+        RESPONSE_CACHE.note_bypass()
+    route = model_route(prompt)
+
+    def produce() -> Generator[tuple[str, Any], None, tuple[str, dict[str, Any]]]:
+        if use_cache and SINGLE_FLIGHT.cross_process:
+            # Пока ждали flock, ответ мог сгенерировать другой воркер.
+            cached = RESPONSE_CACHE.get(key, count=False)
+            if cached is not None:
+                return (yield from _ready_stream(kind, cached))
+        options = dict(kind=kind, temperature=temperature, client=client, priority=priority, cancel=cancel)
+        outcome, fast = None, cascade_route(prompt)
+        if fast is not None:
+            try:
+                outcome = yield from _stream_on(fast, prompt, **options)
+            except LLMError as e:
+                log.warning("Каскад: быстрая модель %s не ответила: %s", fast.model, e)
+            if cascade_result(prompt, outcome and outcome[0]) is None:
+                outcome = None
+                yield "reset", {"model": route.model}
+        if outcome is None:
+            outcome = yield from _stream_on(route, prompt, **options)
+        RESPONSE_CACHE.put(key, outcome[0])
+        return outcome
+
+    return (yield from SINGLE_FLIGHT.stream(key, produce, cancel, reset=("reset", {"model": route.model})))
+
+
+def _stream_on(
+    route: ModelRoute, prompt: str, *, kind: str, temperature: float, client: str, priority: int,
+    cancel: CancelToken | None,
+) -> Generator[tuple[str, Any], None, tuple[str, dict[str, Any]]]:
+    """Стрим одной модели маршрута с разбором на лету (события llm_stream, без кэша)."""
+    parser = StreamingParser(kind)
+    with get_scheduler(route.provider).slot(client=client, priority=priority, cancel=cancel):
+        watchdog = answer_watchdog(prompt)
+        stream = _provider_stream(prompt, temperature=temperature, cancel=cancel, watchdog=watchdog, route=route)
+        for piece in stream:
+            visible, ready = parser.feed(piece)
+            if visible:
+                yield "token", visible
+            for item in ready:
+                yield "section", item
+    result, parsed, ready = parser.finish()
+    for item in ready:
+        yield "section", item
+    return result, parsed
+
+
+async def llm_astream(
+    prompt: str,
+    *,
+    kind: str,
+    temperature: float = 0.7,
+    use_cache: bool = True,
+    client: str = "-",
+    priority: int = PRIORITY_INTERACTIVE,
+) -> AsyncGenerator[tuple[str, Any], None]:
+    """llm_stream для ASGI-режима.
+
+    Async-генератор не может вернуть значение, поэтому итог приходит
+    последним событием ("result", (очищенный текст, секции)).
+    """
+    key = response_key(prompt, temperature)
+    if use_cache:
+        cached = await _cache_call(RESPONSE_CACHE.get, key)
+        if cached is not None:
+            for event in _aready_events(kind, cached):
+                yield event
+            return
+    else:
+        RESPONSE_CACHE.note_bypass()
+    route = model_route(prompt)
+
+    async def produce() -> AsyncGenerator[tuple[str, Any], None]:
+        if use_cache and SINGLE_FLIGHT.cross_process:
+            cached = await _cache_call(RESPONSE_CACHE.get, key, count=False)
+            if cached is not None:
+                for event in _aready_events(kind, cached):
+                    yield event
+                return
+        options = dict(kind=kind, temperature=temperature, client=client, priority=priority)
+        outcome, fast = None, cascade_route(prompt)
+        if fast is not None:
+            try:
+                async for event, payload in _astream_on(fast, prompt, **options):
+                    if event == "result":
+                        outcome = payload
+                    else:
+                        yield event, payload
+            except LLMError as e:
+                log.warning("Каскад: быстрая модель %s не ответила: %s", fast.model, e)
+            if cascade_result(prompt, outcome and outcome[0]) is None:
+                outcome = None
+                yield "reset", {"model": route.model}
+        if outcome is None:
+            async for event, payload in _astream_on(route, prompt, **options):
+                if event == "result":
+                    outcome = payload
+                else:
+                    yield event, payload
+        await _cache_call(RESPONSE_CACHE.put, key, outcome[0])
+        yield "result", outcome
+
+    async with aclosing(SINGLE_FLIGHT.astream(key, produce, reset=("reset", {"model": route.model}))) as events:
+        async for event in events:
+            yield event
+
+
+def _aready_events(kind: str, text: str) -> list[tuple[str, Any]]:
+    """_ready_stream для llm_astream: те же события и итог последним событием ("result", …)."""
+    parsed = _SECTION_PARSERS[kind](text)
+    return [("token", text), *(("section", item) for item in parsed.items() if item[1]), ("result", (text, parsed))]
+
+
+async def _astream_on(
+    route: ModelRoute, prompt: str, *, kind: str, temperature: float, client: str, priority: int,
+) -> AsyncGenerator[tuple[str, Any], None]:
+    """_stream_on для ASGI-режима; итог — последним событием ("result", …)."""
+    parser = StreamingParser(kind)
+    async with get_scheduler(route.provider).async_slot(client=client, priority=priority):
+        watchdog = answer_watchdog(prompt)
+        async for piece in _provider_astream(prompt, temperature=temperature, watchdog=watchdog, route=route):
+            visible, ready = parser.feed(piece)
+            if visible:
+                yield "token", visible
+            for item in ready:
+                yield "section", item
+    result, parsed, ready = parser.finish()
+    for item in ready:
+        yield "section", item
+    yield "result", (result, parsed)
+
+
+def preload_ollama_model() -> None:
+    """Заранее загружает модели на хостах Ollama (запрос без промпта), чтобы холодный
+    старт не достался первому пользователю; keep_alive держит их в памяти между всплесками.
+    Кроме основной модели — модели Ollama из VIORA_MODEL_ROUTES и VIORA_CASCADE."""
+    models = [CFG.ollama_model] if CFG.llm_provider == "ollama" else []
+    models += [m for m in routed_models("ollama") if m not in models]
+    if not models or not CFG.ollama_preload:
+        return
+    for backend in BACKENDS.backends:
+        if backend.provider != "ollama":
+            continue
+        for model in models:
+            body: dict[str, Any] = {"model": model}
+            if CFG.ollama_keep_alive:
+                body["keep_alive"] = _ollama_keep_alive()
+            started = time.monotonic()
+            try:
+                r = backend.client().request("POST", "/api/generate", json_body=body)
+                if r.status_code != 200:
+                    raise LLMError(f"HTTP {r.status_code}: {r.text[:200]}")
+            except Exception as e:
+                log.warning("%s: не удалось загрузить %s заранее: %s", backend.name, model, e)
+                continue
+            log.info("%s: модель %s загружена за %.1f с", backend.name, model, time.monotonic() - started)
+
+
+_PRELOAD_PID: int | None = None
+_PRELOAD_LOCK = threading.Lock()
+
+
+@app.before_request
+def start_ollama_preload() -> None:
+    """preload_ollama_model в фоне, раз на процесс (ленивый старт, fork-safe).
+
+    Кроме __main__ и lifespan вызывается на первом запросе: воркеры gunicorn
+    не проходят ни через то, ни через другое.
+    """
+    global _PRELOAD_PID
+    pid = os.getpid()
+    if _PRELOAD_PID == pid:
+        return
+    with _PRELOAD_LOCK:
+        if _PRELOAD_PID == pid:
+            return
+        _PRELOAD_PID = pid
+    threading.Thread(target=preload_ollama_model, name="viora-preload", daemon=True).start()
+
+
+def check_backend_health(backend: Backend) -> dict[str, Any]:
+    """Проверка одного хоста: Ollama — /api/tags, Mistral — /models."""
+    if backend.provider == "mistral":
+        if not CFG.mistral_api_key:
+            return {
+                "status": "degraded",
+                "provider": "mistral",
+                "reachable": False,
+                "error": "MISTRAL_API_KEY не задан",
+                "model": CFG.mistral_model,
+                "api_url": backend.base_url,
             }
         try:
-            r = requests.get(
-                f"{CFG.mistral_base_url}/models",
-                headers={"Authorization": f"Bearer {CFG.mistral_api_key}"},
-                timeout=10,
-            )
+            r = backend.client().request("GET", "/models", read_timeout=10)
             models: list[str] = []
             if r.status_code == 200:
                 payload = r.json()
@@ -547,7 +4850,7 @@ def check_llm_health() -> dict[str, Any]:
                 "reachable": r.status_code == 200,
                 "model": CFG.mistral_model,
                 "model_listed": CFG.mistral_model in models if models else None,
-                "api_url": CFG.mistral_base_url,
+                "api_url": backend.base_url,
                 "available_models": models[:20],
             }
         except Exception as e:
@@ -557,28 +4860,143 @@ def check_llm_health() -> dict[str, Any]:
                 "reachable": False,
                 "error": str(e),
                 "model": CFG.mistral_model,
-                "api_url": CFG.mistral_base_url,
+                "api_url": backend.base_url,
             }
 
     try:
-        r = requests.get(f"{CFG.ollama_url}/api/tags", timeout=5)
+        r = backend.client().request("GET", "/api/tags", read_timeout=5)
         ollama_ok = r.status_code == 200
         models: list[str] = []
         if ollama_ok:
             models = [m["name"] for m in r.json().get("models", [])]
-        return {
+        check = {
             "status": "ok" if ollama_ok else "degraded",
             "provider": "ollama",
             "reachable": ollama_ok,
-            "ollama_url": CFG.ollama_url,
+            "ollama_url": backend.base_url,
             "model": CFG.ollama_model,
             "model_loaded": CFG.ollama_model in models,
             "available_models": models,
         }
+        routed = routed_models("ollama")
+        if routed:
+            check["routed_models"] = {m: m in models for m in routed}
+        return check
     except Exception as e:
         return {"status": "error", "provider": "ollama", "reachable": False, "error": str(e)}
 
 
+def probe_backends() -> list[dict[str, Any]]:
+    """Живой опрос всех бэкендов (параллельно, если их несколько).
+
+    Результат сразу учитывается предохранителями хостов Ollama.
+    """
+    backends = BACKENDS.backends
+    if len(backends) == 1:
+        checks = [check_backend_health(backends[0])]
+    else:
+        checks = list(fanout_pool().map(check_backend_health, backends))
+    for backend, check in zip(backends, checks):
+        if backend.provider == "ollama":
+            BACKENDS.observe_health(backend, check["reachable"])
+    return checks
+
+
+def health_summary(checks: list[dict[str, Any]]) -> dict[str, Any]:
+    """Сводка для /healthz по результатам probe_backends.
+
+    Верхний уровень — первый хост (как с одним OLLAMA_URL); сервис здоров, пока
+    отвечает хоть один основной хост. В "backends" — каждый хост с текущими
+    счётчиками балансировщика и состоянием предохранителя.
+    """
+    info = dict(checks[0])
+    primary = [c for b, c in zip(BACKENDS.backends, checks) if not b.overflow and not b.routed]
+    if not info.get("reachable") and any(c.get("reachable") for c in primary):
+        info["status"], info["reachable"] = "ok", True
+    info["backends"] = [
+        {**stats, **{k: check[k] for k in ("reachable", "model_loaded", "error") if k in check}}
+        for stats, check in zip(BACKENDS.stats(), checks)
+    ]
+    return info
+
+
+def check_llm_health() -> dict[str, Any]:
+    """Живая проверка активного провайдера (без кэша HealthMonitor)."""
+    return health_summary(probe_backends())
+
+
+class HealthMonitor:
+    """Фоновый опрос провайдера раз в VIORA_HEALTH_INTERVAL.
+
+    /healthz и /readyz отдают последний снимок с его возрастом, поэтому ни вкладки
+    браузера, ни пробы оркестратора не ходят в /api/tags и не ждут медленную
+    модель. Заодно снимок кормит предохранители BackendPool.
+    VIORA_HEALTH_INTERVAL=0 — без фона, живая проверка на каждый запрос.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._checks: list[dict[str, Any]] | None = None
+        self._checked_at = 0.0
+        self._duration = 0.0
+        self._first = threading.Event()
+        self._pid: int | None = None
+
+    def ensure_running(self) -> None:
+        """Поток опроса на процесс (ленивый старт, fork-safe)."""
+        pid = os.getpid()
+        if self.interval <= 0 or self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+        threading.Thread(target=self._loop, name="viora-health", daemon=True).start()
+
+    def _loop(self) -> None:
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                log.exception("health-check failed")
+            time.sleep(self.interval)
+
+    def refresh(self) -> list[dict[str, Any]]:
+        started = time.monotonic()
+        checks = probe_backends()
+        with self._lock:
+            self._checks = checks
+            self._checked_at = time.monotonic()
+            self._duration = self._checked_at - started
+        self._first.set()
+        return checks
+
+    def snapshot(self, *, wait: float = 0) -> tuple[list[dict[str, Any]] | None, float | None]:
+        """(результаты проверки, возраст в секундах); (None, None) — первой проверки ещё не было."""
+        if self.interval <= 0:
+            return self.refresh(), 0.0
+        self.ensure_running()
+        if wait and self._checks is None:
+            self._first.wait(wait)
+        with self._lock:
+            if self._checks is None:
+                return None, None
+            return self._checks, time.monotonic() - self._checked_at
+
+    def stale(self, age: float | None) -> bool:
+        # Проверка хоста может занять таймаут connect + 5 с — это не повод считать снимок протухшим.
+        return age is None or (self.interval > 0 and age > 3 * self.interval + CFG.connect_timeout + 10)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {"interval": self.interval, "last_duration": round(self._duration, 3)}
+
+
+HEALTH = HealthMonitor(CFG.health_interval)
+
+
 # ── Валидация ─────────────────────────────────────────────────────────────────
 def _json_required(body: Any) -> dict:
     if not isinstance(body, dict):
@@ -616,91 +5034,1366 @@ def _list_field(d: dict, key: str, *, min_len: int = 1, max_items: int = 30) ->
     return cleaned
 
 
-# ── Страницы ──────────────────────────────────────────────────────────────────
-@app.route("/")
-def index():
-    return render_template("index.html")
+# Поля запросов API (общие для Flask-маршрутов и ASGI-режима).
+def _life_args(data: dict) -> tuple[str, list[str]]:
+    return _str_field(data, "title"), _list_field(data, "outcomes", min_len=1, max_items=15)
+
+
+_LIFE_MAX_NODES = 15
+_LIFE_MAX_DEPTH = 4
+
+
+@dataclass(frozen=True)
+class LifeNode:
+    """Исход из дерева life: id узла на холсте, id родителя-исхода (None — ветка
+    от корня), текст для промпта — путь ветки «исход → уточнение» — и hash
+    результата, который уже есть у клиента (из прошлого ответа)."""
+
+    id: str
+    parent: str | None
+    outcome: str
+    hash: str | None = None
+
+
+def _life_nodes(raw: Any) -> list[LifeNode]:
+    """nodes: [{"id", "text", "children": [...]}] → плоский список в порядке обхода (сначала родитель)."""
+    nodes: list[LifeNode] = []
+    seen: set[str] = set()
+
+    def walk(items: Any, parent: LifeNode | None, depth: int) -> None:
+        if not isinstance(items, list):
+            raise ValueError("Поле «nodes» и children узлов должны быть массивами")
+        if items and depth > _LIFE_MAX_DEPTH:
+            raise ValueError(f"Ветки глубже {_LIFE_MAX_DEPTH} уровней не поддерживаются")
+        for item in items:
+            if not isinstance(item, dict):
+                raise ValueError("Узел должен быть объектом {id, text}")
+            node_id = item.get("id")
+            if not isinstance(node_id, str) or not node_id.strip() or len(node_id) > 100:
+                raise ValueError("У каждого узла должен быть строковый id")
+            if node_id in seen:
+                raise ValueError(f"Повторяющийся id узла: {node_id}")
+            seen.add(node_id)
+            text = _str_field(item, "text", max_len=1000)
+            known = item.get("hash")
+            node = LifeNode(node_id, parent.id if parent else None,
+                            f"{parent.outcome} → {text}" if parent else text,
+                            known if isinstance(known, str) else None)
+            nodes.append(node)
+            if len(nodes) > _LIFE_MAX_NODES:
+                raise ValueError(f"В поле «nodes» слишком много узлов (>{_LIFE_MAX_NODES})")
+            walk(item.get("children") or [], node, depth + 1)
+
+    walk(raw, None, 1)
+    if not nodes:
+        raise ValueError("В поле «nodes» нужен хотя бы один узел")
+    return nodes
+
+
+def _life_input(data: dict) -> tuple[str, list[str], list[LifeNode] | None]:
+    """Плоский список outcomes или дерево nodes со стабильными id (тогда результаты
+    несут id и parent узла, а вложенные исходы анализируются с контекстом ветки)."""
+    if "nodes" not in data:
+        title, outcomes = _life_args(data)
+        return title, outcomes, None
+    nodes = _life_nodes(data["nodes"])
+    return _str_field(data, "title"), [n.outcome for n in nodes], nodes
+
+
+def _next_frame_args(data: dict) -> tuple[str, str]:
+    return _str_field(data, "title"), _str_field(data, "current_frame")
+
+
+def _analyze_frames_args(data: dict) -> tuple[str, list[str]]:
+    return _str_field(data, "title"), _list_field(data, "frames", min_len=2, max_items=20)
+
+
+# ── SSE ───────────────────────────────────────────────────────────────────────
+def _sse(event: str, payload: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def _sse_response(gen: Generator[str, None, None]) -> Response:
+    return Response(stream_with_context(_until_cancelled(gen)), mimetype="text/event-stream",
+                    headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"})
+
+
+def _until_cancelled(gen: Generator[str, None, None]) -> Generator[str, None, None]:
+    """Клиент ушёл посреди потока — поток просто заканчивается, без ошибки в логе сервера."""
+    try:
+        yield from gen
+    except RequestCancelled:
+        pass
+
+
+def _sse_llm_stream(
+    events: Generator[tuple[str, Any], None, tuple[str, dict[str, Any]]],
+    *,
+    extra: dict[str, Any] | None = None,
+) -> Generator[str, None, tuple[str, dict[str, Any]]]:
+    """Перекладывает llm_stream в SSE: 'token' на кусок, 'section' на готовую секцию."""
+    while True:
+        try:
+            event, payload = next(events)
+        except StopIteration as stop:
+            return stop.value
+        yield _sse_llm_event(event, payload, extra)
+
+
+def _sse_llm_event(event: str, payload: Any, extra: dict[str, Any] | None = None) -> str:
+    """Событие llm_stream/llm_astream → SSE: 'token' на кусок, 'section' на готовую секцию,
+    'reset' — каскад отверг ответ быстрой модели, показанное сбрасывается."""
+    extra = extra or {}
+    if event == "token":
+        return _sse("token", {**extra, "text": payload})
+    if event == "reset":
+        return _sse("reset", {**extra, **payload})
+    key, value = payload
+    return _sse("section", {**extra, "key": key, "value": value})
+
+
+def _pump(gen: Generator[Any, None, Any], sink) -> Any:
+    """Отдаёт все элементы генератора в sink и возвращает его return-значение."""
+    while True:
+        try:
+            sink(next(gen))
+        except StopIteration as stop:
+            return stop.value
+
+
+# ── Страницы ──────────────────────────────────────────────────────────────────
+@app.route("/")
+def index():
+    return render_template("index.html")
+
+
+@app.route("/life")
+def life():
+    return render_template("life.html")
+
+
+@app.route("/flow")
+def flow():
+    return render_template("flow.html", prefetch=CFG.prefetch)
+
+
+# ── Статика: минификация, отпечатки, сжатие ───────────────────────────────────
+# Шаблоны ссылаются на статику через asset_url(): при VIORA_ASSETS=1 это
+# /assets/<путь>.<хэш>.<ext> — минифицированный файл из памяти с immutable-кэшем,
+# заранее сжатыми gzip/brotli-вариантами и ETag. Хэш меняется вместе с содержимым,
+# поэтому ручные ?v=N больше не нужны. /static/ Flask остаётся как был.
+_ASSET_TYPES = {
+    ".js": "application/javascript; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+}
+_ASSET_NAME_RE = re.compile(r"^(?P<stem>.+)\.(?P<hash>[0-9a-f]{10})(?P<ext>\.[a-z]+)$")
+_JS_REGEX_AFTER = frozenset("(,=:[!&|?{};+-*%<>~^")
+_JS_REGEX_KEYWORDS = frozenset({
+    "return", "typeof", "case", "do", "else", "in", "of", "new", "delete",
+    "void", "throw", "instanceof", "yield", "await",
+})
+
+
+def _js_string_end(src: str, i: int) -> int:
+    """Конец строкового литерала, начинающегося в src[i] (индекс после кавычки)."""
+    quote, n = src[i], len(src)
+    i += 1
+    while i < n:
+        c = src[i]
+        if c == "\\":
+            i += 2
+            continue
+        if c == quote or c == "\n":
+            return i + 1
+        i += 1
+    return n
+
+
+def _js_template_end(src: str, i: int) -> int:
+    """Конец шаблонной строки `…${…}…` с учётом вложенных выражений и строк."""
+    n = len(src)
+    i += 1
+    while i < n:
+        c = src[i]
+        if c == "\\":
+            i += 2
+        elif c == "`":
+            return i + 1
+        elif c == "$" and src.startswith("${", i):
+            i += 2
+            depth = 1
+            while i < n and depth:
+                c = src[i]
+                if c in "'\"":
+                    i = _js_string_end(src, i)
+                    continue
+                if c == "`":
+                    i = _js_template_end(src, i)
+                    continue
+                if c == "{":
+                    depth += 1
+                elif c == "}":
+                    depth -= 1
+                i += 1
+        else:
+            i += 1
+    return n
+
+
+def _js_regex_end(src: str, i: int) -> int:
+    """Конец литерала /…/flags или -1, если до конца строки его нет (это деление)."""
+    n = len(src)
+    i += 1
+    in_class = False
+    while i < n:
+        c = src[i]
+        if c == "\n":
+            return -1
+        if c == "\\":
+            i += 2
+            continue
+        if c == "[":
+            in_class = True
+        elif c == "]":
+            in_class = False
+        elif c == "/" and not in_class:
+            i += 1
+            while i < n and src[i].isalpha():
+                i += 1
+            return i
+        i += 1
+    return -1
+
+
+def minify_js(src: str) -> str:
+    """Консервативная минификация JS: без комментариев, отступов и пустых строк.
+
+    Строки, шаблонные строки и регулярные выражения копируются как есть. Переводы
+    строк сохраняются (на них держится автоматическая вставка «;»), пробелы
+    между токенами схлопываются в один, но не удаляются — смысл кода не меняется.
+    """
+    out: list[str] = []
+    gap = ""  # отложенный разделитель между токенами: "", " " или "\n"
+    prev = ""  # последний значимый символ (для различения /re/ и деления)
+    word = ""  # последнее слово (return /re/ …)
+    i, n = 0, len(src)
+
+    def emit(token: str) -> None:
+        nonlocal gap
+        if gap and out:
+            out.append(gap)
+        gap = ""
+        out.append(token)
+
+    while i < n:
+        c = src[i]
+        if c == "\n":
+            gap = "\n"
+            i += 1
+        elif c.isspace():
+            gap = gap or " "
+            i += 1
+        elif src.startswith("//", i):
+            j = src.find("\n", i)
+            i = n if j < 0 else j
+        elif src.startswith("/*", i):
+            j = src.find("*/", i + 2)
+            i = n if j < 0 else j + 2
+            gap = gap or " "
+        elif c in "'\"`":
+            j = _js_string_end(src, i) if c != "`" else _js_template_end(src, i)
+            emit(src[i:j])
+            prev, word, i = c, "", j
+        elif c == "/" and (not prev or prev in _JS_REGEX_AFTER or word in _JS_REGEX_KEYWORDS) and (
+            j := _js_regex_end(src, i)
+        ) > 0:
+            emit(src[i:j])
+            prev, word, i = "/", "", j
+        elif c.isalnum() or c in "_$" or ord(c) > 127:
+            j = i + 1
+            while j < n and (src[j].isalnum() or src[j] in "_$" or ord(src[j]) > 127):
+                j += 1
+            word = src[i:j]
+            emit(word)
+            prev, i = word[-1], j
+        else:
+            emit(c)
+            prev, word, i = c, "", i + 1
+    return "".join(out) + "\n"
+
+
+_CSS_TOKEN_RE = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|/\*.*?\*/|\s+|[{};,>]|[^"\'/\s{};,>]+|/', re.S)
+
+
+def minify_css(src: str) -> str:
+    """Минификация CSS: без комментариев и лишних пробелов вокруг { } ; , >.
+
+    Пробелы внутри значений (calc(a + b), составные селекторы) сохраняются.
+    """
+    out: list[str] = []
+    gap = False
+    for token in _CSS_TOKEN_RE.findall(src):
+        if token.startswith("/*") or token.isspace():
+            gap = True
+            continue
+        if token == "}" and out and out[-1] == ";":
+            out.pop()
+        elif gap and out and out[-1] not in "{};,>" and token not in "{};,>":
+            out.append(" ")
+        gap = False
+        out.append(token)
+    return "".join(out) + "\n"
+
+
+@dataclass
+class Asset:
+    """Собранный файл статики: минифицированное тело и его сжатые варианты."""
+
+    path: str  # путь относительно static/, например scripts/life.js
+    url: str
+    fingerprint: str
+    mimetype: str
+    body: bytes
+    gzip: bytes
+    br: bytes | None
+    source_size: int
+    mtime: float
+
+
+class AssetStore:
+    """Ленивая сборка статики в памяти процесса (отпечаток — sha256 содержимого).
+
+    Файл собирается при первом обращении; в debug-режиме — заново, если он
+    изменился на диске, чтобы правки были видны без перезапуска.
+    """
+
+    def __init__(self, root: str, *, enabled: bool, watch: bool) -> None:
+        self.root = root
+        self.enabled = enabled
+        self.watch = watch
+        self._assets: dict[str, Asset] = {}
+        self._by_url: dict[str, Asset] = {}
+        self._lock = threading.Lock()
+
+    def _build(self, path: str) -> Asset:
+        full = os.path.join(self.root, path)
+        with open(full, "rb") as f:
+            raw = f.read()
+        ext = os.path.splitext(path)[1]
+        text = raw.decode("utf-8")
+        body = (minify_js(text) if ext == ".js" else minify_css(text)).encode("utf-8")
+        fingerprint = hashlib.sha256(body).hexdigest()[:10]
+        stem = path[: -len(ext)]
+        return Asset(
+            path=path,
+            url=f"/assets/{stem}.{fingerprint}{ext}",
+            fingerprint=fingerprint,
+            mimetype=_ASSET_TYPES[ext],
+            body=body,
+            gzip=gzip.compress(body, compresslevel=9, mtime=0),
+            br=brotli.compress(body, quality=11) if brotli is not None else None,
+            source_size=len(raw),
+            mtime=os.path.getmtime(full),
+        )
+
+    def get(self, path: str) -> Asset | None:
+        """Собранный файл по пути относительно static/ (None — не файл статики)."""
+        if os.path.splitext(path)[1] not in _ASSET_TYPES or ".." in path.split("/"):
+            return None
+        asset = self._assets.get(path)
+        if asset is not None and not self.watch:
+            return asset
+        try:
+            if asset is not None and os.path.getmtime(os.path.join(self.root, path)) == asset.mtime:
+                return asset
+            built = self._build(path)
+        except (FileNotFoundError, NotADirectoryError):
+            # Нет такого файла (чужой или устаревший /assets/…) — обычный 404, не сбой сборки.
+            log.debug("Статика %s не найдена", path)
+            return None
+        except (OSError, UnicodeDecodeError):
+            log.exception("Статика %s не собрана", path)
+            return None
+        with self._lock:
+            old = self._assets.get(path)
+            if old is not None:
+                self._by_url.pop(old.url, None)
+            self._assets[path] = built
+            self._by_url[built.url] = built
+        return built
+
+    def by_url(self, url: str) -> Asset | None:
+        """Файл по адресу /assets/…; неизвестный отпечаток собирается по имени."""
+        asset = self._by_url.get(url)
+        if asset is not None:
+            return asset
+        m = _ASSET_NAME_RE.match(url.removeprefix("/assets/"))
+        if not m:
+            return None
+        asset = self.get(m["stem"] + m["ext"])
+        return asset if asset is not None and asset.url == url else None
+
+    def url_for(self, path: str) -> str:
+        if self.enabled:
+            asset = self.get(path)
+            if asset is not None:
+                return asset.url
+        return f"/static/{path}"
+
+    def paths(self) -> list[str]:
+        found = []
+        for dirpath, _, files in os.walk(self.root):
+            for name in files:
+                if os.path.splitext(name)[1] in _ASSET_TYPES:
+                    found.append(os.path.relpath(os.path.join(dirpath, name), self.root).replace(os.sep, "/"))
+        return sorted(found)
+
+    def write(self, out_dir: str) -> dict[str, str]:
+        """Собирает всю статику в out_dir (для раздачи nginx/CDN) и пишет manifest.json."""
+        manifest = {}
+        os.makedirs(out_dir, exist_ok=True)
+        for path in self.paths():
+            asset = self.get(path)
+            if asset is None:
+                continue
+            target = os.path.join(out_dir, asset.url.removeprefix("/assets/"))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            variants = [("", asset.body), (".gz", asset.gzip)] + ([(".br", asset.br)] if asset.br is not None else [])
+            for suffix, data in variants:
+                with open(target + suffix, "wb") as f:
+                    f.write(data)
+            manifest[path] = asset.url
+            log.info(
+                "%s → %s (%d → %d байт, gzip %d%s)",
+                path, asset.url, asset.source_size, len(asset.body), len(asset.gzip),
+                f", br {len(asset.br)}" if asset.br is not None else "",
+            )
+        with open(os.path.join(out_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        return manifest
+
+
+ASSETS = AssetStore(app.static_folder, enabled=CFG.assets, watch=CFG.debug)
+app.jinja_env.globals["asset_url"] = ASSETS.url_for
+
+
+def _accepted_encodings(header: str) -> set[str]:
+    """Кодировки из Accept-Encoding с q > 0."""
+    accepted = set()
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        q = params.strip().removeprefix("q=")
+        try:
+            if params and float(q) <= 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+@app.route("/assets/<path:filename>")
+def assets(filename: str):
+    asset = ASSETS.by_url(f"/assets/{filename}") if CFG.assets else None
+    if asset is None:
+        return jsonify({"error": "Не найдено"}), 404
+    accepted = _accepted_encodings(request.headers.get("Accept-Encoding", ""))
+    body, encoding = asset.body, ""
+    if asset.br is not None and "br" in accepted:
+        body, encoding = asset.br, "br"
+    elif "gzip" in accepted:
+        body, encoding = asset.gzip, "gzip"
+    # Для каждого варианта сжатия свой ETag; 304 — на любой из них: содержимое одно.
+    headers = {
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "ETag": f'"{asset.fingerprint}-{encoding}"' if encoding else f'"{asset.fingerprint}"',
+        "Vary": "Accept-Encoding",
+    }
+    tags = request.if_none_match
+    if tags.star_tag or any(tag.partition("-")[0] == asset.fingerprint for tag in tags.as_set(include_weak=True)):
+        return Response(status=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, content_type=asset.mimetype, headers=headers)
+
+
+# ── Health / version ──────────────────────────────────────────────────────────
+@app.route("/healthz")
+def healthz():
+    """Сводка по LLM-провайдеру из последнего фонового опроса (модель не дёргается)."""
+    checks, age = HEALTH.snapshot(wait=2.0)
+    if checks is None:
+        info: dict[str, Any] = {"status": "starting", "provider": CFG.llm_provider, "reachable": False}
+    else:
+        info = health_summary(checks)
+    ok = info.get("status") == "ok" and info.get("reachable", False) and not HEALTH.stale(age)
+    info["checked_age"] = round(age, 1) if age is not None else None
+    info["health"] = HEALTH.stats()
+    info["cache"] = RESPONSE_CACHE.stats()
+    info["rate_limit"] = RATE_LIMITER.stats()
+    info["singleflight"] = SINGLE_FLIGHT.stats()
+    info["scheduler"] = get_scheduler().stats()
+    info["jobs"] = JOBS.stats()
+    return jsonify(info), 200 if ok else 503
+
+
+@app.route("/livez")
+def livez():
+    """Liveness: процесс жив и отвечает; без ввода-вывода."""
+    return jsonify({"status": "ok", "uptime": round(time.time() - HEALTH.started_at, 1)})
+
+
+@app.route("/readyz")
+def readyz():
+    """Readiness: свежий снимок говорит, что модель доступна, а очередь не переполнена."""
+    checks, age = HEALTH.snapshot(wait=2.0)
+    reason = error = None
+    if checks is None:
+        reason = "первая проверка провайдера ещё не завершилась"
+    elif HEALTH.stale(age):
+        reason = f"проверка провайдера устарела ({age:.0f} с)"
+    else:
+        info = health_summary(checks)
+        loaded = [
+            b.get("model_loaded", True) for b in info["backends"]
+            if b.get("reachable") and not b["overflow"] and not b["routed"]
+        ]
+        if info.get("status") != "ok" or not info.get("reachable"):
+            reason, error = "LLM-провайдер недоступен", info.get("error")
+        elif CFG.llm_provider == "ollama" and not any(loaded):
+            reason = f"модель {CFG.ollama_model} не найдена ни на одном хосте Ollama"
+    sched = get_scheduler().stats()
+    if reason is None and sched["queued"] >= sched["max_queue"]:
+        reason = "очередь генераций заполнена"
+    body = {
+        "ready": reason is None,
+        "provider": CFG.llm_provider,
+        "checked_age": round(age, 1) if age is not None else None,
+    }
+    if reason:
+        body["reason"] = reason
+    if error:
+        body["error"] = error
+    return jsonify(body), 200 if reason is None else 503
+
+
+@METRICS.collector
+def _runtime_metrics() -> list[tuple[str, str, str, list[tuple[dict[str, Any], float]]]]:
+    cache = RESPONSE_CACHE.stats()
+    flights = SINGLE_FLIGHT.stats()
+    schedulers = {name: sched.stats() for name, sched in _SCHEDULERS.items()}
+    backends = BACKENDS.stats()
+    jobs = JOBS.stats()
+    rate = RATE_LIMITER.stats()
+    prefetch = PREFETCH.stats()
+    return [
+        ("viora_cache_requests_total", "counter", "Обращения к кэшу ответов по результату", [
+            ({"result": "hit"}, cache["hits"]),
+            ({"result": "miss"}, cache["misses"]),
+            ({"result": "bypass"}, cache["bypasses"]),
+        ]),
+        ("viora_cache_disk_hits_total", "counter", "Попадания в SQLite-уровень кэша", [({}, cache["disk_hits"])]),
+        ("viora_cache_entries", "gauge", "Записей в памяти кэша", [({}, cache["entries"])]),
+        ("viora_cache_bytes", "gauge", "Объём кэша в памяти", [({}, cache["bytes"])]),
+        ("viora_singleflight_inflight", "gauge", "Генерации, к которым могут присоединиться дубли", [
+            ({}, flights["inflight"]),
+        ]),
+        ("viora_singleflight_coalesced_total", "counter", "Запросы, склеенные с уже идущей генерацией", [
+            ({}, flights["coalesced"]),
+        ]),
+        ("viora_llm_inflight", "gauge", "Генерации в работе (занятые слоты планировщика)", [
+            ({"provider": name}, st["active"]) for name, st in schedulers.items()
+        ]),
+        ("viora_llm_queued", "gauge", "Запросы в очереди планировщика", [
+            ({"provider": name}, st["queued"]) for name, st in schedulers.items()
+        ]),
+        ("viora_llm_concurrency", "gauge", "Лимит одновременных генераций", [
+            ({"provider": name}, st["concurrency"]) for name, st in schedulers.items()
+        ]),
+        ("viora_llm_rejected_total", "counter", "Запросы, отклонённые из-за переполненной очереди (429)", [
+            ({"provider": name}, st["rejected"]) for name, st in schedulers.items()
+        ]),
+        ("viora_backend_outstanding", "gauge", "Запросы в работе на хосте", [
+            ({"backend": b["name"]}, b["outstanding"]) for b in backends
+        ]),
+        ("viora_backend_concurrency_limit", "gauge", "Адаптивный лимит одновременных генераций на хосте", [
+            ({"backend": b["name"]}, b["capacity"]) for b in backends
+        ]),
+        ("viora_backend_limit_decreases_total", "counter", "Снижения лимита хоста из-за перегрузки", [
+            ({"backend": b["name"]}, b["limit_decreases"]) for b in backends
+        ]),
+        ("viora_backend_up", "gauge", "1 — предохранитель хоста закрыт", [
+            ({"backend": b["name"]}, 1 if b["state"] == "closed" else 0) for b in backends
+        ]),
+        ("viora_backend_requests_total", "counter", "Запросы к хосту", [
+            ({"backend": b["name"]}, b["requests"]) for b in backends
+        ]),
+        ("viora_backend_failures_total", "counter", "Ошибки запросов к хосту", [
+            ({"backend": b["name"]}, b["failures"]) for b in backends
+        ]),
+        ("viora_backend_hedges_total", "counter", "Дублирующие (хеджированные) запросы на хост", [
+            ({"backend": b["name"]}, b["hedges"]) for b in backends
+        ]),
+        ("viora_backend_breaker_trips_total", "counter", "Срабатывания предохранителя хоста", [
+            ({"backend": b["name"]}, b["breaker_trips"]) for b in backends
+        ]),
+        ("viora_rate_limited_total", "counter", "Запросы, отклонённые лимитом клиента (429)", [
+            ({}, rate["limited"]),
+        ]),
+        ("viora_rate_charged_tokens_total", "counter", "Оценочные токены, списанные лимитом клиентов", [
+            ({}, rate["charged"]),
+        ]),
+        ("viora_jobs", "gauge", "Фоновые задачи в хранилище по статусу", [
+            ({"status": status}, n) for status, n in sorted(jobs["by_status"].items())
+        ]),
+        ("viora_jobs_running_here", "gauge", "Фоновые задачи, выполняемые этим процессом", [
+            ({}, jobs["running_here"]),
+        ]),
+        ("viora_jobs_created_total", "counter", "Созданные фоновые задачи", [({}, jobs["created"])]),
+        ("viora_jobs_cancelled_total", "counter", "Отменённые фоновые задачи", [({}, jobs["cancelled"])]),
+        ("viora_cancel_watched", "gauge", "Запросы и задачи под наблюдением монитора отмены", [
+            ({}, CANCELS.stats()["watched"]),
+        ]),
+        ("viora_prefetch_total", "counter", "Спекулятивные генерации следующего кадра по исходу", [
+            ({"outcome": outcome}, n) for outcome, n in sorted(prefetch.items()) if outcome != "running"
+        ]),
+        ("viora_prefetch_running", "gauge", "Идущие спекулятивные генерации", [({}, prefetch["running"])]),
+    ]
+
+
+@app.route("/metrics")
+def metrics():
+    """Метрики процесса в текстовом формате Prometheus."""
+    return Response(METRICS.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# ── API: life — пакетный анализ исходов (параллельно) ────────────────────────
+def _life_batch_size(data: dict, total: int) -> int:
+    """Сколько исходов класть в один промпт; 0 — по промпту на исход.
+
+    {"batch": true/false} в запросе перекрывает VIORA_LIFE_BATCH.
+    """
+    enabled = data["batch"] if isinstance(data.get("batch"), bool) else CFG.life_batch
+    if not enabled or total < 2:
+        return 0
+    return max(2, CFG.life_batch_size)
+
+
+def _life_chunks(idxs: list[int], batch_size: int) -> list[list[int]]:
+    if not batch_size:
+        return [[i] for i in idxs]
+    return [idxs[i:i + batch_size] for i in range(0, len(idxs), batch_size)]
+
+
+def _life_outcome_key(title: str, outcome: str) -> str:
+    """Ключ кэша ответа на build_prompt_pros_cons — тот же, что у llm_generate для одного исхода."""
+    return response_key(build_prompt_pros_cons(title, outcome), 0.7)
+
+
+def _life_hash(key: str) -> str:
+    """Хэш содержимого исхода по ключу кэша: меняется вместе с заголовком, текстом ветки или моделью."""
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def _life_reuse(
+    title: str, outcomes: list[str], nodes: list[LifeNode] | None, *, use_cache: bool,
+) -> tuple[list[tuple[int, dict]], list[int]]:
+    """Что можно не генерировать заново: (готовые результаты, индексы для модели).
+
+    Узел с hash, совпавшим с текущим, не изменился — клиенту уходит короткий
+    {"unchanged": true} без текста. Остальные исходы ищутся в кэше ответов
+    ({"reused": true}). Обход кэша (nocache) генерирует всё заново.
+    """
+    if not use_cache:
+        return [], list(range(len(outcomes)))
+    ready: list[tuple[int, dict]] = []
+    fresh: list[int] = []
+    for i, outcome in enumerate(outcomes):
+        key = _life_outcome_key(title, outcome)
+        if nodes and nodes[i].hash == _life_hash(key):
+            ready.append((i, {"outcome": outcome, "ok": True, "unchanged": True}))
+            continue
+        cached = RESPONSE_CACHE.get(key, count=False)
+        if cached is None:
+            fresh.append(i)
+            continue
+        RESPONSE_CACHE.note_hit()
+        ready.append((i, {**enrich_life_result(outcome, cached, ok=True), "reused": True}))
+    return ready, fresh
+
+
+def _life_cost(title: str, outcomes: list[str], idxs: list[int]) -> int:
+    """Стоимость для лимита — только исходы, которые пойдут в модель."""
+    return request_cost([build_prompt_pros_cons(title, outcomes[i]) for i in idxs])
+
+
+def _life_tag(
+    title: str, outcomes: list[str], nodes: list[LifeNode] | None, idx: int, payload: dict,
+) -> dict:
+    """index и hash исхода (его клиент пришлёт в следующий раз), у дерева — id и parent узла."""
+    payload["index"] = idx
+    payload["hash"] = _life_hash(_life_outcome_key(title, outcomes[idx]))
+    if nodes:
+        payload["id"] = nodes[idx].id
+        payload["parent"] = nodes[idx].parent
+    return payload
+
+
+def _life_batch_payloads(
+    title: str, outcomes: list[str], idxs: list[int], text: str,
+) -> list[tuple[int, dict | None]]:
+    """Делит пакетный ответ по исходам; удачные блоки кладутся в кэш под ключом
+    одиночного промпта — повторный анализ дерева находит их по исходу."""
+    parts = split_life_batch(text, len(idxs))
+    if not all(parts):
+        log.warning("life batch: %d of %d blocks malformed, retrying them one by one",
+                    parts.count(None), len(idxs))
+    for i, part in zip(idxs, parts):
+        if part:
+            RESPONSE_CACHE.put(_life_outcome_key(title, outcomes[i]), part[0])
+    return [
+        (i, enrich_life_result(outcomes[i], part[0], ok=True, sections=part[1]) if part else None)
+        for i, part in zip(idxs, parts)
+    ]
+
+
+def _analyze_life_chunk(
+    title: str, outcomes: list[str], idxs: list[int], *, use_cache: bool, client: str,
+    cancel: CancelToken | None = None,
+) -> list[tuple[int, dict | None]]:
+    """Один вызов модели на исходы idxs; None — исход нужно переспросить отдельно."""
+    if len(idxs) > 1:
+        try:
+            text = llm_generate(
+                build_prompt_pros_cons_batch(title, [outcomes[i] for i in idxs]), temperature=0.7,
+                use_cache=use_cache, client=client, priority=PRIORITY_BATCH, max_len=4000 * len(idxs),
+                cancel=cancel, items=list(range(1, len(idxs) + 1)),
+            )
+        except Exception:
+            log.exception("life batch failed for %d outcomes", len(idxs))
+            return [(i, None) for i in idxs]
+        return _life_batch_payloads(title, outcomes, idxs, text)
+    i = idxs[0]
+    try:
+        result = llm_generate(
+            build_prompt_pros_cons(title, outcomes[i]), temperature=0.7,
+            use_cache=use_cache, client=client, priority=PRIORITY_BATCH, cancel=cancel,
+        )
+        return [(i, enrich_life_result(outcomes[i], result, ok=True))]
+    except Exception as e:
+        log.exception("life analyze failed for %s", outcomes[i])
+        return [(i, enrich_life_result(outcomes[i], f"Ошибка ИИ: {e}", ok=False))]
+
+
+def iter_life_results(
+    title: str, outcomes: list[str], *, batch_size: int, use_cache: bool, client: str,
+    cancel: CancelToken | None = None, idxs: list[int] | None = None,
+) -> Generator[tuple[int, dict], None, None]:
+    """(индекс, результат) по мере готовности; idxs — только эти исходы (по умолчанию все).
+
+    С batch_size исходы идут пачками в один промпт, а исходы из битых пачек
+    сразу переспрашиваются по одному — результат есть у каждого исхода.
+    Отмена cancel обрывает идущие запросы к модели и бросает RequestCancelled;
+    незапущенные куски при отмене или закрытии генератора снимаются с пула.
+    """
+    pool = fanout_pool()
+    pending = {
+        pool.submit(_analyze_life_chunk, title, outcomes, chunk, use_cache=use_cache, client=client, cancel=cancel)
+        for chunk in _life_chunks(list(range(len(outcomes))) if idxs is None else idxs, batch_size)
+    }
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                for i, payload in fut.result():
+                    if payload is None:
+                        pending.add(pool.submit(
+                            _analyze_life_chunk, title, outcomes, [i], use_cache=use_cache, client=client,
+                            cancel=cancel,
+                        ))
+                    else:
+                        yield i, payload
+    finally:
+        for fut in pending:
+            fut.cancel()
+
+
+@app.route("/run-ai-life", methods=["POST"])
+def run_ai_life():
+    try:
+        data = _json_required(request.get_json(silent=True))
+        title, outcomes, nodes = _life_input(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    use_cache = not _cache_bypass(data)
+    ready, fresh = _life_reuse(title, outcomes, nodes, use_cache=use_cache)
+    batch_size = _life_batch_size(data, len(fresh))
+    client = _client_id()
+    try:
+        _charge(client, _life_cost(title, outcomes, fresh), tasks=len(_life_chunks(fresh, batch_size)))
+    except QueueFullError as e:
+        return _too_busy(e)
+
+    results: list[dict] = [None] * len(outcomes)  # type: ignore
+    try:
+        for i, payload in chain(ready, iter_life_results(
+            title, outcomes, batch_size=batch_size, use_cache=use_cache, client=client,
+            cancel=_request_cancel(), idxs=fresh,
+        )):
+            results[i] = _life_tag(title, outcomes, nodes, i, payload)
+    except RequestCancelled:
+        return _client_gone()
+
+    return jsonify({"results": results}), 200
+
+
+# ── API: life — streaming-вариант (SSE, по одному исходу) ─────────────────────
+@app.route("/run-ai-life/stream", methods=["POST"])
+def run_ai_life_stream():
+    """Server-Sent Events: события 'result' приходят по мере готовности каждого исхода.
+
+    С {"tokens": true} дополнительно идут 'token' и 'section' с полем index
+    (пакетный режим при этом не используется — каждому исходу свой поток).
+    Вместо outcomes можно прислать дерево nodes с id и hash узлов (см. _life_input):
+    неизменённые и закэшированные исходы приходят сразу, модель считает только новые.
+    """
+    try:
+        data = _json_required(request.get_json(silent=True))
+        title, outcomes, nodes = _life_input(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    use_cache = not _cache_bypass(data)
+    client = _client_id()
+    tokens = data.get("tokens") is True
+    ready, fresh = _life_reuse(title, outcomes, nodes, use_cache=use_cache)
+    batch_size = 0 if tokens else _life_batch_size(data, len(fresh))
+    try:
+        _charge(client, _life_cost(title, outcomes, fresh), tasks=len(_life_chunks(fresh, batch_size)))
+    except QueueFullError as e:
+        return _too_busy(e)
+    cancel = _request_cancel()
+
+    def token_stream() -> Generator[str, None, None]:
+        # Каждый исход стримит токены/секции в общую очередь; None — исход завершён.
+        yield _sse("start", {"total": len(outcomes), "tokens": True})
+        for idx, payload in ready:
+            yield _sse("result", _life_tag(title, outcomes, nodes, idx, payload))
+        events: Queue = Queue()
+
+        def analyze_streaming(idx: int, outcome: str) -> None:
+            try:
+                result, sections = _pump(
+                    _sse_llm_stream(
+                        llm_stream(
+                            build_prompt_pros_cons(title, outcome), kind="life", temperature=0.7,
+                            use_cache=use_cache, client=client, priority=PRIORITY_BATCH, cancel=cancel,
+                        ),
+                        extra={"index": idx},
+                    ),
+                    events.put,
+                )
+                payload = enrich_life_result(outcome, result, ok=True, sections=sections)
+            except RequestCancelled:
+                events.put(None)
+                return
+            except Exception as e:
+                log.exception("life stream failed for %s", outcome)
+                payload = enrich_life_result(outcome, f"Ошибка ИИ: {e}", ok=False)
+            events.put(_sse("result", _life_tag(title, outcomes, nodes, idx, payload)))
+            events.put(None)
+
+        pool = fanout_pool()
+        futures = [pool.submit(analyze_streaming, i, outcomes[i]) for i in fresh]
+        finished = 0
+        try:
+            while finished < len(fresh):
+                item = events.get()
+                cancel.check()
+                if item is None:
+                    finished += 1
+                    continue
+                yield item
+        finally:
+            for fut in futures:
+                fut.cancel()
+        yield _sse("done", {})
+
+    def event_stream() -> Generator[str, None, None]:
+        yield _sse("start", {"total": len(outcomes)})
+        for idx, payload in chain(ready, iter_life_results(
+            title, outcomes, batch_size=batch_size, use_cache=use_cache, client=client, cancel=cancel, idxs=fresh,
+        )):
+            yield _sse("result", _life_tag(title, outcomes, nodes, idx, payload))
+        yield _sse("done", {})
+
+    return _sse_response(token_stream() if tokens else event_stream())
+
+
+# ── API: jobs — фоновый анализ исходов с возобновляемыми результатами ────────
+# POST /jobs/life сразу отвечает 202 с job_id, работа идёт в фоне на общем
+# планировщике, каждый готовый исход пишется в журнал задачи. Результаты:
+# GET /jobs/<id> (опрос) или GET /jobs/<id>/events (SSE с id событий — после
+# обрыва браузер переподключается с Last-Event-ID и получает только недостающее).
+# DELETE /jobs/<id> отменяет задачу.
+_JOB_POLL = 1.0          # как часто follower проверяет события чужого воркера
+_SSE_KEEPALIVE = 15.0    # комментарий-пинг в простаивающем SSE, чтобы прокси не рвали соединение
+
+
+def _job_links(job: dict[str, Any]) -> dict[str, Any]:
+    job_id = job["job_id"]
+    return {**job, "status_url": f"/jobs/{job_id}", "events_url": f"/jobs/{job_id}/events"}
+
+
+def _job_created(job: dict[str, Any]) -> Response:
+    resp = app.json.response(_job_links(job))
+    resp.status_code = 202
+    resp.headers["Location"] = f"/jobs/{job['job_id']}"
+    return resp
+
+
+def _job_not_found() -> tuple[Response, int]:
+    return app.json.response({"error": "Задача не найдена или устарела"}), 404
+
+
+def _job_snapshot(job: dict[str, Any]) -> dict[str, Any]:
+    """Статус задачи с готовыми на сейчас результатами (None — исход ещё считается)."""
+    results: list[dict | None] = [None] * job["total"]
+    error = None
+    for _seq, event, data in JOBS.events(job["job_id"]):
+        if event == "result":
+            payload = json.loads(data)
+            results[payload["index"]] = payload
+        elif event == "error":
+            error = json.loads(data).get("error")
+    snapshot = {**_job_links(job), "results": results}
+    if error:
+        snapshot["error"] = error
+    return snapshot
+
 
+def _last_event_id(headers: Headers, args: dict) -> int:
+    """Last-Event-ID (переподключение EventSource) или ?last_event_id= для ручного возобновления."""
+    raw = headers.get("Last-Event-ID") or args.get("last_event_id") or "0"
+    try:
+        return max(int(raw), 0)
+    except ValueError:
+        return 0
 
-@app.route("/life")
-def life():
-    return render_template("life.html")
 
+def _sse_job_event(seq: int, event: str, data: str) -> str:
+    return f"id: {seq}\nevent: {event}\ndata: {data}\n\n"
 
-@app.route("/flow")
-def flow():
-    return render_template("flow.html")
 
+def _run_life_job(
+    job_id: str, title: str, outcomes: list[str], *, nodes: list[LifeNode] | None,
+    ready: list[tuple[int, dict]], fresh: list[int],
+    batch_size: int, use_cache: bool, client: str, cancel: CancelToken,
+) -> None:
+    # Отмена в этом процессе приходит через cancel.cancel(), из другого воркера — флагом в базе.
+    CANCELS.watch(cancel, lambda: JOBS.cancel_requested(job_id))
+    completed = 0
+    try:
+        for idx, payload in chain(ready, iter_life_results(
+            title, outcomes, batch_size=batch_size, use_cache=use_cache, client=client, cancel=cancel, idxs=fresh,
+        )):
+            JOBS.add_event(job_id, "result", _life_tag(title, outcomes, nodes, idx, payload))
+            completed += 1
+    except RequestCancelled:
+        pass
+    except Exception:
+        log.exception("life job %s failed", job_id)
+        JOBS.add_event(job_id, "error", {"error": "Внутренняя ошибка сервера"})
+        return
+    finally:
+        CANCELS.unwatch(cancel)
+    if completed < len(outcomes):
+        JOBS.finish_cancelled(job_id)
+    else:
+        JOBS.add_event(job_id, "done", {})
 
-# ── Health / version ──────────────────────────────────────────────────────────
-@app.route("/healthz")
-def healthz():
-    """Проверяет доступность активного LLM-провайдера (Ollama или Mistral)."""
-    info = check_llm_health()
-    ok = info.get("status") == "ok" and info.get("reachable", False)
-    return jsonify(info), 200 if ok else 503
 
+def job_event_stream(job_id: str, after: int) -> Generator[str, None, None]:
+    """События задачи после after, затем новые по мере появления — до финального."""
+    idle = 0.0
+    while True:
+        batch = JOBS.events(job_id, after)
+        for seq, event, data in batch:
+            yield _sse_job_event(seq, event, data)
+            after = seq
+            if event in _JOB_FINAL_EVENTS:
+                return
+        if batch:
+            idle = 0.0
+            continue
+        started = time.monotonic()
+        if not JOBS.wait(job_id, after, _JOB_POLL):
+            return
+        idle += time.monotonic() - started
+        if idle >= _SSE_KEEPALIVE:
+            idle = 0.0
+            yield ": ping\n\n"
 
-# ── API: life — пакетный анализ исходов (параллельно) ────────────────────────
-@app.route("/run-ai-life", methods=["POST"])
-def run_ai_life():
+
+@app.route("/jobs/life", methods=["POST"])
+def create_life_job():
+    """Тело как у /run-ai-life; ответ 202 с job_id, status_url и events_url."""
     try:
         data = _json_required(request.get_json(silent=True))
-        title = _str_field(data, "title")
-        outcomes = _list_field(data, "outcomes", min_len=1, max_items=15)
+        title, outcomes, nodes = _life_input(data)
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
+    use_cache = not _cache_bypass(data)
+    ready, fresh = _life_reuse(title, outcomes, nodes, use_cache=use_cache)
+    batch_size = _life_batch_size(data, len(fresh))
+    client = _client_id()
+    try:
+        _charge(client, _life_cost(title, outcomes, fresh), tasks=len(_life_chunks(fresh, batch_size)))
+    except QueueFullError as e:
+        return _too_busy(e)
+
+    cancel = CancelToken()
+    job_id = JOBS.create("life", len(outcomes), cancel.cancel)
+    JOBS.add_event(job_id, "start", {"job_id": job_id, "total": len(outcomes)})
+    threading.Thread(
+        target=_run_life_job, args=(job_id, title, outcomes),
+        kwargs={"nodes": nodes, "ready": ready, "fresh": fresh, "batch_size": batch_size,
+                "use_cache": use_cache, "client": client, "cancel": cancel},
+        name=f"viora-job-{job_id[:8]}", daemon=True,
+    ).start()
+    return _job_created(JOBS.get(job_id))
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id: str):
+    job = JOBS.get(job_id)
+    if job is None:
+        return _job_not_found()
+    return jsonify(_job_snapshot(job)), 200
+
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id: str):
+    """SSE: start → result* → done | cancelled | error; у каждого события id для Last-Event-ID."""
+    if JOBS.get(job_id) is None:
+        return _job_not_found()
+    return _sse_response(job_event_stream(job_id, _last_event_id(request.headers, request.args)))
+
+
+@app.route("/jobs/<job_id>", methods=["DELETE"])
+def cancel_job(job_id: str):
+    """Отмена: уже готовые результаты остаются доступны до истечения VIORA_JOB_TTL."""
+    job = JOBS.request_cancel(job_id)
+    if job is None:
+        return _job_not_found()
+    return jsonify(_job_links(job)), 202 if job["status"] == "running" else 200
+
+
+# ── API: flow — спекулятивная подготовка следующего кадра ────────────────────
+@dataclass
+class _Prefetch:
+    key: str
+    token: CancelToken
+    future: Future
+    claimed: bool = False  # ответ уже ждёт клик — не вытесняется
+    expires: float = 0.0
 
-    def analyze(outcome: str) -> dict:
+
+class PrefetchStore:
+    """Заранее сгенерированные ответы /run-ai-flow-next-frame: по одному на клиента.
+
+    Страница присылает последний отредактированный кадр; генерация идёт с
+    PRIORITY_SPECULATIVE и только на свободный слот планировщика провайдера
+    next_frame (prefetch_scheduler), а встал кто-то в очередь — незатребованная
+    спекуляция отменяется и отдаёт слот. Новый кадр
+    того же клиента отменяет прежний. Клик по кадру забирает готовый ответ или
+    дожидается идущей генерации; неиспользованный ответ живёт ttl секунд.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: dict[str, _Prefetch] = {}
+        self.counts = {
+            outcome: 0
+            for outcome in ("started", "hit", "cancelled", "preempted", "skipped", "limited", "expired", "failed")
+        }
+
+    def _count(self, outcome: str) -> None:
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def start(self, client: str, key: str, run, charge=None) -> str:
+        """Запускает run(cancel) → текст ответа в фоне.
+
+        Статус: started, running (уже готовится), ready (уже готов), busy (нет свободного слота),
+        limited (charge() — списание с лимита клиента — бросил RateLimited).
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(client)
+            if entry is not None and entry.key == key:
+                if not entry.future.done():
+                    return "running"
+                if entry.future.exception() is None and entry.expires > now:
+                    return "ready"
+            old = self._entries.pop(client, None)
+        if old is not None:
+            self._drop(old)
+        if not prefetch_scheduler().idle():
+            self._count("skipped")
+            return "busy"
+        if charge is not None:
+            try:
+                charge()
+            except RateLimited:
+                self._count("limited")
+                return "limited"
+        entry = _Prefetch(key=key, token=CancelToken(), future=Future())
+        entry.future.set_running_or_notify_cancel()
+        with self._lock:
+            self._entries[client] = entry
+            self.counts["started"] += 1
+        fanout_pool().submit(self._run, client, entry, run)
+        return "started"
+
+    def _run(self, client: str, entry: _Prefetch, run) -> None:
         try:
-            result = llm_generate(build_prompt_pros_cons(title, outcome), temperature=0.7)
-            return enrich_life_result(outcome, result, ok=True)
+            result = run(entry.token)
+        except RequestCancelled as e:
+            entry.future.set_exception(e)
+        except QueueFullError as e:
+            self._count("skipped")  # слот заняли между проверкой и генерацией
+            entry.future.set_exception(e)
         except Exception as e:
-            log.exception("life analyze failed for %s", outcome)
-            return enrich_life_result(outcome, f"Ошибка ИИ: {e}", ok=False)
+            log.warning("flow prefetch failed: %s", e)
+            self._count("failed")
+            entry.future.set_exception(e)
+        else:
+            entry.expires = time.monotonic() + self.ttl
+            entry.future.set_result(result)
+            return
+        with self._lock:
+            if self._entries.get(client) is entry:
+                del self._entries[client]
 
-    results: list[dict] = [None] * len(outcomes)  # type: ignore
-    with ThreadPoolExecutor(max_workers=min(CFG.max_workers, len(outcomes))) as ex:
-        future_to_idx = {ex.submit(analyze, o): i for i, o in enumerate(outcomes)}
-        for fut in as_completed(future_to_idx):
-            results[future_to_idx[fut]] = fut.result()
+    def _drop(self, entry: _Prefetch) -> None:
+        if not entry.future.done():
+            entry.token.cancel()
+            self._count("cancelled")
+        elif entry.future.exception() is None:
+            self._count("expired")
 
-    return jsonify({"results": results}), 200
+    def cancel(self, client: str) -> bool:
+        """Кадр изменился: идущая генерация отменяется, готовый ответ выбрасывается."""
+        with self._lock:
+            entry = self._entries.pop(client, None)
+        if entry is None:
+            return False
+        self._drop(entry)
+        return True
 
+    def claim(self, client: str, key: str) -> Future | None:
+        """Future спекулятивного ответа на key (клиент кликнул); с этого момента не вытесняется."""
+        with self._lock:
+            entry = self._entries.get(client)
+            if entry is None or entry.key != key:
+                return None
+            entry.claimed = True
+            return entry.future
 
-# ── API: life — streaming-вариант (SSE, по одному исходу) ─────────────────────
-@app.route("/run-ai-life/stream", methods=["POST"])
-def run_ai_life_stream():
-    """Server-Sent Events: события 'result' приходят по мере готовности каждого исхода."""
+    def consume(self, client: str, key: str, fut: Future) -> str | None:
+        """Результат затребованного ответа (один раз); None — генерировать как обычно."""
+        with self._lock:
+            entry = self._entries.get(client)
+            if entry is None or entry.future is not fut:
+                return None
+            del self._entries[client]
+        if fut.exception() is not None:
+            return None
+        if entry.expires <= time.monotonic():
+            self._count("expired")
+            return None
+        self._count("hit")
+        return fut.result()
+
+    def take(self, client: str, key: str, cancel: CancelToken | None = None) -> str | None:
+        """claim + ожидание идущей генерации (прерываемое cancel) + consume."""
+        fut = self.claim(client, key)
+        if fut is None:
+            return None
+        try:
+            _future_result(fut, cancel)
+        except Exception:
+            pass
+        return self.consume(client, key, fut)
+
+    async def atake(self, client: str, key: str) -> str | None:
+        """take для ASGI-режима: ожидание без потока."""
+        fut = self.claim(client, key)
+        if fut is None:
+            return None
+        try:
+            await asyncio.wrap_future(fut)
+        except (Exception, RequestCancelled):
+            pass
+        return self.consume(client, key, fut)
+
+    def preempt(self) -> None:
+        """on_contention планировщика: одна незатребованная генерация уступает слот."""
+        with self._lock:
+            victim = next(
+                (e for e in self._entries.values() if not e.claimed and not e.future.done() and not e.token.cancelled),
+                None,
+            )
+        if victim is not None:
+            victim.token.cancel()
+            self._count("preempted")
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {"running": sum(not e.future.done() for e in self._entries.values()), **self.counts}
+
+
+def prefetch_scheduler() -> LLMScheduler:
+    """Планировщик провайдера, которому маршрут моделей отдаёт next_frame (VIORA_MODEL_ROUTES)."""
+    route = CFG.model_routes.get("next_frame")
+    return get_scheduler(route.provider if route else None)
+
+
+PREFETCH = PrefetchStore(ttl=CFG.prefetch_ttl)
+if CFG.prefetch:
+    prefetch_scheduler().on_contention = PREFETCH.preempt
+
+
+@app.route("/run-ai-flow-next-frame/prefetch", methods=["POST", "DELETE"])
+def run_ai_flow_next_frame_prefetch():
+    """POST — подготовить следующий кадр заранее (202), DELETE — кадр изменился, отменить.
+
+    Запущенная генерация списывает request_cost с лимита клиента; при пустом
+    бюджете кадр просто не готовится (status: limited), без 429.
+    """
+    if not CFG.prefetch:
+        return jsonify({"error": "Спекулятивная генерация выключена (VIORA_PREFETCH=1)"}), 404
+    client = _client_id()
+    if request.method == "DELETE":
+        return jsonify({"cancelled": PREFETCH.cancel(client)}), 200
     try:
         data = _json_required(request.get_json(silent=True))
-        title = _str_field(data, "title")
-        outcomes = _list_field(data, "outcomes", min_len=1, max_items=15)
+        title, current_frame = _next_frame_args(data)
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
 
-    def event_stream() -> Generator[str, None, None]:
-        yield f"event: start\ndata: {json.dumps({'total': len(outcomes)})}\n\n"
+    prompt = build_prompt_next_frame(title, current_frame)
+    key = response_key(prompt, 0.8)
+    if RESPONSE_CACHE.get(key, count=False) is not None:
+        PREFETCH.cancel(client)
+        return jsonify({"status": "cached"}), 200
+    status = PREFETCH.start(client, key, lambda cancel: llm_generate(
+        prompt, temperature=0.8, client=client, priority=PRIORITY_SPECULATIVE, cancel=cancel,
+    ), charge=lambda: RATE_LIMITER.take(client, request_cost([prompt])))
+    return jsonify({"status": status}), 202
 
-        def analyze(idx: int, outcome: str) -> tuple[int, dict]:
-            try:
-                result = llm_generate(build_prompt_pros_cons(title, outcome), temperature=0.7)
-                return idx, enrich_life_result(outcome, result, ok=True, index=idx)
-            except Exception as e:
-                return idx, enrich_life_result(outcome, f"Ошибка ИИ: {e}", ok=False, index=idx)
 
-        with ThreadPoolExecutor(max_workers=min(CFG.max_workers, len(outcomes))) as ex:
-            futs = [ex.submit(analyze, i, o) for i, o in enumerate(outcomes)]
-            for fut in as_completed(futs):
-                idx, payload = fut.result()
-                if "index" not in payload:
-                    payload["index"] = idx
-                yield f"event: result\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+# ── API: flow — map-reduce для больших наборов кадров ────────────────────────
+def _analyze_map_reduce(data: dict, total: int) -> bool:
+    """Оценивать ли кадры кусками до сравнения; {"map_reduce": true/false} перекрывает конфиг.
+
+    Без смысла, если кадров не больше, чем попадает в финальное сравнение.
+    """
+    if isinstance(data.get("map_reduce"), bool):
+        enabled = data["map_reduce"]
+    else:
+        enabled = CFG.flow_map_min > 0 and total >= CFG.flow_map_min
+    return enabled and total > CFG.flow_shortlist
 
-        yield "event: done\ndata: {}\n\n"
 
-    return Response(stream_with_context(event_stream()), mimetype="text/event-stream",
-                    headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"})
+def _frame_chunks(total: int) -> list[list[int]]:
+    """Номера кадров (с 1) по кускам map-этапа."""
+    numbers = list(range(1, total + 1))
+    return [numbers[i:i + CFG.flow_map_chunk] for i in range(0, total, CFG.flow_map_chunk)]
+
+
+def _score_prompt(title: str, frames: list[str], numbers: list[int]) -> str:
+    return build_prompt_score_frames(title, [frames[n - 1] for n in numbers], numbers)
+
+
+def _uncached_cost(prompt: str, temperature: float, use_cache: bool, items: list[int] | None = None) -> int:
+    """Стоимость генерации для лимита; ответ из кэша бесплатен — как закэшированные исходы life."""
+    if use_cache and RESPONSE_CACHE.get(response_key(prompt, temperature, items), count=False) is not None:
+        return 0
+    return request_cost([prompt], items)
+
+
+def _frames_map_cost(title: str, frames: list[str], use_cache: bool) -> tuple[int, str, int]:
+    """(стоимость, провайдер, число кусков) map-этапа: платят куски, оценок которых нет в кэше.
+
+    Сравнение отобранных кадров списывается отдельно, после отбора: его промпт зависит от оценок.
+    """
+    chunks = _frame_chunks(len(frames))
+    prompts = [(_score_prompt(title, frames, numbers), numbers) for numbers in chunks]
+    cost = sum(_uncached_cost(prompt, 0.3, use_cache, numbers) for prompt, numbers in prompts)
+    return cost, model_route(prompts[0][0]).provider, len(chunks)
+
+
+def _frames_shortlist(
+    title: str, frames: list[str], chunks: list[list[int]], texts: list[str | Exception],
+) -> tuple[str, dict]:
+    """Итог map-этапа → (промпт сравнения отобранных кадров, сводка для ответа).
+
+    Упавший кусок не роняет запрос: его кадры идут в отбор без оценки, после
+    оценённых. Если упали все куски — ошибка первого.
+    """
+    errors = [t for t in texts if isinstance(t, Exception)]
+    if len(errors) == len(texts):
+        raise errors[0]
+    scores: dict[int, tuple[float, str]] = {}
+    for numbers, text in zip(chunks, texts):
+        if not isinstance(text, Exception):
+            scores.update(parse_frame_scores(text, numbers))
+    ranked = sorted(range(1, len(frames) + 1), key=lambda n: (n not in scores, -scores.get(n, (0.0, ""))[0], n))
+    shortlist = sorted(ranked[:CFG.flow_shortlist])
+    summary = {
+        "chunks": len(chunks),
+        "failed_chunks": len(errors),
+        "shortlist": shortlist,
+        "scores": [
+            {"frame": n, "score": scores[n][0] if n in scores else None, "note": scores[n][1] if n in scores else ""}
+            for n in range(1, len(frames) + 1)
+        ],
+    }
+    prompt = build_prompt_analyze_frames(
+        title, [frames[n - 1] for n in shortlist], numbers=shortlist, total=len(frames),
+    )
+    return prompt, summary
+
+
+def shortlist_frames(
+    title: str, frames: list[str], *, use_cache: bool, client: str, cancel: CancelToken | None = None,
+) -> tuple[str, dict]:
+    """Map-этап: куски кадров оцениваются параллельно; см. _frames_shortlist."""
+    chunks = _frame_chunks(len(frames))
+    pool = fanout_pool()
+    futures = [
+        pool.submit(
+            llm_generate, _score_prompt(title, frames, numbers), temperature=0.3,
+            use_cache=use_cache, client=client, priority=PRIORITY_INTERACTIVE, cancel=cancel, items=numbers,
+        )
+        for numbers in chunks
+    ]
+    texts: list[str | Exception] = []
+    try:
+        for numbers, fut in zip(chunks, futures):
+            try:
+                texts.append(fut.result())
+            except QueueFullError:
+                raise
+            except Exception as e:
+                log.warning("flow analyze: frames %d–%d not scored: %s", numbers[0], numbers[-1], e)
+                texts.append(e)
+    finally:
+        for fut in futures:
+            fut.cancel()
+    return _frames_shortlist(title, frames, chunks, texts)
 
 
 # ── API: flow ─────────────────────────────────────────────────────────────────
@@ -708,15 +6401,28 @@ def run_ai_life_stream():
 def run_ai_flow_next_frame():
     try:
         data = _json_required(request.get_json(silent=True))
-        title = _str_field(data, "title")
-        current_frame = _str_field(data, "current_frame")
+        title, current_frame = _next_frame_args(data)
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
 
+    prompt = build_prompt_next_frame(title, current_frame)
+    use_cache = not _cache_bypass(data)
+    client = _client_id()
+    cancel = _request_cancel()
     try:
-        result = llm_generate(
-            build_prompt_next_frame(title, current_frame), temperature=0.8
+        key = response_key(prompt, 0.8)
+        prefetched = PREFETCH.take(client, key, cancel) if use_cache else None
+        if not prefetched:
+            # Спекулятивный ответ уже оплачен при запуске — списываем только генерацию.
+            _charge(client, _uncached_cost(prompt, 0.8, use_cache), model_route(prompt).provider)
+        result = prefetched or llm_generate(
+            prompt, temperature=0.8,
+            use_cache=use_cache, client=client, priority=PRIORITY_INTERACTIVE, cancel=cancel,
         )
+    except QueueFullError as e:
+        return _too_busy(e)
+    except RequestCancelled:
+        return _client_gone()
     except Exception as e:
         log.exception("flow next_frame failed")
         return jsonify({"error": f"Ошибка ИИ: {e}"}), 502
@@ -726,6 +6432,7 @@ def run_ai_flow_next_frame():
         "current_frame": current_frame,
         "result": result,
         **parse_flow_next_frame_sections(result),
+        **({"prefetched": True} if prefetched else {}),
     }), 200
 
 
@@ -733,15 +6440,33 @@ def run_ai_flow_next_frame():
 def run_ai_flow_analyze_frames():
     try:
         data = _json_required(request.get_json(silent=True))
-        title = _str_field(data, "title")
-        frames = _list_field(data, "frames", min_len=2, max_items=20)
+        title, frames = _analyze_frames_args(data)
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
 
+    use_cache = not _cache_bypass(data)
+    map_reduce = _analyze_map_reduce(data, len(frames))
+    client = _client_id()
+    cancel = _request_cancel()
+    extra: dict[str, Any] = {}
     try:
+        if map_reduce:
+            cost, provider, chunks = _frames_map_cost(title, frames, use_cache)
+            _charge(client, cost, provider, tasks=chunks)
+            prompt, extra["map_reduce"] = shortlist_frames(
+                title, frames, use_cache=use_cache, client=client, cancel=cancel,
+            )
+        else:
+            prompt = build_prompt_analyze_frames(title, frames)
+        _charge(client, _uncached_cost(prompt, 0.3, use_cache), model_route(prompt).provider)
         result = llm_generate(
-            build_prompt_analyze_frames(title, frames), temperature=0.3
+            prompt, temperature=0.3,
+            use_cache=use_cache, client=client, priority=PRIORITY_INTERACTIVE, cancel=cancel,
         )
+    except QueueFullError as e:
+        return _too_busy(e)
+    except RequestCancelled:
+        return _client_gone()
     except Exception as e:
         log.exception("flow analyze failed")
         return jsonify({"error": f"Ошибка ИИ: {e}"}), 502
@@ -751,9 +6476,98 @@ def run_ai_flow_analyze_frames():
         "frames": frames,
         "result": result,
         **parse_flow_analyze_sections(result),
+        **extra,
     }), 200
 
 
+# ── API: flow — streaming-варианты (SSE, по токенам) ──────────────────────────
+def _flow_token_stream(
+    kind: str, prompt: str, *, temperature: float, data: dict, base: dict,
+    shortlist: bool = False,
+) -> Response:
+    """start → [map_reduce] → token* / section* → result (та же форма, что у обычного ответа) → done.
+
+    shortlist — сначала map-этап (shortlist_frames), его сводка уходит событием
+    map_reduce, а токены — уже от сравнения отобранных кадров. Лимит (_charge)
+    списывается до ответа, чтобы отказ пришёл обычным 429; сравнение после
+    map-этапа и невостребованный спекулятивный ответ — уже событием error.
+    """
+    use_cache = not _cache_bypass(data)
+    client = _client_id()
+    # Готовящийся спекулятивный ответ уже оплачен; списываем, только если он не пригодится.
+    claimed = not shortlist and use_cache and PREFETCH.claim(client, response_key(prompt, temperature)) is not None
+    try:
+        if shortlist:
+            cost, provider, chunks = _frames_map_cost(base["title"], base["frames"], use_cache)
+            _charge(client, cost, provider, tasks=chunks)
+        elif not claimed:
+            _charge(client, _uncached_cost(prompt, temperature, use_cache), model_route(prompt).provider)
+    except QueueFullError as e:
+        return _too_busy(e)
+    cancel = _request_cancel()
+
+    def event_stream() -> Generator[str, None, None]:
+        nonlocal prompt
+        yield _sse("start", {})
+        extra = {}
+        try:
+            if shortlist:
+                prompt, extra["map_reduce"] = shortlist_frames(
+                    base["title"], base["frames"], use_cache=use_cache, client=client, cancel=cancel,
+                )
+                yield _sse("map_reduce", extra["map_reduce"])
+            key = response_key(prompt, temperature)
+            prefetched = PREFETCH.take(client, key, cancel) if use_cache else None
+            if prefetched:
+                extra["prefetched"] = True
+            elif claimed or shortlist:
+                _charge(client, _uncached_cost(prompt, temperature, use_cache), model_route(prompt).provider)
+            result, sections = yield from _sse_llm_stream(
+                _ready_stream(kind, prefetched) if prefetched else
+                llm_stream(prompt, kind=kind, temperature=temperature, use_cache=use_cache,
+                           client=client, priority=PRIORITY_INTERACTIVE, cancel=cancel),
+            )
+        except QueueFullError as e:
+            yield _sse("error", _too_busy_body(e))
+            return
+        except Exception as e:
+            log.exception("flow %s stream failed", kind)
+            yield _sse("error", {"error": f"Ошибка ИИ: {e}"})
+            return
+        yield _sse("result", {**base, "result": result, **sections, **extra})
+        yield _sse("done", {})
+
+    return _sse_response(event_stream())
+
+
+@app.route("/run-ai-flow-next-frame/stream", methods=["POST"])
+def run_ai_flow_next_frame_stream():
+    try:
+        data = _json_required(request.get_json(silent=True))
+        title, current_frame = _next_frame_args(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return _flow_token_stream(
+        "next_frame", build_prompt_next_frame(title, current_frame), temperature=0.8,
+        data=data, base={"title": title, "current_frame": current_frame},
+    )
+
+
+@app.route("/run-ai-flow-analyze-frames/stream", methods=["POST"])
+def run_ai_flow_analyze_frames_stream():
+    try:
+        data = _json_required(request.get_json(silent=True))
+        title, frames = _analyze_frames_args(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    map_reduce = _analyze_map_reduce(data, len(frames))
+    return _flow_token_stream(
+        "analyze", build_prompt_analyze_frames(title, frames), temperature=0.3,
+        data=data, base={"title": title, "frames": frames},
+        shortlist=map_reduce,
+    )
+
+
 # ── Error handlers ────────────────────────────────────────────────────────────
 @app.errorhandler(404)
 def not_found(_):
@@ -765,7 +6579,633 @@ def internal_error(_):
     return jsonify({"error": "Внутренняя ошибка сервера"}), 500
 
 
+# ── ASGI-режим (uvicorn main:asgi_app) ────────────────────────────────────────
+# LLM-маршруты обслуживаются корутинами: ожидание модели, очереди планировщика
+# и SSE-соединения не держат потоков, поэтому на узле помещаются тысячи
+# висящих запросов. Остальные маршруты (страницы, статика, /healthz) отдаёт
+# тот же Flask через мост WSGI→ASGI. Нужны httpx и asgiref:
+#   pip install uvicorn httpx asgiref && uvicorn main:asgi_app --port 5001
+class _AsgiRequest:
+    """То немногое из запроса, что нужно LLM-маршрутам."""
+
+    def __init__(self, scope: dict, body: bytes, path_params: dict[str, str] | None = None):
+        self.headers = Headers([
+            (name.decode("latin-1"), value.decode("latin-1"))
+            for name, value in scope.get("headers") or []
+        ])
+        client = scope.get("client")
+        self.remote_addr = client[0] if client else None
+        self.body = body
+        self.path_params = path_params or {}
+        self.args = dict(parse_qsl((scope.get("query_string") or b"").decode("latin-1")))
+
+    def get_json(self) -> Any:
+        """Как request.get_json(silent=True): не JSON или битое тело → None."""
+        mimetype = (self.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+        if not (mimetype == "application/json" or (mimetype.startswith("application/") and mimetype.endswith("+json"))):
+            return None
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+    def client_id(self) -> str:
+        return _client_id(self.headers, self.remote_addr)
+
+    def cache_bypass(self, data: dict) -> bool:
+        return _cache_bypass(data, self.headers)
+
+
+async def _asgi_send(send, resp: Response, status: int | None = None) -> None:
+    """Отправляет готовый (не потоковый) Flask Response с CORS-заголовками."""
+    if status is not None:
+        resp.status_code = status
+    add_cors(resp)
+    body = resp.get_data()
+    resp.headers["Content-Length"] = str(len(body))
+    await send({
+        "type": "http.response.start",
+        "status": resp.status_code,
+        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in resp.headers.items()],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _asgi_json(send, payload: Any, status: int = 200) -> None:
+    await _asgi_send(send, app.json.response(payload), status)
+
+
+async def _asgi_sse(send, events: AsyncGenerator[str, None]) -> None:
+    resp = Response(mimetype="text/event-stream", headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"})
+    add_cors(resp)
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in resp.headers.items()],
+    })
+    try:
+        async for chunk in events:
+            await send({"type": "http.response.body", "body": chunk.encode("utf-8"), "more_body": True})
+    finally:
+        await events.aclose()
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def _cancel_tasks(tasks: list[asyncio.Task]) -> None:
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+_ASYNC_ROUTES: dict[tuple[str, str], Any] = {}
+_ASYNC_PATTERN_ROUTES: list[tuple[str, str, re.Pattern, Any]] = []
+
+
+def _async_route(path: str, method: str = "POST"):
+    """Маршрут, который в ASGI-режиме обслуживается корутиной, а не Flask.
+
+    <name> в пути — параметр, как во Flask; значение попадает в req.path_params.
+    """
+    def register(handler):
+        if "<" in path:
+            rx = re.compile(re.sub(r"<(\w+)>", r"(?P<\1>[^/]+)", path))
+            _ASYNC_PATTERN_ROUTES.append((method, path, rx, handler))
+        else:
+            _ASYNC_ROUTES[(method, path)] = handler
+        return handler
+    return register
+
+
+def _match_async_route(method: str, path: str) -> tuple[Any, str, dict[str, str]] | None:
+    """(обработчик, шаблон маршрута для метрик, параметры пути) или None — отдать Flask."""
+    handler = _ASYNC_ROUTES.get((method, path))
+    if handler is not None:
+        return handler, path, {}
+    for route_method, template, rx, handler in _ASYNC_PATTERN_ROUTES:
+        if route_method == method:
+            m = rx.fullmatch(path)
+            if m:
+                return handler, template, m.groupdict()
+    return None
+
+
+async def _aanalyze_life_chunk(
+    title: str, outcomes: list[str], idxs: list[int], *, use_cache: bool, client: str,
+) -> list[tuple[int, dict | None]]:
+    """_analyze_life_chunk для ASGI-режима."""
+    if len(idxs) > 1:
+        try:
+            text = await llm_agenerate(
+                build_prompt_pros_cons_batch(title, [outcomes[i] for i in idxs]), temperature=0.7,
+                use_cache=use_cache, client=client, priority=PRIORITY_BATCH, max_len=4000 * len(idxs),
+                items=list(range(1, len(idxs) + 1)),
+            )
+        except Exception:
+            log.exception("life batch failed for %d outcomes", len(idxs))
+            return [(i, None) for i in idxs]
+        return await _cache_call(_life_batch_payloads, title, outcomes, idxs, text)
+    i = idxs[0]
+    try:
+        result = await llm_agenerate(
+            build_prompt_pros_cons(title, outcomes[i]), temperature=0.7,
+            use_cache=use_cache, client=client, priority=PRIORITY_BATCH,
+        )
+        return [(i, enrich_life_result(outcomes[i], result, ok=True))]
+    except Exception as e:
+        log.exception("life analyze failed for %s", outcomes[i])
+        return [(i, enrich_life_result(outcomes[i], f"Ошибка ИИ: {e}", ok=False))]
+
+
+async def aiter_life_results(
+    title: str, outcomes: list[str], *, batch_size: int, use_cache: bool, client: str,
+    idxs: list[int] | None = None,
+) -> AsyncGenerator[tuple[int, dict], None]:
+    """iter_life_results для ASGI-режима."""
+    pending = {
+        asyncio.create_task(_aanalyze_life_chunk(title, outcomes, chunk, use_cache=use_cache, client=client))
+        for chunk in _life_chunks(list(range(len(outcomes))) if idxs is None else idxs, batch_size)
+    }
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                for i, payload in task.result():
+                    if payload is None:
+                        pending.add(asyncio.create_task(
+                            _aanalyze_life_chunk(title, outcomes, [i], use_cache=use_cache, client=client)))
+                    else:
+                        yield i, payload
+    finally:
+        await _cancel_tasks(list(pending))
+
+
+@_async_route("/run-ai-life")
+async def arun_ai_life(req: _AsgiRequest, send) -> None:
+    try:
+        data = _json_required(req.get_json())
+        title, outcomes, nodes = _life_input(data)
+    except ValueError as e:
+        return await _asgi_json(send, {"error": str(e)}, 400)
+    use_cache = not req.cache_bypass(data)
+    ready, fresh = await _cache_call(_life_reuse, title, outcomes, nodes, use_cache=use_cache)
+    batch_size = _life_batch_size(data, len(fresh))
+    client = req.client_id()
+    try:
+        await _acharge(client, _life_cost(title, outcomes, fresh), tasks=len(_life_chunks(fresh, batch_size)))
+    except QueueFullError as e:
+        return await _asgi_send(send, *_too_busy(e))
+
+    results: list[dict] = [None] * len(outcomes)  # type: ignore
+    for i, payload in ready:
+        results[i] = _life_tag(title, outcomes, nodes, i, payload)
+    async for i, payload in aiter_life_results(
+        title, outcomes, batch_size=batch_size, use_cache=use_cache, client=client, idxs=fresh,
+    ):
+        results[i] = _life_tag(title, outcomes, nodes, i, payload)
+    await _asgi_json(send, {"results": results})
+
+
+@_async_route("/run-ai-life/stream")
+async def arun_ai_life_stream(req: _AsgiRequest, send) -> None:
+    try:
+        data = _json_required(req.get_json())
+        title, outcomes, nodes = _life_input(data)
+    except ValueError as e:
+        return await _asgi_json(send, {"error": str(e)}, 400)
+    use_cache = not req.cache_bypass(data)
+    client = req.client_id()
+    tokens = data.get("tokens") is True
+    ready, fresh = await _cache_call(_life_reuse, title, outcomes, nodes, use_cache=use_cache)
+    batch_size = 0 if tokens else _life_batch_size(data, len(fresh))
+    try:
+        await _acharge(client, _life_cost(title, outcomes, fresh), tasks=len(_life_chunks(fresh, batch_size)))
+    except QueueFullError as e:
+        return await _asgi_send(send, *_too_busy(e))
+
+    async def token_stream() -> AsyncGenerator[str, None]:
+        yield _sse("start", {"total": len(outcomes), "tokens": True})
+        for idx, payload in ready:
+            yield _sse("result", _life_tag(title, outcomes, nodes, idx, payload))
+        events: asyncio.Queue = asyncio.Queue()
+
+        async def analyze_streaming(idx: int, outcome: str) -> None:
+            try:
+                result, sections = "", {}
+                async for event, payload in llm_astream(
+                    build_prompt_pros_cons(title, outcome), kind="life", temperature=0.7,
+                    use_cache=use_cache, client=client, priority=PRIORITY_BATCH,
+                ):
+                    if event == "result":
+                        result, sections = payload
+                    else:
+                        events.put_nowait(_sse_llm_event(event, payload, {"index": idx}))
+                payload = enrich_life_result(outcome, result, ok=True, sections=sections)
+            except Exception as e:
+                log.exception("life stream failed for %s", outcome)
+                payload = enrich_life_result(outcome, f"Ошибка ИИ: {e}", ok=False)
+            events.put_nowait(_sse("result", _life_tag(title, outcomes, nodes, idx, payload)))
+            events.put_nowait(None)
+
+        tasks = [asyncio.create_task(analyze_streaming(i, outcomes[i])) for i in fresh]
+        try:
+            finished = 0
+            while finished < len(fresh):
+                item = await events.get()
+                if item is None:
+                    finished += 1
+                    continue
+                yield item
+        finally:
+            await _cancel_tasks(tasks)
+        yield _sse("done", {})
+
+    async def event_stream() -> AsyncGenerator[str, None]:
+        yield _sse("start", {"total": len(outcomes)})
+        for idx, payload in ready:
+            yield _sse("result", _life_tag(title, outcomes, nodes, idx, payload))
+        results = aiter_life_results(
+            title, outcomes, batch_size=batch_size, use_cache=use_cache, client=client, idxs=fresh,
+        )
+        try:
+            async for idx, payload in results:
+                yield _sse("result", _life_tag(title, outcomes, nodes, idx, payload))
+        finally:
+            await results.aclose()
+        yield _sse("done", {})
+
+    await _asgi_sse(send, token_stream() if tokens else event_stream())
+
+
+async def _awatch_job_cancel(job_id: str, task: asyncio.Task) -> None:
+    """Отмена из другого воркера приходит флагом в базе — проверяем его при старте и периодически."""
+    while not task.done():
+        if await _jobs_call(JOBS.cancel_requested, job_id):
+            task.cancel()
+            return
+        await asyncio.sleep(_CANCEL_POLL)
+
+
+async def _arun_life_job(
+    job_id: str, title: str, outcomes: list[str], *, nodes: list[LifeNode] | None,
+    ready: list[tuple[int, dict]], fresh: list[int], batch_size: int, use_cache: bool, client: str,
+) -> None:
+    """_run_life_job для ASGI-режима: отмена — task.cancel()."""
+    watcher = asyncio.create_task(_awatch_job_cancel(job_id, asyncio.current_task()))
+    results = aiter_life_results(
+        title, outcomes, batch_size=batch_size, use_cache=use_cache, client=client, idxs=fresh,
+    )
+    try:
+        for idx, payload in ready:
+            await _jobs_call(JOBS.add_event, job_id, "result", _life_tag(title, outcomes, nodes, idx, payload))
+        async for idx, payload in results:
+            await _jobs_call(JOBS.add_event, job_id, "result", _life_tag(title, outcomes, nodes, idx, payload))
+    except asyncio.CancelledError:
+        await _jobs_call(JOBS.finish_cancelled, job_id)
+        raise
+    except Exception:
+        log.exception("life job %s failed", job_id)
+        await _jobs_call(JOBS.add_event, job_id, "error", {"error": "Внутренняя ошибка сервера"})
+        return
+    finally:
+        watcher.cancel()
+        await results.aclose()
+    await _jobs_call(JOBS.add_event, job_id, "done", {})
+
+
+async def ajob_event_stream(job_id: str, after: int) -> AsyncGenerator[str, None]:
+    """job_event_stream для ASGI-режима."""
+    idle = 0.0
+    while True:
+        batch = await _jobs_call(JOBS.events, job_id, after)
+        for seq, event, data in batch:
+            yield _sse_job_event(seq, event, data)
+            after = seq
+            if event in _JOB_FINAL_EVENTS:
+                return
+        if batch:
+            idle = 0.0
+            continue
+        started = time.monotonic()
+        if not await JOBS.await_events(job_id, after, _JOB_POLL):
+            return
+        idle += time.monotonic() - started
+        if idle >= _SSE_KEEPALIVE:
+            idle = 0.0
+            yield ": ping\n\n"
+
+
+@_async_route("/jobs/life")
+async def acreate_life_job(req: _AsgiRequest, send) -> None:
+    try:
+        data = _json_required(req.get_json())
+        title, outcomes, nodes = _life_input(data)
+    except ValueError as e:
+        return await _asgi_json(send, {"error": str(e)}, 400)
+    use_cache = not req.cache_bypass(data)
+    ready, fresh = await _cache_call(_life_reuse, title, outcomes, nodes, use_cache=use_cache)
+    batch_size = _life_batch_size(data, len(fresh))
+    client = req.client_id()
+    try:
+        await _acharge(client, _life_cost(title, outcomes, fresh), tasks=len(_life_chunks(fresh, batch_size)))
+    except QueueFullError as e:
+        return await _asgi_send(send, *_too_busy(e))
+
+    loop = asyncio.get_running_loop()
+    task: asyncio.Task | None = None
+
+    def cancel() -> None:
+        # Задачи ещё нет (DELETE пришёл, пока журнал создавался) — отменять нечего:
+        # флаг cancel в базе она проверит при старте (_awatch_job_cancel). Созданную
+        # отменяем следующим шагом цикла, после её первого шага: отменённая до старта
+        # корутина не выполняется вовсе и не записала бы событие cancelled.
+        if task is not None:
+            loop.call_soon(task.cancel)
+
+    # DELETE /jobs/<id> обслуживает Flask в потоке моста — отмену передаём в цикл событий.
+    job_id = await _jobs_call(JOBS.create, "life", len(outcomes), lambda: loop.call_soon_threadsafe(cancel))
+    await _jobs_call(JOBS.add_event, job_id, "start", {"job_id": job_id, "total": len(outcomes)})
+    task = asyncio.create_task(_arun_life_job(
+        job_id, title, outcomes, nodes=nodes, ready=ready, fresh=fresh, batch_size=batch_size,
+        use_cache=use_cache, client=client,
+    ))
+    await _asgi_send(send, _job_created(await _jobs_call(JOBS.get, job_id)))
+
+
+@_async_route("/jobs/<job_id>/events", method="GET")
+async def ajob_events(req: _AsgiRequest, send) -> None:
+    job_id = req.path_params["job_id"]
+    if await _jobs_call(JOBS.get, job_id) is None:
+        return await _asgi_send(send, *_job_not_found())
+    await _asgi_sse(send, ajob_event_stream(job_id, _last_event_id(req.headers, req.args)))
+
+
+async def _ascore_chunk(title: str, frames: list[str], numbers: list[int], *,
+                        use_cache: bool, client: str) -> str | Exception:
+    try:
+        return await llm_agenerate(
+            _score_prompt(title, frames, numbers), temperature=0.3,
+            use_cache=use_cache, client=client, priority=PRIORITY_INTERACTIVE, items=numbers,
+        )
+    except QueueFullError:
+        raise
+    except Exception as e:
+        log.warning("flow analyze: frames %d–%d not scored: %s", numbers[0], numbers[-1], e)
+        return e
+
+
+async def ashortlist_frames(title: str, frames: list[str], *, use_cache: bool, client: str) -> tuple[str, dict]:
+    """shortlist_frames для ASGI-режима."""
+    chunks = _frame_chunks(len(frames))
+    tasks = [
+        asyncio.create_task(_ascore_chunk(title, frames, numbers, use_cache=use_cache, client=client))
+        for numbers in chunks
+    ]
+    try:
+        texts = await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return _frames_shortlist(title, frames, chunks, texts)
+
+
+async def _aflow_generate(req: _AsgiRequest, send, kind: str, prompt: str, *,
+                          temperature: float, data: dict, base: dict,
+                          shortlist: bool = False) -> None:
+    use_cache = not req.cache_bypass(data)
+    client = req.client_id()
+    extra = {}
+    try:
+        if shortlist:
+            cost, provider, chunks = await _cache_call(_frames_map_cost, base["title"], base["frames"], use_cache)
+            await _acharge(client, cost, provider, tasks=chunks)
+            prompt, extra["map_reduce"] = await ashortlist_frames(
+                base["title"], base["frames"], use_cache=use_cache, client=client,
+            )
+        key = response_key(prompt, temperature)
+        prefetched = await PREFETCH.atake(client, key) if use_cache else None
+        if prefetched:
+            extra["prefetched"] = True
+        else:
+            cost = await _cache_call(_uncached_cost, prompt, temperature, use_cache)
+            await _acharge(client, cost, model_route(prompt).provider)
+        result = prefetched or await llm_agenerate(
+            prompt, temperature=temperature, use_cache=use_cache,
+            client=client, priority=PRIORITY_INTERACTIVE,
+        )
+    except QueueFullError as e:
+        return await _asgi_send(send, *_too_busy(e))
+    except Exception as e:
+        log.exception("flow %s failed", kind)
+        return await _asgi_json(send, {"error": f"Ошибка ИИ: {e}"}, 502)
+    await _asgi_json(send, {**base, "result": result, **_SECTION_PARSERS[kind](result), **extra})
+
+
+async def _aflow_token_stream(req: _AsgiRequest, send, kind: str, prompt: str, *,
+                              temperature: float, data: dict, base: dict,
+                              shortlist: bool = False) -> None:
+    """Как _flow_token_stream: start → [map_reduce] → token* / section* → result → done."""
+    use_cache = not req.cache_bypass(data)
+    client = req.client_id()
+    claimed = not shortlist and use_cache and PREFETCH.claim(client, response_key(prompt, temperature)) is not None
+    try:
+        if shortlist:
+            cost, provider, chunks = await _cache_call(_frames_map_cost, base["title"], base["frames"], use_cache)
+            await _acharge(client, cost, provider, tasks=chunks)
+        elif not claimed:
+            cost = await _cache_call(_uncached_cost, prompt, temperature, use_cache)
+            await _acharge(client, cost, model_route(prompt).provider)
+    except QueueFullError as e:
+        return await _asgi_send(send, *_too_busy(e))
+
+    async def event_stream() -> AsyncGenerator[str, None]:
+        nonlocal prompt
+        yield _sse("start", {})
+        extra = {}
+        try:
+            if shortlist:
+                prompt, extra["map_reduce"] = await ashortlist_frames(
+                    base["title"], base["frames"], use_cache=use_cache, client=client,
+                )
+                yield _sse("map_reduce", extra["map_reduce"])
+            key = response_key(prompt, temperature)
+            prefetched = await PREFETCH.atake(client, key) if use_cache else None
+            if not prefetched and (claimed or shortlist):
+                cost = await _cache_call(_uncached_cost, prompt, temperature, use_cache)
+                await _acharge(client, cost, model_route(prompt).provider)
+            if prefetched:
+                extra["prefetched"] = True
+                events: list[tuple[str, Any]] = []
+                result, sections = _pump(_ready_stream(kind, prefetched), events.append)
+                for event, payload in events:
+                    yield _sse_llm_event(event, payload)
+            else:
+                async for event, payload in llm_astream(prompt, kind=kind, temperature=temperature,
+                                                        use_cache=use_cache, client=client,
+                                                        priority=PRIORITY_INTERACTIVE):
+                    if event == "result":
+                        result, sections = payload
+                    else:
+                        yield _sse_llm_event(event, payload)
+        except QueueFullError as e:
+            yield _sse("error", _too_busy_body(e))
+            return
+        except Exception as e:
+            log.exception("flow %s stream failed", kind)
+            yield _sse("error", {"error": f"Ошибка ИИ: {e}"})
+            return
+        yield _sse("result", {**base, "result": result, **sections, **extra})
+        yield _sse("done", {})
+
+    await _asgi_sse(send, event_stream())
+
+
+async def _aflow_next_frame(req: _AsgiRequest, send, respond) -> None:
+    try:
+        data = _json_required(req.get_json())
+        title, current_frame = _next_frame_args(data)
+    except ValueError as e:
+        return await _asgi_json(send, {"error": str(e)}, 400)
+    await respond(
+        req, send, "next_frame", build_prompt_next_frame(title, current_frame), temperature=0.8,
+        data=data, base={"title": title, "current_frame": current_frame},
+    )
+
+
+async def _aflow_analyze_frames(req: _AsgiRequest, send, respond) -> None:
+    try:
+        data = _json_required(req.get_json())
+        title, frames = _analyze_frames_args(data)
+    except ValueError as e:
+        return await _asgi_json(send, {"error": str(e)}, 400)
+    map_reduce = _analyze_map_reduce(data, len(frames))
+    await respond(
+        req, send, "analyze", build_prompt_analyze_frames(title, frames), temperature=0.3,
+        data=data, base={"title": title, "frames": frames},
+        shortlist=map_reduce,
+    )
+
+
+@_async_route("/run-ai-flow-next-frame")
+async def arun_ai_flow_next_frame(req: _AsgiRequest, send) -> None:
+    await _aflow_next_frame(req, send, _aflow_generate)
+
+
+@_async_route("/run-ai-flow-next-frame/stream")
+async def arun_ai_flow_next_frame_stream(req: _AsgiRequest, send) -> None:
+    await _aflow_next_frame(req, send, _aflow_token_stream)
+
+
+@_async_route("/run-ai-flow-analyze-frames")
+async def arun_ai_flow_analyze_frames(req: _AsgiRequest, send) -> None:
+    await _aflow_analyze_frames(req, send, _aflow_generate)
+
+
+@_async_route("/run-ai-flow-analyze-frames/stream")
+async def arun_ai_flow_analyze_frames_stream(req: _AsgiRequest, send) -> None:
+    await _aflow_analyze_frames(req, send, _aflow_token_stream)
+
+
+_flask_asgi = WsgiToAsgi(app) if WsgiToAsgi is not None else None
+
+
+async def _asgi_lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            missing = [name for name, mod in (("httpx", httpx), ("asgiref", WsgiToAsgi)) if mod is None]
+            if missing:
+                await send({"type": "lifespan.startup.failed",
+                            "message": f"ASGI-режим требует пакеты: {', '.join(missing)}"})
+                return
+            log.info("ASGI-режим: provider=%s, model=%s", CFG.llm_provider, CFG.active_model())
+            if CFG.model_routes or CFG.cascade:
+                log.info("Маршруты моделей: %s", describe_routes())
+            start_ollama_preload()
+            HEALTH.ensure_running()
+            METRICS.ensure_running()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await close_async_clients()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+
+async def _watch_disconnect(receive, task: asyncio.Task, finished) -> None:
+    """Отменяет обработчик, когда клиент закрыл соединение.
+
+    uvicorn после обрыва молча игнорирует send(), поэтому без этого генерация
+    дорабатывала бы впустую; об уходе клиента говорит только http.disconnect.
+    finished() — ответ уже отправлен целиком, отменять нечего.
+    """
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            if not finished() and not task.done():
+                task.cancel()
+            return
+
+
+async def asgi_app(scope: dict, receive, send) -> None:
+    """ASGI-приложение: те же маршруты и ответы, что у Flask-приложения app."""
+    if scope["type"] == "lifespan":
+        return await _asgi_lifespan(receive, send)
+    route = _match_async_route(scope["method"], scope["path"]) if scope["type"] == "http" else None
+    if route is None:
+        if _flask_asgi is None:
+            raise RuntimeError("ASGI-режим требует asgiref (pip install asgiref)")
+        return await _flask_asgi(scope, receive, send)
+    handler, template, path_params = route
+
+    started = finished = False
+    status = 500
+
+    async def tracked_send(message: dict) -> None:
+        nonlocal started, finished, status
+        if message["type"] == "http.response.start":
+            started, status = True, message["status"]
+        elif message["type"] == "http.response.body" and not message.get("more_body"):
+            finished = True
+        await send(message)
+
+    req = _AsgiRequest(scope, await _read_body(receive), path_params)
+    began = time.perf_counter()
+    task = asyncio.create_task(handler(req, tracked_send))
+    watcher = asyncio.create_task(_watch_disconnect(receive, task, lambda: finished))
+    try:
+        await task
+    except asyncio.CancelledError:
+        if not task.cancelled() or not watcher.done():
+            raise  # отменили сам asgi_app (остановка сервера), а не обработчик
+        CLIENT_DISCONNECTS.inc(route=template)
+        if not started:
+            status = 499
+    except Exception:
+        log.exception("ASGI %s failed", scope["path"])
+        if not started:
+            status = 500
+            await _asgi_json(send, {"error": "Внутренняя ошибка сервера"}, 500)
+    finally:
+        watcher.cancel()
+        HTTP_SECONDS.observe(time.perf_counter() - began, route=template, method=scope["method"], status=status)
+
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["build-assets"]:
+        # python main.py build-assets [DIR] — та же сборка файлами (с .gz/.br) для nginx/CDN
+        ASSETS.write(sys.argv[2] if len(sys.argv) > 2 else os.path.join(app.root_path, "dist", "assets"))
+        raise SystemExit(0)
     if CFG.llm_provider == "mistral" and not CFG.mistral_api_key:
         log.warning("VIORA_LLM_PROVIDER=mistral, но MISTRAL_API_KEY не задан")
     log.info(
@@ -777,7 +7217,19 @@ if __name__ == "__main__":
         CFG.debug,
     )
     if CFG.llm_provider == "ollama":
-        log.info("Ollama: %s", CFG.ollama_url)
+        log.info(
+            "Ollama: %s (api=%s, keep_alive=%s)",
+            ", ".join(CFG.ollama_urls), CFG.ollama_api, CFG.ollama_keep_alive or "-",
+        )
+        if CFG.mistral_overflow:
+            if CFG.mistral_api_key:
+                log.info("Mistral API: %s (overflow)", CFG.mistral_base_url)
+            else:
+                log.warning("VIORA_MISTRAL_OVERFLOW=1, но MISTRAL_API_KEY не задан — overflow выключен")
     else:
         log.info("Mistral API: %s", CFG.mistral_base_url)
+    if CFG.model_routes or CFG.cascade:
+        log.info("Маршруты моделей: %s", describe_routes())
+    start_ollama_preload()
+    HEALTH.ensure_running()
     app.run(debug=CFG.debug, port=CFG.port, host=os.environ.get("HOST", "0.0.0.0"))
@@ -9,6 +9,7 @@
  *  - History.snapshot()/undo()/redo()   — undo/redo стек состояний (с дебаунсом)
  *  - Shortcuts.bind(map)                — горячие клавиши с авто-помощью
  *  - tryFetch(url, opts)                — fetch с понятными ошибками
+ *  - postSse(url, body, onEvent)        — POST + разбор Server-Sent Events
  *  - escapeHtml(s)                      — безопасный текст в HTML
  */
 (function (global) {
@@ -298,6 +299,43 @@
     }
   }
 
+  // ════════════════════════ SSE helper ════════════════════════
+  // POST с JSON-телом и потоковым разбором ответа text/event-stream.
+  // onEvent(event, data) вызывается на каждое событие; промис завершается с концом потока.
+  async function postSse(url, body, onEvent) {
+    const resp = await fetch(url, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(body),
+    });
+    if (!resp.ok || !resp.body) {
+      let msg = `HTTP ${resp.status}`;
+      try { const j = await resp.json(); if (j && j.error) msg = j.error; } catch { /* не JSON */ }
+      throw new Error(msg);
+    }
+    const reader = resp.body.getReader();
+    const decoder = new TextDecoder('utf-8');
+    let buffer = '';
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      const parts = buffer.split('\n\n');
+      buffer = parts.pop() || '';
+      for (const block of parts) {
+        let event = 'message', dataStr = '';
+        for (const line of block.split('\n')) {
+          if (line.startsWith('event: ')) event = line.slice(7).trim();
+          else if (line.startsWith('data: ')) dataStr += line.slice(6);
+        }
+        if (!dataStr) continue;
+        let data;
+        try { data = JSON.parse(dataStr); } catch { continue; }
+        onEvent(event, data);
+      }
+    }
+  }
+
   // ════════════════════════ utils ════════════════════════
   function escapeHtml(s) {
     if (s === null || s === undefined) return '';
@@ -352,6 +390,6 @@
   // ════════════════════════ Export ════════════════════════
   global.Viora = {
     Toast, Confirm, Theme, Exporter, Shortcuts, Help,
-    createHistory, tryFetch, escapeHtml, debounce,
+    createHistory, tryFetch, postSse, escapeHtml, debounce,
   };
 })(window);
@@ -7,6 +7,7 @@
  *  • Горячие клавиши
  *  • Тёмная / светлая тема
  *  • Тосты и health-чек
+ *  • Спекулятивный следующий кадр (VIORA_PREFETCH=1)
  */
 (() => {
   'use strict';
@@ -192,6 +193,38 @@
   // Замена нативного alert на тост
   window.alert = (msg) => Toast.show(String(msg), 'info', 3000);
 
+  // ── Спекулятивный следующий кадр (VIORA_PREFETCH=1) ──────────────
+  // После паузы в правке кадра сервер заранее готовит его продолжение на
+  // свободной мощности — клик по «→» получает ответ сразу. Правка отменяет
+  // идущую генерацию.
+  if (document.body.dataset.prefetch === '1' && !navigator.connection?.saveData) {
+    const PREFETCH_URL = '/run-ai-flow-next-frame/prefetch';
+    let outstanding = false;
+    const frameText = (node) => node?.querySelector('.title')?.innerText.trim() || '';
+
+    const prefetch = debounce((node) => {
+      const title = frameText(document.querySelector('[data-id="root"]'));
+      const currentFrame = frameText(node);
+      if (!title || !currentFrame || !node.isConnected) return;
+      outstanding = true;
+      fetch(PREFETCH_URL, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ title, current_frame: currentFrame }),
+      }).catch(() => { outstanding = false; });
+    }, 1200);
+
+    document.addEventListener('input', (e) => {
+      const node = e.target.closest?.('.node[data-type="frame"], .node[data-id="root"]');
+      if (!node || !e.target.classList.contains('title')) return;
+      if (outstanding) {
+        outstanding = false;
+        fetch(PREFETCH_URL, { method: 'DELETE', keepalive: true }).catch(() => {});
+      }
+      prefetch(node);
+    });
+  }
+
   // Health-проверка
   (async () => {
     try {
@@ -28,6 +28,9 @@ let isLockedUntil = 0;
 let timerInterval = null;
 let _saveTimeout = null;
 let selectedFramesForAnalysis = new Set();
+// Кадры, продолжение которых уже генерировали: повторный клик — просьба о другом
+// варианте, поэтому сервер получает no_cache и не отдаёт прошлый ответ из кэша.
+const generatedNextFrames = new Set();
 
 // ПЕРЕМЕННЫЕ ДЛЯ МАСШТАБИРОВАНИЯ
 let scale = 1;
@@ -824,22 +827,17 @@ async function generateNextFrame(parentNode){
   aiNextFrameBtn.style.opacity = '0.6';
 
   try {
-    const response = await fetch('/run-ai-flow-next-frame', {
-      method: 'POST',
-      headers: {'Content-Type': 'application/json'},
-      body: JSON.stringify({ title, current_frame: currentFrame })
-    });
-
-    if(!response.ok) throw new Error('HTTP ' + response.status);
-
-    const data = await response.json();
-    const result = data.result || '';
+    const requestKey = `${title}\n${currentFrame}`;
+    const body = { title, current_frame: currentFrame };
+    if(generatedNextFrames.has(requestKey)) body.no_cache = true;
+    const data = await streamFlowRequest('/run-ai-flow-next-frame/stream', body, loading);
 
     if(outBox.lastElementChild === loading) outBox.removeChild(loading);
 
     const { nextFrame, visualElements, emotionalImpact, composition, soundRhythm, transition } = flowNextFrameFromResponse(data);
 
     if(nextFrame) {
+      generatedNextFrames.add(requestKey);
       const rect = parentNode.getBoundingClientRect();
       const canvasRect = canvasContent.getBoundingClientRect();
 
@@ -883,6 +881,36 @@ async function generateNextFrame(parentNode){
   aiNextFrameBtn.style.opacity = '';
 }
 
+// ========== ПОТОКОВЫЙ ОТВЕТ ИИ ==========
+// Стримит ответ в блок загрузки по мере генерации; возвращает итоговый объект
+// (та же форма, что у обычного JSON-ответа эндпоинта).
+async function streamFlowRequest(url, body, loading) {
+  let preview = null;
+  let text = '';
+  let final = null;
+  await window.Viora.postSse(url, body, (event, data) => {
+    if(event === 'token') {
+      if(!preview) {
+        preview = document.createElement('div');
+        preview.style.cssText = 'margin-top:8px;font-size:12px;white-space:pre-wrap;color:var(--text-muted);';
+        loading.appendChild(preview);
+      }
+      text += data.text || '';
+      preview.textContent = text;
+    } else if(event === 'reset') {
+      // Каскад отверг черновик быстрой модели — ответ пойдёт заново.
+      text = '';
+      if(preview) preview.textContent = '';
+    } else if(event === 'result') {
+      final = data;
+    } else if(event === 'error') {
+      throw new Error(data.error || 'Ошибка ИИ');
+    }
+  });
+  if(!final) throw new Error('Поток ответа оборвался');
+  return final;
+}
+
 // ========== АНАЛИЗ КАДРОВ ==========
 function showFrameAnalysisModal(){
   const frames = Array.from(document.querySelectorAll('.node[data-type="frame"]'));
@@ -940,16 +968,7 @@ async function analyzeSelectedFrames(){
   frameAnalysisModal.classList.remove('active');
 
   try {
-    const response = await fetch('/run-ai-flow-analyze-frames', {
-      method: 'POST',
-      headers: {'Content-Type': 'application/json'},
-      body: JSON.stringify({ title, frames })
-    });
-
-    if(!response.ok) throw new Error('HTTP ' + response.status);
-
-    const data = await response.json();
-    const result = data.result || '';
+    const data = await streamFlowRequest('/run-ai-flow-analyze-frames/stream', { title, frames }, loading);
 
     if(outBox.lastElementChild === loading) outBox.removeChild(loading);
 
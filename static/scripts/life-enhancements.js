@@ -236,6 +236,26 @@
     return { title: '', outcomes: [] };
   }
 
+  // Последний результат по id узла: его hash уходит на сервер, и неизменённые
+  // исходы возвращаются без повторной генерации ({ unchanged: true }).
+  const analyzed = new Map();
+
+  function withKnownHashes(nodes) {
+    return nodes.map((n) => {
+      const known = analyzed.get(n.id);
+      const hasBranches = typeof window.outcomeHasAiBranches === 'function' && window.outcomeHasAiBranches(n.id);
+      return {
+        ...n,
+        hash: known && hasBranches ? known.hash : undefined,
+        children: withKnownHashes(n.children || []),
+      };
+    });
+  }
+
+  function countNodes(nodes) {
+    return nodes.reduce((acc, n) => acc + 1 + countNodes(n.children || []), 0);
+  }
+
   async function runWithStream() {
     const btn = $('#ai-analyze');
     if (!btn) return;
@@ -262,6 +282,10 @@
       if (!built) return;
       await new Promise((r) => setTimeout(r, 400));
     }
+    // С холста берём дерево с id узлов — сервер пересчитает только новые и изменённые исходы
+    const tree = typeof window.collectTreeNodes === 'function' ? window.collectTreeNodes() : null;
+    const nodes = tree && tree.nodes.length ? withKnownHashes(tree.nodes) : null;
+    const total = nodes ? countNodes(nodes) : outcomes.length;
     // Проверяем блокировку через DOM (life.js хранит таймер в #ai-timer)
     const timerText = document.getElementById('ai-timer')?.textContent || '';
     if (/\d/.test(timerText)) { Toast.show('Подождите окончания таймера', 'info'); return; }
@@ -271,7 +295,7 @@
 
     aiOutput.innerHTML = `
       <div class="ai-response">
-        <div class="meta"><b>Анализ ${outcomes.length} исхода(ов) — в реальном времени</b></div>
+        <div class="meta"><b>Анализ ${total} исхода(ов) — в реальном времени</b></div>
         <div id="stream-progress" style="margin-top:8px;font-size:12px;color:rgba(255,255,255,0.6);" aria-live="polite">Подключение к ИИ…</div>
         <div id="stream-results" style="margin-top:8px;"></div>
       </div>`;
@@ -283,7 +307,7 @@
       const resp = await fetch('/run-ai-life/stream', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ title, outcomes }),
+        body: JSON.stringify(nodes ? { title, nodes } : { title, outcomes }),
       });
       if (!resp.ok || !resp.body) {
         throw new Error('HTTP ' + resp.status);
@@ -311,16 +335,24 @@
           try { data = JSON.parse(dataStr); } catch { continue; }
           if (event === 'result') {
             done++;
-            progressEl.textContent = `Получено ${done} из ${outcomes.length}`;
-            renderStreamResult(resultsEl, data, outcomes.length);
-            // дозаписываем секции анализа (плюсы, минусы, риски, рекомендации, вердикт) как узлы
-            if (typeof window.createProConNodesForOutcome === 'function') {
+            progressEl.textContent = `Получено ${done} из ${total}`;
+            const unchanged = data.unchanged && analyzed.has(data.id);
+            if (unchanged) {
+              data = { ...analyzed.get(data.id), index: data.index };
+            } else if (data.id && data.ok !== false) {
+              analyzed.set(data.id, data);
+            }
+            renderStreamResult(resultsEl, data, total);
+            // дозаписываем секции анализа (плюсы, минусы, риски, рекомендации, вердикт) как узлы;
+            // ветки неизменённого исхода уже на холсте
+            if (!unchanged && typeof window.createProConNodesForOutcome === 'function') {
               const parsed = (window.lifeAnalysisFromItem || window.parseProsConsFromText)(data);
               const hasAny = (parsed.pros?.length || parsed.cons?.length ||
                 parsed.risks?.length || parsed.recommendations?.length ||
                 (parsed.verdict && parsed.verdict.trim()));
               if (hasAny) {
                 window.createProConNodesForOutcome(data.outcome, parsed.pros, parsed.cons, data.index, {
+                  nodeId: data.id,
                   risks: parsed.risks || [],
                   recommendations: parsed.recommendations || [],
                   verdict: parsed.verdict || ''
@@ -328,7 +360,7 @@
               }
             }
           } else if (event === 'done') {
-            progressEl.textContent = `Готово (${done} из ${outcomes.length})`;
+            progressEl.textContent = `Готово (${done} из ${total})`;
             if (typeof window.scheduleFinalAiLayout === 'function') {
               window.scheduleFinalAiLayout(150);
             } else if (typeof window.relayoutAllProConTrees === 'function') {
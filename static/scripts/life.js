@@ -1485,6 +1485,25 @@ function collectTreeText() {
     return { title, outcomes };
 }
 
+/** Дерево исходов с холста для diff-анализа: вложенные исходы — уточнения родительской ветки */
+function collectTreeNodes() {
+    const root = byId('root');
+    const title = normalizeProblemText(root ? root.querySelector('.title')?.innerText : '');
+
+    const walk = (parentId, depth) => edges
+        .filter(e => e.from === parentId)
+        .map(e => byId(e.to))
+        .filter(n => n && isOutcomeNode(n))
+        .map(n => ({
+            id: n.dataset.id,
+            text: (n.querySelector('.title')?.innerText || '').trim(),
+            children: depth < 4 ? walk(n.dataset.id, depth + 1) : []
+        }))
+        .filter(n => n.text);
+
+    return { title, nodes: walk('root', 1) };
+}
+
 function updateAIPreview() {
     syncFormFromCanvas();
 }
@@ -1592,6 +1611,10 @@ function isAiBranchType(type) {
     return type && (AI_BRANCH_TYPES.has(type) || type.includes('pro') || type.includes('con'));
 }
 
+function outcomeHasAiBranches(outcomeId) {
+    return edges.some(e => e.from === outcomeId && isAiBranchType(byId(e.to)?.dataset.type));
+}
+
 function removeOutcomeAiBranches(outcomeId) {
     edges.filter(e => e.from === outcomeId).forEach(e => {
         const child = byId(e.to);
@@ -1737,7 +1760,7 @@ function relayoutAllProConTrees() {
 function createProConNodesForOutcome(outcomeText, pros, cons, outcomeIndex, extras = {}) {
     const nodes = Array.from(document.querySelectorAll('.node[data-id]'));
 
-    let outcomeNode = nodes.find(n => {
+    let outcomeNode = (extras.nodeId && byId(extras.nodeId)) || nodes.find(n => {
         const nodeText = (n.querySelector('.title')?.innerText || '').trim();
         const nodeType = n.dataset.type;
         return nodeText === outcomeText &&
@@ -2253,6 +2276,8 @@ window.parseProsConsFromText = parseProsConsFromText;
 window.lifeAnalysisFromItem = lifeAnalysisFromItem;
 window.createProConNodesForOutcome = createProConNodesForOutcome;
 window.collectTreeText = collectTreeText;
+window.collectTreeNodes = collectTreeNodes;
+window.outcomeHasAiBranches = outcomeHasAiBranches;
 window.collectFormData = collectFormData;
 window.buildTreeFromForm = buildTreeFromForm;
 window.syncFormFromCanvas = syncFormFromCanvas;
@@ -0,0 +1,331 @@
+"""
+Поведение слоя вокруг модели на поддельном провайдере.
+
+Планировщик (приоритеты, очередь по кругу между клиентами, admit), лимит
+запросов (пополнение бюджета и 429), single-flight, circuit breaker хоста
+и возобновление событий фоновой задачи по Last-Event-ID. Провайдер подменяет
+_generate_once: ответы — заготовки bench/mock_llm, сеть не нужна.
+"""
+from __future__ import annotations
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench"))
+
+import main  # noqa: E402
+from mock_llm import canned_response  # noqa: E402
+
+_WAIT = 5.0
+
+
+def _until(predicate, timeout: float = _WAIT) -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "условие не выполнилось"
+        time.sleep(0.005)
+
+
+def _sse_events(body: str) -> list[tuple[int, str, str]]:
+    """(id, event, data) событий SSE задачи; пинги пропускаются."""
+    events = []
+    for block in body.split("\n\n"):
+        lines = [line for line in block.splitlines() if ": " in line and not line.startswith(":")]
+        fields = dict(line.split(": ", 1) for line in lines)
+        if "id" in fields:
+            events.append((int(fields["id"]), fields["event"], fields["data"]))
+    return events
+
+
+class _Calls(list):
+    """Промпты, дошедшие до поддельной модели; fail=True — хост отвечает ошибкой."""
+
+    fail = False
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    """Поддельный провайдер и чистые кэш, лимит, single-flight и журнал задач."""
+    calls = _Calls()
+
+    def generate_once(backend, prompt, *, temperature, max_len=4000, cancel=None, model=None, items=None):
+        calls.append(prompt)
+        if calls.fail:
+            raise main.LLMError("HTTP 500: mock failure")
+        return main.sanitize_ai_text(canned_response(prompt, think_chars=0)[1], max_len=max_len)
+
+    monkeypatch.setattr(main, "_generate_once", generate_once)
+    monkeypatch.setattr(main, "_retry_delay", lambda attempt: 0.0)
+    monkeypatch.setattr(main, "RESPONSE_CACHE", main.ResponseCache(ttl=3600, max_bytes=1 << 20))
+    monkeypatch.setattr(main, "RATE_LIMITER", main.RateLimiter(per_minute=0, burst=0))
+    monkeypatch.setattr(main, "SINGLE_FLIGHT", main.SingleFlight())
+    monkeypatch.setattr(main, "JOBS", main.JobStore(ttl=3600))
+    monkeypatch.setattr(main.HEALTH, "interval", 0)  # фоновый health-check не трогает предохранитель
+    return calls
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "_PRELOAD_PID", os.getpid())  # без фоновой загрузки моделей
+    return main.app.test_client()
+
+
+# ── Планировщик ──────────────────────────────────────────────────────────────
+def _queue(
+    scheduler: main.LLMScheduler, order: list[str], name: str, client: str, priority: int,
+) -> threading.Thread:
+    """Ставит в очередь запрос, который, получив слот, записывает имя и сразу его отдаёт."""
+    queued = scheduler.stats()["queued"]
+
+    def run() -> None:
+        with scheduler.slot(client=client, priority=priority):
+            order.append(name)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    _until(lambda: scheduler.stats()["queued"] == queued + 1)
+    return thread
+
+
+def test_scheduler_grants_by_priority_then_round_robin() -> None:
+    scheduler = main.LLMScheduler("test", concurrency=1, max_queue=8)
+    order: list[str] = []
+    scheduler.acquire(client="holder", priority=main.PRIORITY_INTERACTIVE)
+    threads = [
+        _queue(scheduler, order, "a1", "a", main.PRIORITY_BATCH),
+        _queue(scheduler, order, "a2", "a", main.PRIORITY_BATCH),
+        _queue(scheduler, order, "a3", "a", main.PRIORITY_BATCH),
+        _queue(scheduler, order, "b1", "b", main.PRIORITY_BATCH),
+        _queue(scheduler, order, "c1", "c", main.PRIORITY_INTERACTIVE),
+    ]
+    scheduler.release()
+    for thread in threads:
+        thread.join(_WAIT)
+    # Интерактивный запрос — первым; пакет клиента a не задерживает одиночный запрос b.
+    assert order == ["c1", "a1", "b1", "a2", "a3"]
+    assert scheduler.stats()["active"] == 0
+
+
+def test_scheduler_admit_rejects_overflow() -> None:
+    scheduler = main.LLMScheduler("test", concurrency=1, max_queue=2)
+    scheduler.admit(3)  # один слот свободен, двое в очередь — влезают
+    with pytest.raises(main.QueueFullError):
+        scheduler.admit(4)
+    order: list[str] = []
+    scheduler.acquire(client="holder", priority=main.PRIORITY_BATCH)
+    threads = [_queue(scheduler, order, name, name, main.PRIORITY_BATCH) for name in ("a", "b")]
+    with pytest.raises(main.QueueFullError) as exc:
+        scheduler.admit(1)
+    assert exc.value.retry_after >= 1
+    with pytest.raises(main.QueueFullError):
+        scheduler.acquire(client="c", priority=main.PRIORITY_BATCH)
+    assert scheduler.stats()["rejected"] == 3
+    scheduler.release()
+    for thread in threads:
+        thread.join(_WAIT)
+    assert order == ["a", "b"]
+
+
+def test_scheduler_speculative_never_queues() -> None:
+    scheduler = main.LLMScheduler("test", concurrency=1, max_queue=8)
+    scheduler.acquire(client="holder", priority=main.PRIORITY_BATCH)
+    with pytest.raises(main.QueueFullError):
+        scheduler.acquire(client="holder", priority=main.PRIORITY_SPECULATIVE)
+    assert scheduler.stats()["queued"] == 0
+    scheduler.release()
+
+
+# ── Лимит запросов ───────────────────────────────────────────────────────────
+def test_rate_limiter_refills_over_time(monkeypatch) -> None:
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+    limiter = main.RateLimiter(per_minute=60, burst=10)
+    limiter.take("a", 6)
+    with pytest.raises(main.RateLimited) as exc:
+        limiter.take("a", 6)
+    assert exc.value.retry_after == 3  # не хватает 2 токенов при 1 токене в секунду
+    limiter.take("b", 6)  # у другого клиента свой бюджет
+    now[0] += 2.0
+    limiter.take("a", 6)
+    now[0] += 60.0
+    limiter.take("a", 25)  # дороже burst — проходит с полным бюджетом
+    with pytest.raises(main.RateLimited):
+        limiter.take("a", 1)
+    assert limiter.stats()["limited"] == 2
+
+
+def test_rate_limit_answers_429(fake_llm, client, monkeypatch) -> None:
+    monkeypatch.setattr(main, "RATE_LIMITER", main.RateLimiter(per_minute=1, burst=1))
+    body = {"title": "Путь", "current_frame": "Герой у двери"}
+    assert client.post("/run-ai-flow-next-frame", json=body).status_code == 200
+    assert len(fake_llm) == 1
+    # Ответ из кэша бюджет не тратит.
+    assert client.post("/run-ai-flow-next-frame", json=body).status_code == 200
+    resp = client.post("/run-ai-flow-next-frame", json={**body, "current_frame": "Герой за дверью"})
+    assert resp.status_code == 429
+    assert int(resp.headers["Retry-After"]) >= 1
+    assert resp.get_json()["retry_after"] >= 1
+    assert len(fake_llm) == 1
+
+
+# ── Single-flight ────────────────────────────────────────────────────────────
+def test_single_flight_coalesces_identical_calls() -> None:
+    flight = main.SingleFlight()
+    release = threading.Event()
+    calls: list[int] = []
+    results: list[str] = []
+
+    def work() -> str:
+        calls.append(1)
+        release.wait(_WAIT)
+        return "ответ"
+
+    threads = [threading.Thread(target=lambda: results.append(flight.do("k", work))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    _until(lambda: flight.stats()["coalesced"] == 3)
+    release.set()
+    for thread in threads:
+        thread.join(_WAIT)
+    assert calls == [1]
+    assert results == ["ответ"] * 4
+    assert flight.stats()["inflight"] == 0
+
+
+def test_single_flight_waiter_takes_over_cancelled_leader() -> None:
+    flight = main.SingleFlight()
+    leader_cancel = main.CancelToken()
+    started = threading.Event()
+    outcome: list[object] = []
+
+    def leader_work() -> str:
+        started.set()
+        leader_cancel.sleep(_WAIT)
+        return "лидер"
+
+    def lead() -> None:
+        try:
+            flight.do("k", leader_work, leader_cancel)
+        except main.RequestCancelled:
+            outcome.append("cancelled")
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    started.wait(_WAIT)
+    follower = threading.Thread(target=lambda: outcome.append(flight.do("k", lambda: "ожидающий")))
+    follower.start()
+    _until(lambda: flight.stats()["coalesced"] == 1)
+    leader_cancel.cancel()
+    leader.join(_WAIT)
+    follower.join(_WAIT)
+    assert sorted(outcome) == sorted(["cancelled", "ожидающий"])
+
+
+def test_single_flight_stream_shares_events() -> None:
+    flight = main.SingleFlight()
+    release = threading.Event()
+    calls: list[int] = []
+    streams: list[tuple[list, object]] = []
+
+    def produce():
+        calls.append(1)
+        yield "token", "раз"
+        release.wait(_WAIT)
+        yield "token", "два"
+        return "итог"
+
+    def consume() -> None:
+        events = flight.stream("k", produce)
+        seen = []
+        while True:
+            try:
+                seen.append(next(events))
+            except StopIteration as stop:
+                streams.append((seen, stop.value))
+                return
+
+    threads = [threading.Thread(target=consume) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    _until(lambda: flight.stats()["coalesced"] == 2)
+    release.set()
+    for thread in threads:
+        thread.join(_WAIT)
+    assert calls == [1]
+    assert streams == [([("token", "раз"), ("token", "два")], "итог")] * 3
+
+
+def test_llm_generate_coalesces_through_provider(fake_llm, monkeypatch) -> None:
+    release = threading.Event()
+    generate_once = main._generate_once
+
+    def slow(*args, **kwargs):
+        release.wait(_WAIT)
+        return generate_once(*args, **kwargs)
+
+    monkeypatch.setattr(main, "_generate_once", slow)
+    prompt = main.build_prompt_next_frame("Путь", "Герой у двери")
+    results: list[str] = []
+    threads = [threading.Thread(target=lambda: results.append(main.llm_generate(prompt))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    _until(lambda: main.SINGLE_FLIGHT.stats()["coalesced"] == 2)
+    release.set()
+    for thread in threads:
+        thread.join(_WAIT)
+    assert len(fake_llm) == 1
+    assert len(set(results)) == 1 and results[0]
+
+
+# ── Circuit breaker ──────────────────────────────────────────────────────────
+def test_breaker_opens_then_half_open_probe_closes(fake_llm, monkeypatch) -> None:
+    backend = main.BACKENDS.backends[0]
+    monkeypatch.setattr(backend, "breaker", main.CircuitBreaker(failures=2, cooldown=30.0))
+    prompt = main.build_prompt_next_frame("Путь", "Герой у двери")
+    fake_llm.fail = True
+    with pytest.raises(main.LLMError):
+        main.llm_generate(prompt, use_cache=False)
+    assert backend.breaker.state == "open"
+    assert len(fake_llm) == 2  # третья попытка не дошла до хоста
+    with pytest.raises(main.LLMError):
+        main.llm_generate(prompt, use_cache=False)
+    assert len(fake_llm) == 2
+
+    backend.breaker.opened_at -= backend.breaker.cooldown  # прошёл cooldown
+    probe = main.BACKENDS.acquire()
+    assert backend.breaker.state == "half_open"
+    with pytest.raises(main.LLMError):
+        main.BACKENDS.acquire()  # пока идёт пробный запрос, остальные на хост не идут
+    main.BACKENDS.done(probe, time.monotonic(), failed=True)
+    assert backend.breaker.state == "open"  # неудачная проба открывает снова
+
+    backend.breaker.opened_at -= backend.breaker.cooldown
+    fake_llm.fail = False
+    assert main.llm_generate(prompt, use_cache=False)
+    assert backend.breaker.state == "closed"
+
+
+# ── Фоновые задачи ───────────────────────────────────────────────────────────
+def test_job_events_resume_from_last_event_id(fake_llm, client) -> None:
+    resp = client.post("/jobs/life", json={"title": "Переезд", "outcomes": ["Остаться", "Уехать", "Подождать"]})
+    assert resp.status_code == 202
+    events_url = resp.get_json()["events_url"]
+    full = _sse_events(client.get(events_url).get_data(as_text=True))
+    names = [event for _, event, _ in full]
+    assert names[0] == "start" and names[-1] == "done"
+    assert names.count("result") == 3
+    assert [seq for seq, _, _ in full] == sorted(seq for seq, _, _ in full)
+
+    last_seen = full[1][0]
+    resumed = client.get(events_url, headers={"Last-Event-ID": str(last_seen)})
+    assert _sse_events(resumed.get_data(as_text=True)) == full[2:]
+    manual = client.get(f"{events_url}?last_event_id={full[-2][0]}")
+    assert _sse_events(manual.get_data(as_text=True)) == full[-1:]
+
+    status = client.get(resp.get_json()["status_url"]).get_json()
+    assert all(result is not None for result in status["results"])
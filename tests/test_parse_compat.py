@@ -0,0 +1,57 @@
+"""
+Совместимость парсера ответов модели с прежней реализацией.
+
+Фиксированная часть корпуса bench/parse_compat.py: ручные пограничные случаи,
+заготовки mock_llm и случайные склейки фрагментов с постоянным seed. Полный
+прогон с любым seed — python bench/parse_compat.py --seed N --random M.
+"""
+from __future__ import annotations
+
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench"))
+
+import parse_compat as compat  # noqa: E402
+from mock_llm import split_tokens  # noqa: E402
+
+_SEED = 0
+_RANDOM_TEXTS = 400
+
+
+def _assert_clean(report: compat.Report) -> None:
+    assert report.checked
+    assert not report.mismatches, "\n".join(report.mismatches[:5])
+
+
+@pytest.mark.parametrize("text", compat._EDGE_CASES, ids=range(len(compat._EDGE_CASES)))
+@pytest.mark.parametrize("max_len", [4000, 120, 60])
+def test_edge_cases(text: str, max_len: int) -> None:
+    report = compat.Report()
+    compat.check(report, text, random.Random(_SEED), max_len=max_len)
+    compat.check_batch(report, text, 15)
+    _assert_clean(report)
+
+
+def test_canned_responses() -> None:
+    rng = random.Random(_SEED)
+    report = compat.Report()
+    for text in compat.canned_corpus():
+        for max_len in (4000, 120, 60):
+            compat.check(report, text, rng, max_len=max_len)
+        compat.check(report, "".join(split_tokens(text)), rng)
+        compat.check_batch(report, text, 15)
+    _assert_clean(report)
+
+
+def test_random_fragments() -> None:
+    rng = random.Random(_SEED)
+    report = compat.Report()
+    for _ in range(_RANDOM_TEXTS):
+        text = compat.random_text(rng)
+        compat.check(report, text, rng, max_len=rng.choice([4000, 4000, 120, 60]))
+        compat.check_batch(report, text, 3)
+    _assert_clean(report)